@@ -1,2 +1,4 @@
 import lib.clients.epg2xml
 import lib.clients.channels
+import lib.clients.epg_now_next
+import lib.clients.logo_cache
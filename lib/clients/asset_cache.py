@@ -0,0 +1,156 @@
+"""
+MIT License
+
+Copyright (C) 2023 ROCKY4546
+https://github.com/rocky4546
+
+This file is part of Cabernet
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+and associated documentation files (the "Software"), to deal in the Software without restriction,
+including without limitation the rights to use, copy, modify, merge, publish, distribute,
+sublicense, and/or sell copies of the Software, and to permit persons to whom the Software
+is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or
+substantial portions of the Software.
+"""
+
+import gzip
+import hashlib
+import importlib.resources
+import logging
+import mimetypes
+import os
+import pathlib
+import threading
+import time
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# htdocs folders served by the web admin
+ASSET_FOLDERS = ['html', 'images', 'modules']
+# files in the htdocs package that are never served
+SKIP_SUFFIXES = ('.py', '.pyc', '.xcf')
+# mime types worth compressing, fonts and images are already compressed
+COMPRESS_MIME_PREFIXES = ('text/', 'application/javascript', 'application/json',
+                          'application/xml', 'image/svg+xml')
+# smaller files are sent as is
+COMPRESS_MIN_SIZE = 512
+# html, js and css are revalidated on each use since their urls are not
+# versioned. Images and fonts rarely change.
+CACHE_CONTROL_DEFAULT = 'no-cache'
+CACHE_CONTROL_LONG = 'max-age=86400'
+CACHE_CONTROL_LONG_PREFIXES = ('image/', 'font/')
+
+
+class AssetCache:
+    """
+    Keeps the static web admin files from the htdocs package in memory,
+    keyed by package and file name.  Each asset holds the bytes, a strong
+    ETag, Last-Modified and gzip and brotli copies for text files.
+    The file is checked for a change on each use when it is on disk.
+    """
+    lock = threading.Lock()
+    assets = {}
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+
+    def get_asset(self, _package, _filename):
+        """
+        Raises the same exceptions as importlib.resources.read_binary()
+        when the file does not exist
+        """
+        key = (_package, _filename)
+        asset = AssetCache.assets.get(key)
+        if asset is not None and self.is_current(asset):
+            return asset
+        asset = self.load_asset(_package, _filename)
+        with AssetCache.lock:
+            AssetCache.assets[key] = asset
+        return asset
+
+    def is_current(self, _asset):
+        if _asset['path'] is None:
+            return True
+        try:
+            stat = os.stat(_asset['path'])
+        except OSError:
+            return False
+        return (stat.st_mtime_ns, stat.st_size) == _asset['stat']
+
+    def load_asset(self, _package, _filename):
+        resource = importlib.resources.files(_package).joinpath(_filename)
+        path = None
+        stat_key = None
+        last_modified = time.time()
+        if isinstance(resource, pathlib.Path):
+            path = str(resource)
+            stat = os.stat(path)
+            stat_key = (stat.st_mtime_ns, stat.st_size)
+            last_modified = stat.st_mtime
+        data = resource.read_bytes()
+        mime = mimetypes.guess_type(_filename)[0]
+        asset = {
+            'data': data,
+            'mime': mime,
+            'etag': '"{}"'.format(hashlib.md5(data).hexdigest()),
+            'last_modified': last_modified,
+            'cache_control': self.get_cache_control(mime),
+            'gzip': None,
+            'br': None,
+            'path': path,
+            'stat': stat_key}
+        if self.is_compressible(mime, data):
+            asset['gzip'] = self.keep_if_smaller(data, gzip.compress(data, 9, mtime=0))
+            if brotli is not None:
+                asset['br'] = self.keep_if_smaller(data, brotli.compress(data))
+        return asset
+
+    def is_compressible(self, _mime, _data):
+        return _mime is not None \
+            and _mime.startswith(COMPRESS_MIME_PREFIXES) \
+            and len(_data) >= COMPRESS_MIN_SIZE
+
+    def keep_if_smaller(self, _data, _compressed):
+        if len(_compressed) < len(_data) * 0.9:
+            return _compressed
+        return None
+
+    def get_cache_control(self, _mime):
+        if _mime is not None and _mime.startswith(CACHE_CONTROL_LONG_PREFIXES):
+            return CACHE_CONTROL_LONG
+        return CACHE_CONTROL_DEFAULT
+
+    def preload(self, _www_pkg):
+        """
+        Loads and compresses every servable file in the htdocs package
+        """
+        start = time.monotonic()
+        total = 0
+        root = importlib.resources.files(_www_pkg)
+        for folder in ASSET_FOLDERS:
+            total += self.preload_folder(root.joinpath(folder), _www_pkg + '.' + folder)
+        self.logger.debug('Preloaded {} web assets in {:.2f}s'
+                          .format(total, time.monotonic() - start))
+
+    def preload_folder(self, _folder, _package):
+        count = 0
+        if not _folder.is_dir():
+            return count
+        for entry in _folder.iterdir():
+            if entry.name.startswith(('.', '__')):
+                continue
+            if entry.is_dir():
+                count += self.preload_folder(entry, _package + '.' + entry.name)
+            elif not entry.name.endswith(SKIP_SUFFIXES):
+                try:
+                    self.get_asset(_package, entry.name)
+                    count += 1
+                except (OSError, ModuleNotFoundError) as ex:
+                    self.logger.info('Unable to preload web asset {} {}'.format(entry.name, ex))
+        return count
@@ -16,16 +16,22 @@ The above copyright notice and this permission notice shall be included in all c
 substantial portions of the Software.
 """
 
+import gzip
+import hashlib
 import io
 import logging
+import threading
+import time
 import urllib.request
 from io import StringIO
 from xml.sax.saxutils import escape
 
 import lib.common.utils as utils
 from lib.clients.channels.templates import ch_templates
+from lib.clients.logo_cache import LogoCache
 from lib.common.decorators import getrequest
 from lib.db.db_channels import DBChannels
+from lib.db.db_config_defn import DBConfigDefn
 import lib.image_size.get_image_size as get_image_size
 from lib.common.decorators import handle_url_except
 
@@ -39,38 +45,63 @@ def playlist(_webserver):
 
 @getrequest.route('/channels.m3u')
 def channels_m3u(_webserver):
-    _webserver.do_mime_response(200, 'audio/x-mpegurl', get_channels_m3u(
-        _webserver.config, _webserver.stream_url,
-        _webserver.query_data['name'],
-        _webserver.query_data['instance'],
-        _webserver.plugins.plugins
-    ))
+    send_lineup(_webserver, 'm3u')
 
 
 @getrequest.route('/lineup.xml')
 def lineup_xml(_webserver):
-    _webserver.do_mime_response(200, 'application/xml', get_channels_xml(
-        _webserver.config, _webserver.stream_url,
-        _webserver.query_data['name'],
-        _webserver.query_data['instance'],
-        _webserver.plugins.plugins
-    ))
+    send_lineup(_webserver, 'xml')
 
 
 @getrequest.route('/lineup.json')
 def lineup_json(_webserver):
-    _webserver.do_mime_response(200, None, get_channels_json(
-        _webserver.config, _webserver.stream_url,
+    send_lineup(_webserver, 'json')
+
+
+def send_lineup(_webserver, _format):
+    response = LineupResponses(_webserver.config).get_response(
+        _format, _webserver.config, _webserver.stream_url,
         _webserver.query_data['name'],
         _webserver.query_data['instance'],
-        _webserver.plugins.plugins
-    ))
+        _webserver.plugins.plugins)
+    _webserver.do_etag_response(
+        LINEUP_FORMATS[_format][0], response['data'], response['etag'],
+        response['last_modified'], response['gzip'])
+
+
+def get_enabled_stations(_config, _plugins, _ch_data):
+    """
+    Yields (sid, sid_data, config_section) for the first enabled station
+    of each sid whose plugin and instance are enabled
+    """
+    enabled_sections = {}
+    for sid, sid_data_list in _ch_data.items():
+        for sid_data in sid_data_list:
+            if not sid_data['enabled']:
+                continue
+            ns_inst = (sid_data['namespace'], sid_data['instance'])
+            config_section = enabled_sections.get(ns_inst)
+            if config_section is None:
+                config_section = False
+                if _plugins.get(sid_data['namespace']) \
+                        and _plugins[sid_data['namespace']].enabled \
+                        and _plugins[sid_data['namespace']] \
+                        .plugin_obj.instances[sid_data['instance']].enabled:
+                    section = utils.instance_config_section(sid_data['namespace'], sid_data['instance'])
+                    if _config[section]['enabled']:
+                        config_section = section
+                enabled_sections[ns_inst] = config_section
+            if not config_section:
+                continue
+            yield sid, sid_data, config_section
+            break
 
 
 def get_channels_m3u(_config, _base_url, _namespace, _instance, _plugins):
     format_descriptor = '#EXTM3U'
     record_marker = '#EXTINF'
     ch_obj = ChannelsURL(_config, _base_url)
+    logo_cache = LogoCache(_config)
 
     db = DBChannels(_config)
     ch_data = db.get_channels(_namespace, _instance)
@@ -79,68 +110,53 @@ def get_channels_m3u(_config, _base_url, _namespace, _instance, _plugins):
         '%s\n' % format_descriptor
     )
 
-    sids_processed = []
-    for sid, sid_data_list in ch_data.items():
-        for sid_data in sid_data_list:
-            if sid in sids_processed:
-                continue
-            if not sid_data['enabled'] \
-                    or not _plugins.get(sid_data['namespace']) \
-                    or not _plugins[sid_data['namespace']].enabled:
-                continue
-            if not _plugins[sid_data['namespace']] \
-                    .plugin_obj.instances[sid_data['instance']].enabled:
-                continue
-            config_section = utils.instance_config_section(sid_data['namespace'], sid_data['instance'])
-            if not _config[config_section]['enabled']:
-                continue
-            sids_processed.append(sid)
-            stream = _config[config_section]['player-stream_type']
-            if stream == 'm3u8redirect' and sid_data['json'].get('stream_url'):
-                uri = sid_data['json']['stream_url']
-            else:
-                uri = ch_obj.set_uri(sid_data)
-
-            # NOTE tvheadend supports '|' separated names in two attributes
-            # either 'group-title' or 'tvh-tags'
-            # if a ';' is used in group-title, tvheadend will use the 
-            # entire string as a tag
-            groups = sid_data['namespace']
-            inst_group = _config[config_section]['channel-group_name']
-            if inst_group is not None:
-                groups += '|' + inst_group
-            if sid_data['group_tag']:
-                groups += '|' + '|'.join([sid_data['group_tag']])
-            if sid_data['json']['HD']:
-                if sid_data['json']['group_hdtv']:
-                    groups += '|' + sid_data['json']['group_hdtv']
-            elif sid_data['json']['group_sdtv']:
-                groups += '|' + sid_data['json']['group_sdtv']
+    for sid, sid_data, config_section in get_enabled_stations(_config, _plugins, ch_data):
+        stream = _config[config_section]['player-stream_type']
+        if stream == 'm3u8redirect' and sid_data['json'].get('stream_url'):
+            uri = sid_data['json']['stream_url']
+        else:
+            uri = ch_obj.set_uri(sid_data)
+
+        # NOTE tvheadend supports '|' separated names in two attributes
+        # either 'group-title' or 'tvh-tags'
+        # if a ';' is used in group-title, tvheadend will use the 
+        # entire string as a tag
+        groups = sid_data['namespace']
+        inst_group = _config[config_section]['channel-group_name']
+        if inst_group is not None:
+            groups += '|' + inst_group
+        if sid_data['group_tag']:
+            groups += '|' + '|'.join([sid_data['group_tag']])
+        if sid_data['json']['HD']:
+            if sid_data['json']['group_hdtv']:
+                groups += '|' + sid_data['json']['group_hdtv']
+        elif sid_data['json']['group_sdtv']:
+            groups += '|' + sid_data['json']['group_sdtv']
 
-            updated_chnum = utils.wrap_chnum(
-                str(sid_data['display_number']), sid_data['namespace'],
-                sid_data['instance'], _config)
-            service_name = ch_obj.set_service_name(sid_data)
-            fakefile.write(
-                '%s\n' % (
-                        record_marker + ':-1' + ' ' +
-                        'channelID="' + sid + '" ' +
-                        'tvg-num="' + updated_chnum + '" ' +
-                        'tvg-chno="' + updated_chnum + '" ' +
-                        'tvg-name="' + sid_data['display_name'] + '" ' +
-                        'tvg-id="' + sid + '" ' +
-                        (('tvg-logo="' + sid_data['thumbnail'] + '" ')
-                         if sid_data['thumbnail'] else '') +
-                        'group-title="' + groups + '",' + service_name
-                )
+        updated_chnum = utils.wrap_chnum(
+            str(sid_data['display_number']), sid_data['namespace'],
+            sid_data['instance'], _config)
+        service_name = ch_obj.set_service_name(sid_data)
+        fakefile.write(
+            '%s\n' % (
+                    record_marker + ':-1' + ' ' +
+                    'channelID="' + sid + '" ' +
+                    'tvg-num="' + updated_chnum + '" ' +
+                    'tvg-chno="' + updated_chnum + '" ' +
+                    'tvg-name="' + sid_data['display_name'] + '" ' +
+                    'tvg-id="' + sid + '" ' +
+                    (('tvg-logo="' + logo_cache.get_channel_url(_base_url, sid_data) + '" ')
+                     if sid_data['thumbnail'] else '') +
+                    'group-title="' + groups + '",' + service_name
             )
-            fakefile.write(
-                '%s\n' % (
-                    (
-                        uri
-                    )
+        )
+        fakefile.write(
+            '%s\n' % (
+                (
+                    uri
                 )
             )
+        )
     return fakefile.getvalue()
 
 
@@ -148,81 +164,105 @@ def get_channels_json(_config, _base_url, _namespace, _instance, _plugins):
     db = DBChannels(_config)
     ch_obj = ChannelsURL(_config, _base_url)
     ch_data = db.get_channels(_namespace, _instance)
-    return_json = ''
-    sids_processed = []
-    for sid, sid_data_list in ch_data.items():
-        for sid_data in sid_data_list:
-            if sid in sids_processed:
-                continue
-            if not sid_data['enabled'] \
-                    or not _plugins.get(sid_data['namespace']) \
-                    or not _plugins[sid_data['namespace']].enabled:
-                continue
-            if not _plugins[sid_data['namespace']] \
-                    .plugin_obj.instances[sid_data['instance']].enabled:
-                continue
-            config_section = utils.instance_config_section(sid_data['namespace'], sid_data['instance'])
-            if not _config[config_section]['enabled']:
-                continue
-            sids_processed.append(sid)
-            stream = _config[config_section]['player-stream_type']
-            if stream == 'm3u8redirect' and sid_data['json'].get('stream_url'):
-                uri = sid_data['json']['stream_url']
-            else:
-                uri = ch_obj.set_uri(sid_data)
+    return_json = []
+    for sid, sid_data, config_section in get_enabled_stations(_config, _plugins, ch_data):
+        stream = _config[config_section]['player-stream_type']
+        if stream == 'm3u8redirect' and sid_data['json'].get('stream_url'):
+            uri = sid_data['json']['stream_url']
+        else:
+            uri = ch_obj.set_uri(sid_data)
 
-            updated_chnum = utils.wrap_chnum(
-                str(sid_data['display_number']), sid_data['namespace'],
-                sid_data['instance'], _config)
-            return_json = return_json + ch_templates['jsonLineup'].format(
-                sid_data['json']['callsign'],
-                updated_chnum,
-                sid_data['display_name'],
-                uri,
-                sid_data['json']['HD'])
-            return_json = return_json + ','
-    return "[" + return_json[:-1] + "]"
+        updated_chnum = utils.wrap_chnum(
+            str(sid_data['display_number']), sid_data['namespace'],
+            sid_data['instance'], _config)
+        return_json.append(ch_templates['jsonLineup'].format(
+            sid_data['json']['callsign'],
+            updated_chnum,
+            sid_data['display_name'],
+            uri,
+            sid_data['json']['HD']))
+    return "[" + ','.join(return_json) + "]"
 
 
 def get_channels_xml(_config, _base_url, _namespace, _instance, _plugins):
     db = DBChannels(_config)
     ch_obj = ChannelsURL(_config, _base_url)
     ch_data = db.get_channels(_namespace, _instance)
-    return_xml = ''
-    sids_processed = []
-    for sid, sid_data_list in ch_data.items():
-        for sid_data in sid_data_list:
-            if sid in sids_processed:
-                continue
-            if not sid_data['enabled']:
-                continue
-            if not _plugins.get(sid_data['namespace']):
-                continue
-            if not _plugins[sid_data['namespace']].enabled:
-                continue
-            if not _plugins[sid_data['namespace']] \
-                    .plugin_obj.instances[sid_data['instance']].enabled:
-                continue
-
-            config_section = utils.instance_config_section(sid_data['namespace'], sid_data['instance'])
-            if not _config[config_section]['enabled']:
-                continue
-            sids_processed.append(sid)
-            stream = _config[config_section]['player-stream_type']
-            if stream == 'm3u8redirect':
-                uri = sid_data['json']['stream_url']
-                uri = escape(uri)
-            else:
-                uri = escape(ch_obj.set_uri(sid_data))
-            updated_chnum = utils.wrap_chnum(
-                str(sid_data['display_number']), sid_data['namespace'],
-                sid_data['instance'], _config)
-            return_xml = return_xml + ch_templates['xmlLineup'].format(
-                updated_chnum,
-                escape(sid_data['display_name']),
-                uri,
-                sid_data['json']['HD'])
-    return "<Lineup>" + return_xml + "</Lineup>"
+    return_xml = []
+    for sid, sid_data, config_section in get_enabled_stations(_config, _plugins, ch_data):
+        stream = _config[config_section]['player-stream_type']
+        if stream == 'm3u8redirect':
+            uri = sid_data['json']['stream_url']
+            uri = escape(uri)
+        else:
+            uri = escape(ch_obj.set_uri(sid_data))
+        updated_chnum = utils.wrap_chnum(
+            str(sid_data['display_number']), sid_data['namespace'],
+            sid_data['instance'], _config)
+        return_xml.append(ch_templates['xmlLineup'].format(
+            updated_chnum,
+            escape(sid_data['display_name']),
+            uri,
+            sid_data['json']['HD']))
+    return "<Lineup>" + ''.join(return_xml) + "</Lineup>"
+
+
+# format -> (mime type, function generating the lineup)
+LINEUP_FORMATS = {
+    'm3u': ('audio/x-mpegurl', get_channels_m3u),
+    'xml': ('application/xml', get_channels_xml),
+    'json': ('application/json', get_channels_json)
+}
+
+
+class LineupResponses:
+    """
+    Keeps the encoded and gzipped lineup responses for each format,
+    namespace/instance and base url.  A response is generated again only
+    when the channels or config database changes or a plugin or instance
+    is enabled or disabled.
+    """
+    lock = threading.Lock()
+    responses = {}
+
+    def __init__(self, _config):
+        self.channels_db = DBChannels(_config)
+        self.configdefn_db = DBConfigDefn(_config)
+
+    def get_response(self, _format, _config, _base_url, _namespace, _instance, _plugins):
+        version = self.get_version(_plugins)
+        key = (_format, _base_url, _namespace, _instance)
+        with LineupResponses.lock:
+            response = LineupResponses.responses.get(key)
+            if response is not None and response['version'] == version:
+                return response
+            data = LINEUP_FORMATS[_format][1](
+                _config, _base_url, _namespace, _instance, _plugins).encode('utf-8')
+            etag = '"{}"'.format(hashlib.md5(data).hexdigest())
+            if response is not None and response['etag'] == etag:
+                # content did not change
+                response['version'] = version
+                return response
+            response = {
+                'version': version,
+                'data': data,
+                'gzip': gzip.compress(data, mtime=0),
+                'etag': etag,
+                'last_modified': time.time()}
+            LineupResponses.responses[key] = response
+            return response
+
+    def get_version(self, _plugins):
+        plugins_enabled = []
+        for name, plugin in _plugins.items():
+            if plugin.enabled and plugin.plugin_obj:
+                plugins_enabled.append((name, tuple(
+                    inst_name for inst_name, inst in plugin.plugin_obj.instances.items()
+                    if inst.enabled)))
+        return (
+            self.channels_db.get_data_version(),
+            self.configdefn_db.get_data_version(),
+            tuple(plugins_enabled))
 
 
 class ChannelsURL:
@@ -286,6 +326,9 @@ class ChannelsURL:
         thumbnail_size = (0, 0)
         if _thumbnail is None or _thumbnail == '':
             return thumbnail_size
+        logo_cache = LogoCache(self.config)
+        if logo_cache.is_cacheable(_thumbnail):
+            return logo_cache.get_size(_thumbnail)
         h = {'User-Agent': utils.DEFAULT_USER_AGENT,
              'Accept': '*/*',
              'Accept-Encoding': 'identity',
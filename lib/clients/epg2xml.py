@@ -20,44 +20,86 @@ substantial portions of the Software.
 import traceback
 import datetime
 import errno
+import hashlib
+import json
 import logging
+import os
+import pathlib
 import re
-import xml.dom.minidom as minidom
-from xml.etree import ElementTree
+import shutil
+from xml.sax.saxutils import escape
 
 import lib.common.utils as utils
 import lib.tvheadend.epg_category as epg_category
+from lib.clients.logo_cache import LogoCache
 from lib.common.decorators import getrequest
+from lib.common.filelock import FileLock
+from lib.common.filelock import Timeout
 from lib.db.db_channels import DBChannels
 from lib.db.db_epg import DBepg
 from lib.web.pages.templates import web_templates
 
+# number of characters buffered before writing to the client
+WRITE_SIZE = 65536
+ATTRIB_ENTITIES = {'"': '&quot;', '\n': '&#10;', '\r': '&#13;', '\t': '&#09;'}
+# folder in the data folder holding the pre-rendered xmltv files
+XMLTV_FOLDER = 'xmltv'
+# seconds to wait on another process building the same xmltv file
+XMLTV_LOCK_TIMEOUT = 300
+# config settings used when generating the xmltv file for each instance
+XMLTV_INSTANCE_SETTINGS = ['enabled', 'epg-enabled', 'epg-prefix', 'epg-suffix']
+
 
 @getrequest.route('/xmltv.xml')
 def xmltv_xml(_webserver):
+    namespace = _webserver.query_data['name']
+    instance = _webserver.query_data['instance']
+    if namespace is not None \
+            and not _webserver.plugins.plugins.get(namespace):
+        _webserver.do_mime_response(
+            501, 'text/html',
+            web_templates['htmlError'].format('501 - Invalid Namespace: {}'.format(namespace)))
+        return
     try:
-        epg = EPG(_webserver)
-        epg.get_epg_xml(_webserver)
+        config = _webserver.plugins.config_obj.data
+        filepath = None
+        if config['epg'].get('epg_xmltv_cache'):
+            filepath = XMLTVFiles(config, _webserver.plugins).get_file(namespace, instance)
+        if filepath:
+            _webserver.do_sendfile_response('application/xml', filepath)
+        else:
+            epg = EPG(config, _webserver.plugins, namespace, instance)
+            epg.get_epg_xml(_webserver)
     except MemoryError as e:
         _webserver.do_mime_response(
             501, 'text/html',
             web_templates['htmlError'].format('501 - MemoryError: {}'.format(e)))
 
 
+def get_logo_base_url(_config):
+    """
+    Channel icons are served from the tuner port, same as the streams
+    """
+    return '{}:{}'.format(_config['web']['plex_accessible_ip'],
+                          _config['web']['plex_accessible_port'])
+
+
 class EPG:
     # https://github.com/XMLTV/xmltv/blob/master/xmltv.dtd
-    def __init__(self, _webserver):
+    def __init__(self, _config, _plugins, _namespace, _instance):
         self.logger = logging.getLogger(__name__)
-        self.webserver = _webserver
-        self.config = _webserver.plugins.config_obj.data
+        self.config = _config
         self.epg_db = DBepg(self.config)
         self.channels_db = DBChannels(self.config)
-        self.plugins = _webserver.plugins
-        self.namespace = _webserver.query_data['name']
-        self.instance = _webserver.query_data['instance']
+        self.logo_cache = LogoCache(self.config)
+        self.plugins = _plugins
+        self.namespace = _namespace
+        self.instance = _instance
         self.tv_tag = False
         self.today = datetime.datetime.utcnow().date()
-        self.prog_processed = []
+        self.prog_processed = set()
+        # programs for channels not in the lineup are never written
+        self.channel_ids = None
 
     def get_next_epg_day(self):
         is_enabled = False
@@ -66,61 +108,53 @@ class EPG:
         inst = None
         day = None
         while not is_enabled:
-            day_data, ns, inst, day = self.epg_db.get_next_row()
+            day_data, ns, inst, day = self.epg_db.get_next_row(self.channel_ids)
             if day_data is None:
                 break
             if day < self.today:
                 continue
-            config_section = utils.instance_config_section(ns, inst)
-            
-            if not self.config.get(ns.lower()) \
-                    or not self.config[ns.lower()]['enabled'] \
-                    or not self.config.get(config_section) \
-                    or not self.config[config_section]['enabled'] \
-                    or not self.config[config_section].get('epg-enabled'):
-                continue
-            is_enabled = True
+            is_enabled = self.is_epg_enabled(ns, inst)
         return day_data, ns, inst, day
 
+    def is_epg_enabled(self, _namespace, _instance):
+        config_section = utils.instance_config_section(_namespace, _instance)
+        if not self.config.get(_namespace.lower()) \
+                or not self.config[_namespace.lower()]['enabled'] \
+                or not self.config.get(config_section) \
+                or not self.config[config_section]['enabled'] \
+                or not self.config[config_section].get('epg-enabled'):
+            return False
+        return True
+
     def get_epg_xml(self, _webserver):
         xml_out = None
-        
-        if self.namespace is not None \
-                and not self.plugins.plugins.get(self.namespace):
-            _webserver.do_mime_response(
-                501, 'text/html',
-                web_templates['htmlError'].format('501 - Invalid Namespace: {}'.format(self.namespace)))
-            return
-
         try:
             _webserver.do_dict_response({
                 'code': 200,
                 'headers': {'Content-type': 'application/xml; Transfer-Encoding: chunked'},
                 'text': None})
-            xml_out = self.gen_header_xml()
+            xml_out = XMLTVWriter(_webserver.wfile, self.config['epg']['epg_prettyprint'])
+            self.gen_header_xml(xml_out)
             channel_list = self.channels_db.get_channels(self.namespace, self.instance)
+            self.channel_ids = set(channel_list.keys())
             self.gen_channel_xml(xml_out, channel_list)
-            self.write_xml(xml_out, keep_xml_prolog=True)
-            xml_out = None
+            xml_out.flush()
 
             self.epg_db.init_get_query(self.namespace, self.instance)
 
             day_data, ns, inst, day = self.get_next_epg_day()
             self.logger.debug('Processing EPG data {}:{} {}'
                               .format(ns, inst, day))
-            self.prog_processed = []
+            self.prog_processed = set()
             while day_data:
-                xml_out = EPG.gen_minimal_header_xml()
                 self.gen_program_xml(xml_out, day_data, channel_list, ns, inst)
-                self.write_xml(xml_out)
-                xml_out.clear()
                 day_data, ns, inst, day = self.get_next_epg_day()
                 self.logger.debug('Processing EPG data {}:{} {}'
                                   .format(ns, inst, day))
             day_data = None
             self.epg_db.close_query()
-            self.webserver.wfile.write(b'</tv>\r\n')
-            self.webserver.wfile.flush()
+            xml_out.end_tv()
+            _webserver.wfile.flush()
         except MemoryError as e:
             self.logger.error('MemoryError parsing large xml')
             raise e
@@ -130,7 +164,7 @@ class EPG:
                 # Normal process.  Client request end of stream
                 self.logger.info('Connection dropped by client {}'
                                  .format(ex))
-                xml_out.clear()
+                self.epg_db.close_query()
                 return
             else:
                 self.logger.error('{}{}'.format(
@@ -139,57 +173,17 @@ class EPG:
 
         xml_out = None   # clear to help garbage collection
 
-    def write_xml(self, _xml, keep_xml_prolog=False):
-        if self.config['epg']['epg_prettyprint']:
-            if not keep_xml_prolog:
-                epg_dom = minidom.parseString(ElementTree.tostring(_xml, encoding='UTF-8', method='xml')).toprettyxml()
-                if epg_dom.endswith('</tv>\n'):
-                    epg_dom = epg_dom.replace('<?xml version="1.0" ?>\n<tv>', '', 1)
-                    epg_dom = epg_dom.replace('</tv>', '', 1)
-                else:
-                    epg_dom = ''
-            else:
-                epg_dom = minidom.parseString(ElementTree.tostring(_xml, encoding='UTF-8', method='xml')).toprettyxml()
-                epg_dom = epg_dom.replace('<?xml version="1.0" ?>\n','<?xml version="1.0" encoding="UTF-8"?>\n<!DOCTYPE tv SYSTEM "xmltv.dtd">\n',1) 
-                if epg_dom.endswith('</tv>\n'):
-                    epg_dom = re.sub('</tv>\n$', '', epg_dom)
-                else:
-                    epg_dom = re.sub('"/>\n$', '">', epg_dom)
-            self.webserver.wfile.write(epg_dom.encode())
-        else:
-            if not keep_xml_prolog:
-                epg_dom = ElementTree.tostring(_xml)
-                if epg_dom.endswith(b'<tv />'):
-                    epg_dom = b''
-                else:
-                    epg_dom = epg_dom.replace(b'<tv>', b'', 1)
-                    epg_dom = epg_dom.replace(b'</tv>', b'', 1)
-            else:
-                epg_dom = b'<?xml version="1.0" encoding="UTF-8"?><!DOCTYPE tv SYSTEM "xmltv.dtd">'
-                epg_dom = epg_dom + ElementTree.tostring(_xml)
-                if epg_dom.endswith(b'</tv>'):
-                    epg_dom = re.sub(b'</tv>$', b'', epg_dom)
-                else:
-                    epg_dom = re.sub(b'" />$', b'">', epg_dom)
-            self.webserver.wfile.write(epg_dom + b'\r\n')
-        epg_dom = None      # clear to help garbage collection
-        return True
-
-    def gen_channel_xml(self, _et_root, _channel_list):
-        sids_processed = []
+    def gen_channel_xml(self, _xml_out, _channel_list):
+        sids_processed = set()
+        logo_base_url = get_logo_base_url(self.config)
         for sid, sid_data_list in _channel_list.items():
             if sid in sids_processed:
                 continue
-            sids_processed.append(sid)
+            sids_processed.add(sid)
             for ch_data in sid_data_list:
                 if not ch_data['enabled']:
                     continue
-                config_section = utils.instance_config_section(ch_data['namespace'], ch_data['instance'])
-                if not self.config.get(ch_data['namespace'].lower()) \
-                        or not self.config[ch_data['namespace'].lower()]['enabled'] \
-                        or not self.config.get(config_section) \
-                        or not self.config[config_section]['enabled'] \
-                        or not self.config[config_section].get('epg-enabled'):
+                if not self.is_epg_enabled(ch_data['namespace'], ch_data['instance']):
                     continue
 
                 updated_chnum = utils.wrap_chnum(
@@ -203,22 +197,24 @@ class EPG:
                     ch_ref += updated_chnum
                 else:
                     ch_ref += sid
-                c_out = EPG.sub_el(_et_root, 'channel', id=ch_ref)
+                _xml_out.start('channel', id=ch_ref)
 
-                EPG.sub_el(c_out, 'display-name', _text='%s %s' %
+                _xml_out.element('display-name', _text='%s %s' %
                     (updated_chnum, ch_data['display_name']))
-                EPG.sub_el(c_out, 'display-name', _text=ch_data['display_name'])
-                EPG.sub_el(c_out, 'display-name', _text=ch_data['json']['callsign'])
-                EPG.sub_el(c_out, 'display-name', _text='%s %s' %
+                _xml_out.element('display-name', _text=ch_data['display_name'])
+                _xml_out.element('display-name', _text=ch_data['json']['callsign'])
+                _xml_out.element('display-name', _text='%s %s' %
                     (updated_chnum, ch_data['json']['callsign']))
-                EPG.sub_el(c_out, 'lcn', _text='%s' %
+                _xml_out.element('lcn', _text='%s' %
                     (updated_chnum))
                 if self.config['epg']['epg_channel_icon'] and ch_data['thumbnail'] is not None:
-                    EPG.sub_el(c_out, 'icon', src=ch_data['thumbnail'])
+                    _xml_out.element('icon', src=self.logo_cache.get_channel_url(
+                        logo_base_url, ch_data))
+                _xml_out.end('channel')
                 break
-        return _et_root
+        return _xml_out
 
-    def gen_program_xml(self, _et_root, _prog_list, _channel_list, _ns, _inst):
+    def gen_program_xml(self, _xml_out, _prog_list, _channel_list, _ns, _inst):
 
         for prog_data in _prog_list:
             proginfo = prog_data['start'] + prog_data['channel']
@@ -247,7 +243,7 @@ class EPG:
             
             if skip:
                 continue
-            self.prog_processed.append(proginfo)
+            self.prog_processed.add(proginfo)
 
             if self.config['epg'].get('epg_add_plugin_to_channel_id'):
                 ch_ref = ch_data['namespace'] + '-'
@@ -261,14 +257,14 @@ class EPG:
                 ch_ref += updated_chnum
             else:
                 ch_ref += prog_data['channel']
-            prog_out = EPG.sub_el(_et_root, 'programme',
-                                  start=prog_data['start'],
-                                  stop=prog_data['stop'],
-                                  channel=ch_ref)
+            _xml_out.start('programme',
+                           start=prog_data['start'],
+                           stop=prog_data['stop'],
+                           channel=ch_ref)
             if prog_data['title']:
-                EPG.sub_el(prog_out, 'title', lang='en', _text=prog_data['title'])
+                _xml_out.element('title', lang='en', _text=prog_data['title'])
             if prog_data['subtitle']:
-                EPG.sub_el(prog_out, 'sub-title', lang='en', _text=prog_data['subtitle'])
+                _xml_out.element('sub-title', lang='en', _text=prog_data['subtitle'])
             descr_add = ''
             if self.config['epg']['description'] == 'extend':
                 if prog_data['formatted_date']:
@@ -287,17 +283,18 @@ class EPG:
             else:
                 self.logger.warning('Config value [epg][description] is invalid: '
                                     + self.config['epg']['description'])
-            EPG.sub_el(prog_out, 'desc', lang='en', _text=descr_add)
+            _xml_out.element('desc', lang='en', _text=descr_add)
 
             if prog_data['video_quality']:
-                video_out = EPG.sub_el(prog_out, 'video')
-                EPG.sub_el(video_out, 'quality', prog_data['video_quality'])
+                _xml_out.start('video')
+                _xml_out.element('quality', prog_data['video_quality'])
+                _xml_out.end('video')
 
             if prog_data['air_date']:
-                EPG.sub_el(prog_out, 'date',
+                _xml_out.element('date',
                            _text=prog_data['air_date'])
 
-            EPG.sub_el(prog_out, 'length', units='minutes', _text=str(prog_data['length']))
+            _xml_out.element('length', units='minutes', _text=str(prog_data['length']))
 
             if prog_data['genres']:
                 for f in prog_data['genres']:
@@ -309,67 +306,322 @@ class EPG:
                     else:
                         self.logger.warning('Config value [epg][genre] is invalid: '
                                             + self.config['epg']['genre'])
-                    EPG.sub_el(prog_out, 'category', lang='en', _text=f.strip())
+                    _xml_out.element('category', lang='en', _text=f.strip())
 
             if prog_data['icon'] and self.config['epg']['epg_program_icon']:
-                EPG.sub_el(prog_out, 'icon', src=prog_data['icon'])
+                _xml_out.element('icon', src=prog_data['icon'])
 
             if prog_data['actors'] or prog_data['directors']:
-                r = ElementTree.SubElement(prog_out, 'credits')
+                _xml_out.start('credits')
                 if prog_data['directors']:
                     for actor in prog_data['directors']:
-                        EPG.sub_el(r, 'director', _text=actor)
+                        _xml_out.element('director', _text=actor)
                 if prog_data['actors']:
                     for actor in prog_data['actors']:
-                        EPG.sub_el(r, 'actor', _text=actor)
+                        _xml_out.element('actor', _text=actor)
+                _xml_out.end('credits')
 
             if prog_data['rating']:
-                r = ElementTree.SubElement(prog_out, 'rating')
-                EPG.sub_el(r, 'value', _text=prog_data['rating'])
+                _xml_out.start('rating')
+                _xml_out.element('value', _text=prog_data['rating'])
+                _xml_out.end('rating')
 
             if prog_data['se_common']:
-                EPG.sub_el(prog_out, 'episode-num', system='common',
+                _xml_out.element('episode-num', system='common',
                            _text=prog_data['se_common'])
-                EPG.sub_el(prog_out, 'episode-num', system='SxxExx',
+                _xml_out.element('episode-num', system='SxxExx',
                            _text=prog_data['se_common'])
             if prog_data['se_progid']:
-                EPG.sub_el(prog_out, 'episode-num', system='dd_progid',
+                _xml_out.element('episode-num', system='dd_progid',
                            _text=prog_data['se_progid'])
             if prog_data['se_xmltv_ns']:
-                EPG.sub_el(prog_out, 'episode-num', system='xmltv_ns',
+                _xml_out.element('episode-num', system='xmltv_ns',
                            _text=prog_data['se_xmltv_ns'])
             if prog_data['is_new']:
-                EPG.sub_el(prog_out, 'new')
+                _xml_out.element('new')
             else:
-                EPG.sub_el(prog_out, 'previously-shown')
+                _xml_out.element('previously-shown')
             if prog_data['cc']:
-                EPG.sub_el(prog_out, 'subtitles', type='teletext')
+                _xml_out.element('subtitles', type='teletext')
             if prog_data['premiere']:
-                EPG.sub_el(prog_out, 'premiere')
+                _xml_out.element('premiere')
+            _xml_out.end('programme')
+
+    def gen_header_xml(self, _xml_out):
+        _xml_out.start_tv(**self.get_header())
+        return _xml_out
 
-    def gen_header_xml(self):
+    def get_header(self):
+        """
+        Returns the attributes of the tv element
+        """
         if self.namespace is None:
             website = utils.CABERNET_URL
             name = utils.CABERNET_ID
         else:
             website = self.plugins.plugins[self.namespace].plugin_settings['website']
             name = self.plugins.plugins[self.namespace].plugin_settings['name']
+        return {
+            'source-info-url': website,
+            'source-info-name': name,
+            'generator-info-name': utils.CABERNET_ID,
+            'generator-info-url': utils.CABERNET_URL}
+
+
+class XMLTVFiles:
+    """
+    Pre-rendered xmltv.xml files kept in the data folder, one for each
+    namespace/instance requested, including the merged file for all plugins.
+    Each EPG day is rendered into its own fragment file and the xmltv file is
+    the header and channels followed by the fragments, so an EPG refresh
+    only renders the days whose last_update changed.
+    A <key>.json manifest records what each fragment was rendered from.
+    """
+    # key -> versions of the databases when the file was last checked
+    validated = {}
+
+    def __init__(self, _config, _plugins=None):
+        self.logger = logging.getLogger(__name__)
+        self.config = _config
+        self.plugins = _plugins
+        self.epg_db = DBepg(self.config)
+        self.channels_db = DBChannels(self.config)
+        self.folder = pathlib.Path(self.config['paths']['db_dir']) \
+            .joinpath(XMLTV_FOLDER)
+
+    def get_file(self, _namespace, _instance):
+        """
+        Returns the path to the current xmltv file, updating it when the
+        EPG, channels or config have changed.  Returns None when the file
+        cannot be created and the xml should be streamed instead
+        """
+        key = self.get_key(_namespace, _instance)
+        filepath = self.folder.joinpath(key + '.xml')
+        version = (self.epg_db.get_data_version(),
+                   self.channels_db.get_data_version(),
+                   self.get_config_sig(),
+                   datetime.datetime.utcnow().date())
+        if XMLTVFiles.validated.get(key) == version and filepath.exists():
+            return filepath
+        header = EPG(self.config, self.plugins, _namespace, _instance).get_header()
+        if not self.update_file(key, _namespace, _instance, header):
+            return None
+        XMLTVFiles.validated[key] = version
+        return filepath
+
+    def update_files(self, _namespace, _instance):
+        """
+        Updates the existing xmltv files that include the namespace/instance.
+        Called at the end of an EPG refresh
+        """
+        if not self.folder.exists():
+            return
+        for manifest_path in self.folder.glob('*.json'):
+            manifest = self.load_manifest(manifest_path.stem)
+            if manifest is None:
+                continue
+            if manifest['namespace'] not in (None, _namespace) \
+                    or manifest['instance'] not in (None, _instance):
+                continue
+            self.update_file(manifest_path.stem, manifest['namespace'],
+                             manifest['instance'], manifest['sig'][2])
 
-        xml_out = ElementTree.Element('!DOCTYPE')
-        xml_out = ElementTree.Element('tv')
-        xml_out.set('source-info-url', website)
-        xml_out.set('source-info-name', name)
-        xml_out.set('generator-info-name', utils.CABERNET_ID)
-        xml_out.set('generator-info-url', utils.CABERNET_URL)
-        return xml_out
-
-    @staticmethod
-    def gen_minimal_header_xml():
-        return ElementTree.Element('tv')
-
-    @staticmethod
-    def sub_el(_parent, _name, _text=None, **kwargs):
-        el = ElementTree.SubElement(_parent, _name, **kwargs)
+    def update_file(self, _key, _namespace, _instance, _header):
+        try:
+            os.makedirs(self.folder.joinpath(_key), exist_ok=True)
+            with FileLock(str(self.folder.joinpath(_key + '.lock')),
+                          timeout=XMLTV_LOCK_TIMEOUT):
+                self.build_file(_key, _namespace, _instance, _header)
+            return True
+        except (OSError, ValueError, Timeout) as ex:
+            self.logger.warning('Unable to update xmltv file {}, {}'.format(_key, ex))
+            return False
+
+    def build_file(self, _key, _namespace, _instance, _header):
+        epg = EPG(self.config, self.plugins, _namespace, _instance)
+        channel_list = self.channels_db.get_channels(_namespace, _instance)
+        channels_sig = hashlib.md5(json.dumps(
+            channel_list, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        sig = [self.get_config_sig(), channels_sig, _header]
+        manifest = self.load_manifest(_key)
+        if manifest is None or manifest['sig'] != sig:
+            old_fragments = {}
+        else:
+            old_fragments = manifest['fragments']
+
+        fragments = {}
+        rendered = 0
+        for row in self.epg_db.get_epg_rows(_namespace, _instance):
+            day = datetime.date.fromisoformat(str(row['day']))
+            if day < epg.today or not epg.is_epg_enabled(row['namespace'], row['instance']):
+                continue
+            name = '{}_{}.xml'.format(self.get_key(row['namespace'], row['instance']), day)
+            inputs = [row['file'], str(row['last_update'])]
+            fragment = old_fragments.get(name)
+            if fragment is not None \
+                    and fragment['inputs'] == inputs \
+                    and epg.prog_processed.isdisjoint(fragment['emitted']) \
+                    and epg.prog_processed.issuperset(fragment['dups']) \
+                    and self.folder.joinpath(_key, name).exists():
+                epg.prog_processed.update(fragment['emitted'])
+            else:
+                fragment = self.build_fragment(
+                    epg, self.folder.joinpath(_key, name), row, channel_list)
+                fragment['inputs'] = inputs
+                rendered += 1
+            fragments[name] = fragment
+
+        if rendered == 0 and manifest is not None \
+                and list(fragments.keys()) == list(manifest['fragments'].keys()) \
+                and self.folder.joinpath(_key + '.xml').exists():
+            self.logger.debug('xmltv file {} is current'.format(_key))
+            return
+
+        filepath = self.folder.joinpath(_key + '.xml')
+        tmp_filepath = self.folder.joinpath(_key + '.xml.tmp')
+        with open(tmp_filepath, 'wb') as xml_file:
+            xml_out = XMLTVWriter(xml_file, self.config['epg']['epg_prettyprint'])
+            xml_out.start_tv(**_header)
+            epg.gen_channel_xml(xml_out, channel_list)
+            xml_out.flush()
+            for name in fragments.keys():
+                with open(self.folder.joinpath(_key, name), 'rb') as fragment_file:
+                    shutil.copyfileobj(fragment_file, xml_file)
+            xml_out.end_tv()
+        os.replace(tmp_filepath, filepath)
+
+        for fragment_path in self.folder.joinpath(_key).iterdir():
+            if fragment_path.name not in fragments:
+                fragment_path.unlink()
+        self.save_manifest(_key, {
+            'namespace': _namespace,
+            'instance': _instance,
+            'sig': sig,
+            'fragments': fragments})
+        self.logger.debug('xmltv file {} updated, {} of {} days rendered'
+                          .format(_key, rendered, len(fragments)))
+
+    def build_fragment(self, _epg, _filepath, _row, _channel_list):
+        """
+        Renders the programs for one EPG day.  Returns the programs written
+        and the programs skipped as already written by an earlier day
+        """
+        day_data = self.epg_db.get_programs(_row['file'], _channel_list.keys())
+        processed = set(_epg.prog_processed)
+        dups = [prog['start'] + prog['channel'] for prog in day_data
+                if prog['start'] + prog['channel'] in processed]
+        tmp_filepath = _filepath.with_suffix('.tmp')
+        with open(tmp_filepath, 'wb') as fragment_file:
+            xml_out = XMLTVWriter(fragment_file, self.config['epg']['epg_prettyprint'], 1)
+            _epg.gen_program_xml(xml_out, day_data, _channel_list,
+                                 _row['namespace'], _row['instance'])
+            xml_out.flush()
+        os.replace(tmp_filepath, _filepath)
+        return {
+            'emitted': list(_epg.prog_processed - processed),
+            'dups': dups}
+
+    def get_config_sig(self):
+        """
+        Returns a hash of the config settings used in the xmltv file
+        """
+        settings = {'epg': self.config['epg'],
+                    'logo_cache': self.config['channels'].get('logo_cache'),
+                    'logo_base_url': get_logo_base_url(self.config)}
+        for section, values in self.config.items():
+            if isinstance(values, dict) and 'enabled' in values:
+                settings[section] = {name: values.get(name)
+                                     for name in XMLTV_INSTANCE_SETTINGS}
+        return hashlib.md5(json.dumps(
+            settings, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def get_key(self, _namespace, _instance):
+        if _namespace is None:
+            _namespace = 'all'
+        if _instance is None:
+            _instance = 'all'
+        return re.sub(r'[^A-Za-z0-9_\-]', '_', '{}_{}'.format(_namespace, _instance))
+
+    def load_manifest(self, _key):
+        try:
+            with open(self.folder.joinpath(_key + '.json'), 'r') as manifest_file:
+                return json.load(manifest_file)
+        except (OSError, ValueError):
+            return None
+
+    def save_manifest(self, _key, _manifest):
+        filepath = self.folder.joinpath(_key + '.json')
+        tmp_filepath = self.folder.joinpath(_key + '.json.tmp')
+        with open(tmp_filepath, 'w') as manifest_file:
+            json.dump(_manifest, manifest_file)
+        os.replace(tmp_filepath, filepath)
+
+
+class XMLTVWriter:
+    """
+    Writes the XMLTV elements as escaped text to _out as they are generated,
+    instead of building a tree for each day.  The text is written in
+    WRITE_SIZE chunks.  With _pretty, each element is on its own line
+    and indented with tabs.
+    """
+
+    def __init__(self, _out, _pretty=False, _depth=0):
+        self.out = _out
+        self.pretty = _pretty
+        self.buffer = []
+        self.buffer_size = 0
+        self.depth = _depth
+
+    def start_tv(self, **kwargs):
+        self.add('<?xml version="1.0" encoding="UTF-8"?>\n<!DOCTYPE tv SYSTEM "xmltv.dtd">\n')
+        self.start('tv', **kwargs)
+
+    def end_tv(self):
+        self.end('tv')
+        self.flush()
+
+    def start(self, _name, **kwargs):
+        self.add(''.join([self.indent(), '<', _name, self.attribs(kwargs), '>',
+                          self.line_end(self.depth == 0)]))
+        self.depth += 1
+
+    def end(self, _name):
+        self.depth -= 1
+        self.add(''.join([self.indent(), '</', _name, '>', self.line_end(self.depth <= 1)]))
+
+    def element(self, _name, _text=None, **kwargs):
+        """
+        Adds an element without children.  Empty text creates an empty element
+        """
         if _text:
-            el.text = _text
-        return el
+            self.add(''.join([self.indent(), '<', _name, self.attribs(kwargs), '>',
+                              escape(_text), '</', _name, '>', self.line_end(self.depth <= 1)]))
+        else:
+            self.add(''.join([self.indent(), '<', _name, self.attribs(kwargs), ' />',
+                              self.line_end(self.depth <= 1)]))
+
+    def attribs(self, _attribs):
+        return ''.join([' %s="%s"' % (name, escape(value, ATTRIB_ENTITIES))
+                        for name, value in _attribs.items()])
+
+    def indent(self):
+        if self.pretty:
+            return '\t' * self.depth
+        return ''
+
+    def line_end(self, _top_level):
+        if self.pretty or _top_level:
+            return '\n'
+        return ''
+
+    def add(self, _text):
+        self.buffer.append(_text)
+        self.buffer_size += len(_text)
+        if self.buffer_size >= WRITE_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.out.write(''.join(self.buffer).encode('utf-8'))
+            self.buffer = []
+            self.buffer_size = 0
@@ -0,0 +1,48 @@
+"""
+MIT License
+
+Copyright (C) 2023 ROCKY4546
+https://github.com/rocky4546
+
+This file is part of Cabernet
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+and associated documentation files (the "Software"), to deal in the Software without restriction,
+including without limitation the rights to use, copy, modify, merge, publish, distribute,
+sublicense, and/or sell copies of the Software, and to permit persons to whom the Software
+is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or
+substantial portions of the Software.
+"""
+
+import json
+import urllib.parse
+
+from lib.common.decorators import getrequest
+from lib.db.db_epg import DBepg
+from lib.web.pages.templates import web_templates
+
+
+@getrequest.route('/api/nownext')
+def epg_now_next(_webserver):
+    """
+    Returns the current and next program for a channel (uid) or, without
+    the channel parameter, for all channels.
+    /api/nownext?name=<namespace>&instance=<instance>&channel=<uid>
+    Times are UTC
+    """
+    namespace = _webserver.query_data['name']
+    if namespace is not None \
+            and not _webserver.plugins.plugins.get(namespace):
+        _webserver.do_mime_response(
+            501, 'text/html',
+            web_templates['htmlError'].format('501 - Invalid Namespace: {}'.format(namespace)))
+        return
+    channel = _webserver.query_data.get('channel')
+    if channel is not None:
+        channel = urllib.parse.unquote(channel)
+    epg_db = DBepg(_webserver.config)
+    now_next = epg_db.get_now_next(
+        namespace, _webserver.query_data['instance'], channel)
+    _webserver.do_mime_response(200, 'application/json', json.dumps(now_next, default=str))
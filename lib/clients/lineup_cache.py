@@ -0,0 +1,105 @@
+"""
+MIT License
+
+Copyright (C) 2023 ROCKY4546
+https://github.com/rocky4546
+
+This file is part of Cabernet
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+and associated documentation files (the "Software"), to deal in the Software without restriction,
+including without limitation the rights to use, copy, modify, merge, publish, distribute,
+sublicense, and/or sell copies of the Software, and to permit persons to whom the Software
+is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or
+substantial portions of the Software.
+"""
+
+import logging
+import threading
+
+import lib.common.utils as utils
+from lib.db.db_channels import DBChannels
+from lib.db.db_config_defn import DBConfigDefn
+
+
+class LineupCache:
+    """
+    Process-wide cache of the config and channel lineups used on each
+    tune request.  The data_version of the config and channels databases
+    is the version counter.  It changes on any commit, including the ones
+    made by the web admin and scheduler processes, so entries are only
+    reloaded after a write.
+    The cached dicts are shared, so callers must not modify them.
+    """
+    lock = threading.Lock()
+    config = None
+    config_version = None
+    # (namespace, instance) -> lineup dict
+    lineups = {}
+
+    def __init__(self, _config):
+        self.logger = logging.getLogger(__name__)
+        self.channels_db = DBChannels(_config)
+        self.configdefn_db = DBConfigDefn(_config)
+
+    def get_config(self):
+        version = self.configdefn_db.get_data_version()
+        with LineupCache.lock:
+            if LineupCache.config is None or LineupCache.config_version != version:
+                LineupCache.config = self.configdefn_db.get_config()
+                LineupCache.config_version = version
+            return LineupCache.config
+
+    def get_stations(self, _namespace, _instance):
+        """
+        Returns the same sid -> list of stations dict as DBChannels.get_channels()
+        """
+        lineup = self.get_lineup(_namespace, _instance)
+        if lineup is None:
+            return None
+        return lineup['stations']
+
+    def get_sid(self, _namespace, _instance, _chnum):
+        """
+        Returns the sid of the first station whose display number, with the
+        instance prefix and suffix added, matches _chnum.  None when not found
+        """
+        lineup = self.get_lineup(_namespace, _instance)
+        if lineup is None:
+            return None
+        return lineup['chnums'].get(_chnum)
+
+    def get_lineup(self, _namespace, _instance):
+        config = self.get_config()
+        version = (self.channels_db.get_data_version(), LineupCache.config_version)
+        key = (_namespace, _instance)
+        with LineupCache.lock:
+            lineup = LineupCache.lineups.get(key)
+            if lineup is not None and lineup['version'] == version:
+                return lineup
+            stations = self.channels_db.get_channels(_namespace, _instance)
+            if stations is None:
+                return None
+            lineup = {
+                'version': version,
+                'stations': stations,
+                'chnums': self.build_chnum_index(stations, config)}
+            LineupCache.lineups[key] = lineup
+            self.logger.debug('Lineup cache reloaded for {}:{}'.format(_namespace, _instance))
+            return lineup
+
+    def build_chnum_index(self, _stations, _config):
+        chnums = {}
+        for sid, station in _stations.items():
+            try:
+                chnum = utils.wrap_chnum(
+                    str(station[0]['display_number']), station[0]['namespace'],
+                    station[0]['instance'], _config)
+            except KeyError:
+                # instance no longer in the config
+                continue
+            if chnum not in chnums:
+                chnums[chnum] = sid
+        return chnums
@@ -0,0 +1,299 @@
+"""
+MIT License
+
+Copyright (C) 2023 ROCKY4546
+https://github.com/rocky4546
+
+This file is part of Cabernet
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+and associated documentation files (the "Software"), to deal in the Software without restriction,
+including without limitation the rights to use, copy, modify, merge, publish, distribute,
+sublicense, and/or sell copies of the Software, and to permit persons to whom the Software
+is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or
+substantial portions of the Software.
+"""
+
+import hashlib
+import http.client
+import io
+import json
+import logging
+import mimetypes
+import os
+import pathlib
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+import lib.common.utils as utils
+import lib.image_size.get_image_size as get_image_size
+from lib.common.decorators import getrequest
+from lib.common.decorators import gettunerrequest
+from lib.db.db_channels import DBChannels
+
+# folder under paths-thumbnails_dir holding the cached logos
+LOGO_FOLDER = 'logos'
+# widths offered for downscaled logos, matches the channels-thumbnail_size values
+LOGO_WIDTHS = (16, 48, 128, 180, 270)
+# seconds to wait on the provider for a logo
+DOWNLOAD_TIMEOUT = 8
+# logos larger than this are not cached
+MAX_LOGO_SIZE = 5242880
+# seconds before retrying a logo that failed to revalidate
+RETRY_DELAY = 3600
+
+
+@getrequest.route('/logos')
+@gettunerrequest.route('/logos')
+def logos(_webserver):
+    """
+    Sends the cached logo for a channel.  Redirects to the provider
+    url when the logo cannot be downloaded
+    """
+    uid = _webserver.query_data.get('uid')
+    if uid is None:
+        _webserver.do_mime_response(404, 'text/html', 'Logo not found')
+        return
+    ch = DBChannels(_webserver.config).get_channel(
+        urllib.parse.unquote(uid),
+        urllib.parse.unquote(_webserver.query_data['name'] or ''),
+        urllib.parse.unquote(_webserver.query_data['instance'] or ''))
+    if ch is None or not ch['thumbnail']:
+        _webserver.do_mime_response(404, 'text/html', 'Logo not found')
+        return
+    logo_cache = LogoCache(_webserver.config)
+    try:
+        meta = logo_cache.get_logo(ch['thumbnail'])
+        filepath = logo_cache.get_variant(meta, _webserver.query_data.get('w'))
+    except (OSError, http.client.HTTPException, ValueError) as ex:
+        logo_cache.logger.debug('Unable to cache logo, redirecting {} {}'
+                                .format(ch['thumbnail'], ex))
+        _webserver.send_response(302)
+        _webserver.send_header('Location', ch['thumbnail'])
+        _webserver.end_headers()
+        return
+    mime = meta['mime'] if filepath.name == meta['file'] else 'image/png'
+    _webserver.do_sendfile_response(mime, filepath)
+
+
+class LogoCache:
+    """
+    Keeps a copy of each channel logo on disk, keyed by a hash of the url.
+    A json file next to each logo holds the ETag, Last-Modified, expiry
+    and image size, so the size is found with the same download and
+    expired logos are revalidated with a conditional GET.
+    """
+    lock = threading.Lock()
+    key_locks = {}
+    metas = {}
+
+    def __init__(self, _config):
+        self.logger = logging.getLogger(__name__)
+        self.config = _config
+        self.folder = pathlib.Path(_config['paths']['thumbnails_dir']) \
+            .joinpath(LOGO_FOLDER)
+
+    def is_enabled(self):
+        return self.config['channels'].get('logo_cache', False)
+
+    def is_cacheable(self, _url):
+        return self.is_enabled() and _url is not None \
+            and _url.lower().startswith(('http://', 'https://'))
+
+    def get_key(self, _url):
+        return hashlib.sha1(_url.encode('utf-8')).hexdigest()
+
+    def get_channel_url(self, _base_url, _sid_data):
+        """
+        Returns the url clients use for the channel logo.  Returns the
+        provider url when the cache is disabled or the url is not http
+        """
+        if not self.is_cacheable(_sid_data['thumbnail']):
+            return _sid_data['thumbnail']
+        return 'http://{}/logos?name={}&instance={}&uid={}'.format(
+            _base_url,
+            urllib.parse.quote(_sid_data['namespace'], safe=''),
+            urllib.parse.quote(_sid_data['instance'], safe=''),
+            urllib.parse.quote(_sid_data['uid'], safe=''))
+
+    def get_size(self, _url, _session=None):
+        """
+        Returns the (width, height) of the logo, downloading it when needed
+        """
+        return tuple(self.get_logo(_url, _session)['size'])
+
+    def get_logo(self, _url, _session=None):
+        """
+        Returns the meta data for the cached logo, downloading or
+        revalidating it when missing or expired.  A stale copy is used when
+        the provider cannot be reached.  Raises OSError, ValueError or the
+        session exceptions when there is no copy
+        """
+        key = self.get_key(_url)
+        meta = LogoCache.metas.get(key)
+        if meta is not None and meta['expires'] > time.time() \
+                and self.folder.joinpath(meta['file']).exists():
+            return meta
+        with self.get_key_lock(key):
+            meta = self.load_meta(key)
+            if meta is not None and meta['expires'] > time.time():
+                LogoCache.metas[key] = meta
+                return meta
+            try:
+                meta = self.download(_url, key, meta, _session)
+            except Exception as ex:
+                if meta is None:
+                    raise
+                self.logger.info('Unable to revalidate logo, using cached copy {} {}'
+                                 .format(_url, ex))
+                meta['expires'] = time.time() + RETRY_DELAY
+            self.save_meta(key, meta)
+            LogoCache.metas[key] = meta
+            return meta
+
+    def get_key_lock(self, _key):
+        with LogoCache.lock:
+            key_lock = LogoCache.key_locks.get(_key)
+            if key_lock is None:
+                key_lock = threading.Lock()
+                LogoCache.key_locks[_key] = key_lock
+            return key_lock
+
+    def load_meta(self, _key):
+        meta_path = self.folder.joinpath(_key + '.json')
+        try:
+            with open(meta_path, 'r') as meta_file:
+                meta = json.load(meta_file)
+        except (OSError, ValueError):
+            return None
+        if not self.folder.joinpath(meta['file']).exists():
+            return None
+        return meta
+
+    def save_meta(self, _key, _meta):
+        meta_path = self.folder.joinpath(_key + '.json')
+        tmp_path = meta_path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as meta_file:
+            json.dump(_meta, meta_file)
+        os.replace(tmp_path, meta_path)
+
+    def get_expires(self):
+        return time.time() + self.config['channels'].get('logo_cache_days', 7) * 86400
+
+    def download(self, _url, _key, _meta, _session):
+        headers = {'User-Agent': utils.DEFAULT_USER_AGENT,
+                   'Accept': 'image/*,*/*',
+                   'Accept-Encoding': 'identity'}
+        if _meta is not None:
+            if _meta.get('etag'):
+                headers['If-None-Match'] = _meta['etag']
+            if _meta.get('last_modified'):
+                headers['If-Modified-Since'] = _meta['last_modified']
+        self.logger.trace('HEADER: {}  URI: {}'.format(headers, _url))
+        status, resp_headers, img_blob = self.http_get(_url, headers, _session)
+        if status == 304 and _meta is not None:
+            _meta['expires'] = self.get_expires()
+            return _meta
+        if len(img_blob) > MAX_LOGO_SIZE:
+            raise ValueError('Logo too large {} bytes'.format(len(img_blob)))
+
+        try:
+            img_meta = get_image_size.get_image_metadata_from_bytesio(
+                io.BytesIO(img_blob), len(img_blob))
+            size = [img_meta.width, img_meta.height]
+            ext = '.' + img_meta.type.lower()
+        except get_image_size.UnknownImageFormat as ex:
+            self.logger.warning('Logo unknown format {} {}'.format(_url, str(ex)))
+            size = [0, 0]
+            ext = ''
+        mime = resp_headers.get('Content-Type')
+        if mime is None or not mime.startswith('image/'):
+            mime = mimetypes.guess_type('logo' + ext)[0] or 'application/octet-stream'
+
+        if not self.folder.exists():
+            os.makedirs(self.folder, exist_ok=True)
+        filename = _key + ext
+        tmp_path = self.folder.joinpath(_key + '.part')
+        with open(tmp_path, 'wb') as logo_file:
+            logo_file.write(img_blob)
+        os.replace(tmp_path, self.folder.joinpath(filename))
+        if _meta is not None and _meta['file'] != filename:
+            self.remove_files(_meta['file'])
+        return {
+            'url': _url,
+            'etag': resp_headers.get('ETag'),
+            'last_modified': resp_headers.get('Last-Modified'),
+            'mime': mime,
+            'file': filename,
+            'size': size,
+            'expires': self.get_expires()}
+
+    def http_get(self, _url, _headers, _session):
+        """
+        Returns (status, headers, body) using the plugin session when
+        provided, otherwise urllib
+        """
+        if _session is not None:
+            resp = _session.get(_url, headers=_headers, timeout=DOWNLOAD_TIMEOUT)
+            if resp.status_code == 304:
+                return 304, resp.headers, b''
+            resp.raise_for_status()
+            return resp.status_code, resp.headers, resp.content
+        req = urllib.request.Request(_url, headers=_headers)
+        try:
+            with urllib.request.urlopen(req, timeout=DOWNLOAD_TIMEOUT) as resp:
+                return resp.status, resp.headers, resp.read(MAX_LOGO_SIZE + 1)
+        except urllib.error.HTTPError as ex:
+            if ex.code == 304:
+                return 304, ex.headers, b''
+            raise
+
+    def get_variant(self, _meta, _width=None):
+        """
+        Returns the path to the logo downscaled to the nearest LOGO_WIDTHS
+        value at or above _width.  Returns the original when Pillow is not
+        installed or the logo is already smaller
+        """
+        filepath = self.folder.joinpath(_meta['file'])
+        if Image is None or not _width or not _meta['size'][0]:
+            return filepath
+        try:
+            width = int(_width)
+        except ValueError:
+            return filepath
+        width = next((w for w in LOGO_WIDTHS if w >= width), None)
+        if width is None or width >= _meta['size'][0]:
+            return filepath
+        variant_path = self.folder.joinpath('{}_{}.png'.format(
+            pathlib.Path(_meta['file']).stem, width))
+        try:
+            if variant_path.stat().st_mtime >= filepath.stat().st_mtime:
+                return variant_path
+        except FileNotFoundError:
+            pass
+        height = max(1, round(_meta['size'][1] * width / _meta['size'][0]))
+        with Image.open(filepath) as img:
+            img = img.convert('RGBA').resize((width, height), Image.LANCZOS)
+            tmp_path = variant_path.with_suffix('.part')
+            img.save(tmp_path, 'PNG', optimize=True)
+        os.replace(tmp_path, variant_path)
+        return variant_path
+
+    def remove_files(self, _filename):
+        stem = pathlib.Path(_filename).stem
+        for path in [self.folder.joinpath(_filename)] + \
+                list(self.folder.glob(stem + '_*.png')):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,366 @@
+"""
+MIT License
+
+Copyright (C) 2023 ROCKY4546
+https://github.com/rocky4546
+
+This file is part of Cabernet
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+and associated documentation files (the "Software"), to deal in the Software without restriction,
+including without limitation the rights to use, copy, modify, merge, publish, distribute,
+sublicense, and/or sell copies of the Software, and to permit persons to whom the Software
+is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or
+substantial portions of the Software.
+"""
+
+import collections
+import errno
+import io
+import logging
+import selectors
+import socket
+import threading
+import time
+from threading import Thread
+
+# largest request header block accepted from a client
+MAX_HEADER_SIZE = 65536
+# largest request body accepted from a client
+MAX_BODY_SIZE = 1048576
+# bytes pending to a client before the handler blocks on a write
+WRITE_HIGH_WATER = 1048576
+# bytes sent to the socket in one send() call
+SEND_SIZE = 262144
+# seconds a client has to send a complete request
+REQUEST_TIMEOUT = 30
+# how often the event loop checks for request timeouts
+LOOP_INTERVAL = 1.0
+
+
+class TunerConnection:
+    """
+    One client socket owned by the TunerServer event loop.
+    The loop reads the request and does all socket writes.  The handler
+    thread sees this object as its socket.  sendall() queues the data and
+    blocks while WRITE_HIGH_WATER bytes are still waiting for the client,
+    which keeps a slow client from growing the buffer.
+    """
+
+    def __init__(self, _server, _sock, _address):
+        self.server = _server
+        self.sock = _sock
+        self.address = _address
+        self.rbuf = bytearray()
+        self.request_len = None
+        self.wbuf = collections.deque()
+        self.wbuf_size = 0
+        self.wbuf_offset = 0
+        self.cond = threading.Condition()
+        # set when the socket is closed or the client went away
+        self.closed = False
+        # set when the handler has finished writing its response
+        self.finished = False
+        self.handler = None
+        self.start_time = time.monotonic()
+
+    def makefile(self, _mode='r', _buffering=None, **kwargs):
+        if 'w' in _mode:
+            raise ValueError('TunerConnection only supports read makefile()')
+        return io.BytesIO(self.rbuf[:self.request_len])
+
+    def settimeout(self, _timeout):
+        pass
+
+    def setsockopt(self, *args):
+        pass
+
+    def getpeername(self):
+        return self.address
+
+    def sendall(self, _data):
+        """
+        When nothing is queued, the data is sent straight to the socket
+        without a copy.  Only the part the socket did not take is copied
+        and queued, since callers may reuse the buffer once this returns
+        """
+        view = memoryview(_data).cast('B')
+        if not view:
+            return
+        with self.cond:
+            while not self.closed and self.wbuf_size >= WRITE_HIGH_WATER:
+                self.cond.wait()
+            if self.closed:
+                raise BrokenPipeError(errno.EPIPE, 'Client connection closed')
+            if not self.wbuf:
+                try:
+                    sent = self.sock.send(view)
+                except (BlockingIOError, InterruptedError):
+                    sent = 0
+                except OSError:
+                    self.set_closed()
+                    raise BrokenPipeError(errno.EPIPE, 'Client connection closed')
+                if sent == len(view):
+                    return
+                view = view[sent:]
+            data = bytes(view)
+            self.wbuf.append(data)
+            self.wbuf_size += len(data)
+        self.server.wakeup(self)
+
+    def sendfile(self, _file, _offset=0, _count=None):
+        total = 0
+        while _count is None or total < _count:
+            size = SEND_SIZE if _count is None else min(SEND_SIZE, _count - total)
+            data = _file.read(size)
+            if not data:
+                break
+            self.sendall(data)
+            total += len(data)
+        return total
+
+    def shutdown(self, _how=None):
+        self.close()
+
+    def close(self):
+        """
+        Called from the handler thread.  The loop closes the socket once
+        the pending data has been sent
+        """
+        with self.cond:
+            self.finished = True
+        self.server.wakeup(self)
+
+    def send_pending(self):
+        """
+        Called from the event loop when the socket is writable.
+        Returns True while data is still pending
+        """
+        with self.cond:
+            while self.wbuf:
+                data = self.wbuf[0]
+                chunk = memoryview(data)[self.wbuf_offset:self.wbuf_offset + SEND_SIZE]
+                try:
+                    sent = self.sock.send(chunk)
+                except (BlockingIOError, InterruptedError):
+                    break
+                except OSError:
+                    self.set_closed()
+                    return False
+                self.wbuf_offset += sent
+                self.wbuf_size -= sent
+                if self.wbuf_offset == len(data):
+                    self.wbuf.popleft()
+                    self.wbuf_offset = 0
+                if sent < len(chunk):
+                    break
+            if self.wbuf_size < WRITE_HIGH_WATER:
+                self.cond.notify_all()
+            return bool(self.wbuf)
+
+    def set_closed(self):
+        with self.cond:
+            self.closed = True
+            self.wbuf.clear()
+            self.wbuf_size = 0
+            self.cond.notify_all()
+
+
+class TunerServer:
+    """
+    Single thread selector loop for the tuner port.  Accepting sockets,
+    reading requests and all client writes are handled by the loop.
+    Once a request is complete, the handler class runs in its own thread,
+    since the stream proxies are blocking code.  Status and lineup
+    requests are no longer queued behind listeners busy streaming.
+    """
+
+    def __init__(self, _server_socket, _handler_class):
+        self.logger = logging.getLogger(__name__)
+        self.server_socket = _server_socket
+        self.server_socket.setblocking(False)
+        self.handler_class = _handler_class
+        self.selector = selectors.DefaultSelector()
+        self.connections = {}
+        self.wakeup_lock = threading.Lock()
+        self.wakeup_pending = set()
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+        self.is_running = False
+
+    def serve_forever(self):
+        self.selector.register(self.server_socket, selectors.EVENT_READ, self.accept)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ, self.process_wakeups)
+        self.is_running = True
+        try:
+            while self.is_running:
+                for key, mask in self.selector.select(LOOP_INTERVAL):
+                    if key.data in (self.accept, self.process_wakeups):
+                        key.data()
+                    else:
+                        self.process_event(key.data, mask)
+                self.check_timeouts()
+        finally:
+            for conn in list(self.connections.values()):
+                self.close_connection(conn)
+            self.selector.close()
+
+    def shutdown(self):
+        self.is_running = False
+        self.wakeup(None)
+
+    def wakeup(self, _conn):
+        """
+        Thread safe way to have the loop look at a connection
+        """
+        with self.wakeup_lock:
+            is_signaled = bool(self.wakeup_pending)
+            self.wakeup_pending.add(_conn)
+        if not is_signaled:
+            try:
+                self.wakeup_send.send(b'\0')
+            except (BlockingIOError, OSError):
+                pass
+
+    def process_wakeups(self):
+        try:
+            while self.wakeup_recv.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        with self.wakeup_lock:
+            pending = self.wakeup_pending
+            self.wakeup_pending = set()
+        for conn in pending:
+            if conn is not None and conn.sock.fileno() in self.connections:
+                self.update_events(conn)
+
+    def accept(self):
+        while True:
+            try:
+                sock, address = self.server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as ex:
+                self.logger.warning('Tuner accept failed {}'.format(ex))
+                return
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = TunerConnection(self, sock, address)
+            self.connections[sock.fileno()] = conn
+            self.selector.register(sock, selectors.EVENT_READ, conn)
+
+    def process_event(self, _conn, _mask):
+        if _mask & selectors.EVENT_READ:
+            self.read_socket(_conn)
+        if _mask & selectors.EVENT_WRITE and not _conn.closed:
+            _conn.send_pending()
+        if _conn.sock.fileno() in self.connections:
+            self.update_events(_conn)
+
+    def read_socket(self, _conn):
+        try:
+            data = _conn.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            # client went away, handler writes will now fail
+            self.close_connection(_conn)
+            return
+        if _conn.handler is not None:
+            # nothing more is read once the request is handed off
+            return
+        _conn.rbuf += data
+        if _conn.request_len is None:
+            _conn.request_len = self.get_request_len(_conn.rbuf)
+            if _conn.request_len is None:
+                if len(_conn.rbuf) > MAX_HEADER_SIZE:
+                    self.send_error(_conn, 431, 'Request Header Fields Too Large')
+                return
+            if _conn.request_len < 0:
+                self.send_error(_conn, 413, 'Payload Too Large')
+                return
+        if len(_conn.rbuf) >= _conn.request_len:
+            self.start_handler(_conn)
+
+    def get_request_len(self, _rbuf):
+        """
+        Returns the header plus body length once the header block is
+        complete, -1 when the body is too large and None while incomplete
+        """
+        header_end = _rbuf.find(b'\r\n\r\n')
+        if header_end < 0:
+            return None
+        header_end += 4
+        for line in bytes(_rbuf[:header_end]).split(b'\r\n')[1:]:
+            name, _, value = line.partition(b':')
+            if name.strip().lower() == b'content-length':
+                try:
+                    body_len = int(value.strip())
+                except ValueError:
+                    return header_end
+                if body_len > MAX_BODY_SIZE:
+                    return -1
+                return header_end + body_len
+        return header_end
+
+    def start_handler(self, _conn):
+        _conn.handler = Thread(target=self.run_handler, args=(_conn,),
+                               name='TunerHandler', daemon=True)
+        _conn.handler.start()
+
+    def run_handler(self, _conn):
+        try:
+            self.handler_class(_conn, _conn.address, self)
+        except (BrokenPipeError, ConnectionResetError) as ex:
+            self.logger.debug('Client dropped connection, ignoring. {}'.format(ex))
+        except Exception as ex:
+            self.logger.exception('{}{}'.format(
+                'UNEXPECTED EXCEPTION in tuner handler=', ex))
+        finally:
+            _conn.close()
+
+    def update_events(self, _conn):
+        with _conn.cond:
+            has_data = bool(_conn.wbuf)
+            is_done = _conn.finished or _conn.closed
+        if not has_data and is_done:
+            self.close_connection(_conn)
+            return
+        events = selectors.EVENT_READ
+        if has_data:
+            events |= selectors.EVENT_WRITE
+        key = self.selector.get_key(_conn.sock)
+        if key.events != events:
+            self.selector.modify(_conn.sock, events, _conn)
+
+    def send_error(self, _conn, _code, _msg):
+        self.logger.warning('[{}] Rejected tuner request {} {}'
+                            .format(_conn.address[0], _code, _msg))
+        _conn.handler = True
+        _conn.sendall('HTTP/1.0 {} {}\r\nConnection: close\r\nContent-Length: 0\r\n\r\n'
+                      .format(_code, _msg).encode())
+        _conn.close()
+
+    def check_timeouts(self):
+        now = time.monotonic()
+        for conn in list(self.connections.values()):
+            if conn.handler is None and now - conn.start_time > REQUEST_TIMEOUT:
+                self.logger.debug('[{}] Tuner request timed out'.format(conn.address[0]))
+                self.close_connection(conn)
+
+    def close_connection(self, _conn):
+        _conn.set_closed()
+        fileno = _conn.sock.fileno()
+        if fileno in self.connections:
+            del self.connections[fileno]
+            self.selector.unregister(_conn.sock)
+        try:
+            _conn.sock.close()
+        except OSError:
+            pass
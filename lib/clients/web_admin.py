@@ -199,6 +199,7 @@ class WebAdminHttpHandler(WebHTTPHandler):
     def init_class_var_sub(cls, _plugins, _hdhr_queue, _terminate_queue, _sched_queue):
         super(WebAdminHttpHandler, cls).init_class_var(_plugins, _hdhr_queue, _terminate_queue)
         WebHTTPHandler.sched_queue = _sched_queue
+        WebHTTPHandler.asset_cache.preload(_plugins.config_obj.data['paths']['www_pkg'])
         getrequest.log_urls()
         postrequest.log_urls()
         filerequest.log_urls()
@@ -16,10 +16,12 @@ The above copyright notice and this permission notice shall be included in all c
 substantial portions of the Software.
 """
 
+import email.utils
 import importlib
 import importlib.resources
 import logging
 import mimetypes
+import os
 import pathlib
 import platform
 import re
@@ -36,6 +38,7 @@ from lib.db.db_plugins import DBPlugins
 from lib.db.db_channels import DBChannels
 from lib.common.pickling import Pickling
 from lib.plugins.plugin_handler import PluginHandler
+from .asset_cache import AssetCache
 
 
 class WebHTTPHandler(BaseHTTPRequestHandler):
@@ -50,6 +53,7 @@ class WebHTTPHandler(BaseHTTPRequestHandler):
     rmg_station_scans = {}
     namespace_list = None
     total_instances = 0
+    asset_cache = AssetCache()
 
     def log_message(self, _format, *args):
         try:
@@ -108,6 +112,12 @@ class WebHTTPHandler(BaseHTTPRequestHandler):
         if _reply_file:
             try:
                 if _package:
+                    if _code == 200:
+                        asset = WebHTTPHandler.asset_cache.get_asset(_package, _reply_file)
+                        self.do_etag_response(
+                            asset['mime'], asset['data'], asset['etag'], asset['last_modified'],
+                            asset['gzip'], asset['cache_control'], asset['br'])
+                        return
                     x = importlib.resources.read_binary(_package, _reply_file)
                 else:
                     # add security to prevent hacker paths
@@ -171,6 +181,106 @@ class WebHTTPHandler(BaseHTTPRequestHandler):
         if rsp_dict['text']:
             self.do_write(rsp_dict['text'].encode('utf-8'))
 
+    def do_etag_response(self, _mime, _data, _etag, _last_modified, _gzip_data=None,
+                         _cache_control='no-cache', _br_data=None):
+        """
+        Sends a cacheable response.  Returns 304 when the client already has
+        the current version and sends _br_data or _gzip_data when the client
+        accepts brotli or gzip.  _last_modified is a timestamp in seconds
+        """
+        headers = {
+            'ETag': _etag,
+            'Last-Modified': email.utils.formatdate(_last_modified, usegmt=True),
+            'Cache-Control': _cache_control}
+        if _gzip_data is not None or _br_data is not None:
+            headers['Vary'] = 'Accept-Encoding'
+        if self.is_client_current(_etag, _last_modified):
+            self.send_response(304)
+            for header, value in headers.items():
+                self.send_header(header, value)
+            self.end_headers()
+            return
+
+        if _br_data is not None and self.is_encoding_accepted('br'):
+            headers['Content-Encoding'] = 'br'
+            _data = _br_data
+        elif _gzip_data is not None and self.is_gzip_accepted():
+            headers['Content-Encoding'] = 'gzip'
+            _data = _gzip_data
+        self.send_response(200)
+        self.send_header('Content-type', _mime)
+        self.send_header('Content-Length', str(len(_data)))
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.do_write(_data)
+
+    def do_sendfile_response(self, _mime, _filepath):
+        """
+        Sends a file using sendfile() when the platform supports it.
+        Returns 304 when the client already has the current version.
+        The ETag is generated from the file modified time and size
+        """
+        with open(_filepath, 'rb') as reader:
+            stat = os.fstat(reader.fileno())
+            etag = '"{:x}-{:x}"'.format(stat.st_mtime_ns, stat.st_size)
+            headers = {
+                'ETag': etag,
+                'Last-Modified': email.utils.formatdate(stat.st_mtime, usegmt=True),
+                'Cache-Control': 'no-cache'}
+            if self.is_client_current(etag, stat.st_mtime):
+                self.send_response(304)
+                for header, value in headers.items():
+                    self.send_header(header, value)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-type', _mime)
+            self.send_header('Content-Length', str(stat.st_size))
+            for header, value in headers.items():
+                self.send_header(header, value)
+            self.end_headers()
+            try:
+                self.wfile.flush()
+                self.connection.sendfile(reader)
+            except (BrokenPipeError, ConnectionResetError, ConnectionAbortedError) as ex:
+                self.logger.debug('Client dropped connection while sending file, ignoring. {}'.format(ex))
+
+    def is_client_current(self, _etag, _last_modified):
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            etags = [x.strip() for x in if_none_match.split(',')]
+            return '*' in etags or _etag in etags or 'W/' + _etag in etags
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since is not None:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError, IndexError):
+                return False
+            return int(_last_modified) <= since
+        return False
+
+    def is_gzip_accepted(self):
+        return self.is_encoding_accepted('gzip')
+
+    def is_encoding_accepted(self, _encoding):
+        accept_encoding = self.headers.get('Accept-Encoding')
+        if not accept_encoding:
+            return False
+        for encoding in accept_encoding.split(','):
+            params = encoding.split(';')
+            if params[0].strip().lower() != _encoding:
+                continue
+            for param in params[1:]:
+                name, _, value = param.partition('=')
+                if name.strip() == 'q':
+                    try:
+                        return float(value) > 0
+                    except ValueError:
+                        return False
+            return True
+        return False
+
     def do_write(self, _data):
         try:
             self.wfile.write(_data)
@@ -217,7 +327,7 @@ class WebHTTPHandler(BaseHTTPRequestHandler):
 
         
     @classmethod
-    def start_httpserver(cls, _plugins, _hdhr_queue, _terminate_queue, _port, _http_server_class, _sched_queue=None):
+    def bind_server_socket(cls, _plugins, _port, _backlog):
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         
@@ -232,7 +342,13 @@ class WebHTTPHandler(BaseHTTPRequestHandler):
                 if i < 1:
                     raise
             
-        server_socket.listen(int(_plugins.config_obj.data['web']['concurrent_listeners']))
+        server_socket.listen(int(_backlog))
+        return server_socket
+
+    @classmethod
+    def start_httpserver(cls, _plugins, _hdhr_queue, _terminate_queue, _port, _http_server_class, _sched_queue=None):
+        server_socket = cls.bind_server_socket(
+            _plugins, _port, _plugins.config_obj.data['web']['concurrent_listeners'])
         utils.logging_setup(_plugins.config_obj.data)
         logger = logging.getLogger(__name__)
         cls.init_class_var_sub(_plugins, _hdhr_queue, _terminate_queue, _sched_queue)
@@ -16,12 +16,14 @@ The above copyright notice and this permission notice shall be included in all c
 substantial portions of the Software.
 """
 
+import copy
 import os
 import json
 import logging
 import os
 import pathlib
 import signal
+import socket
 import threading
 import time
 import urllib
@@ -33,12 +35,15 @@ from urllib.parse import urlparse
 from lib.common import utils
 from lib.common.decorators import gettunerrequest
 from lib.web.pages.templates import web_templates
-from lib.db.db_config_defn import DBConfigDefn
 from lib.streams.m3u8_redirect import M3U8Redirect
 from lib.streams.internal_proxy import InternalProxy
 from lib.streams.ffmpeg_proxy import FFMpegProxy
 from lib.streams.streamlink_proxy import StreamlinkProxy
 from lib.streams.thread_queue import ThreadQueue
+from lib.streams.m3u8_pool import M3U8Pool
+from lib.streams.stream import Stream
+from .lineup_cache import LineupCache
+from .tuner_server import TunerServer
 from .web_handler import WebHTTPHandler
 
 
@@ -47,6 +52,11 @@ def tunerstatus(_webserver):
     _webserver.do_mime_response(200, 'application/json', json.dumps(WebHTTPHandler.rmg_station_scans, cls=ObjectJsonEncoder))
 
 
+@gettunerrequest.route('/tunein_stats')
+def tunein_stats(_webserver):
+    _webserver.do_mime_response(200, 'application/json', json.dumps(Stream.get_tunein_stats()))
+
+
 @gettunerrequest.route('RE:/watch/.+')
 def watch(_webserver):
     sid = _webserver.content_path.replace('/watch/', '')
@@ -63,18 +73,13 @@ def logreset(_webserver):
 @gettunerrequest.route('RE:/auto/v.+')
 def autov(_webserver):
     channel = _webserver.content_path.replace('/auto/v', '')
-    station_list = TunerHttpHandler.channels_db.get_channels(
-        _webserver.query_data['name'], _webserver.query_data['instance'])
-
     # check channel number with adjustments
-    for station in station_list.keys():
-        updated_chnum = utils.wrap_chnum(
-            str(station_list[station][0]['display_number']), station_list[station][0]['namespace'],
-            station_list[station][0]['instance'], _webserver.config)
-        if updated_chnum == channel:
-            _webserver.do_tuning(station, _webserver.query_data['name'],
-                                 _webserver.query_data['instance'])
-            return
+    station = TunerHttpHandler.lineup_cache.get_sid(
+        _webserver.query_data['name'], _webserver.query_data['instance'], channel)
+    if station is not None:
+        _webserver.do_tuning(station, _webserver.query_data['name'],
+                             _webserver.query_data['instance'])
+        return
 
     _webserver.do_mime_response(503, 'text/html', web_templates['htmlError'].format('503 - Unknown channel'))
 
@@ -88,6 +93,7 @@ class ObjectJsonEncoder(json.JSONEncoder):
 
 
 class TunerHttpHandler(WebHTTPHandler):
+    lineup_cache = None
 
     def __init__(self, *args):
         os.chdir(os.path.dirname(os.path.abspath(__file__)))
@@ -108,7 +114,6 @@ class TunerHttpHandler(WebHTTPHandler):
         self.internal_proxy = InternalProxy(TunerHttpHandler.plugins, TunerHttpHandler.hdhr_queue)
         self.ffmpeg_proxy = FFMpegProxy(TunerHttpHandler.plugins, TunerHttpHandler.hdhr_queue)
         self.streamlink_proxy = StreamlinkProxy(TunerHttpHandler.plugins, TunerHttpHandler.hdhr_queue)
-        self.db_configdefn = DBConfigDefn(self.config)
         try:
             super().__init__(*args)
         except ConnectionResetError as ex:
@@ -160,14 +165,16 @@ class TunerHttpHandler(WebHTTPHandler):
                 'UNEXPECTED EXCEPTION on POST=', ex))
 
     def do_tuning(self, sid, _namespace, _instance):
-        # refresh the config data in case it changed in the web_admin process
-        self.plugins.config_obj.refresh_config_data()
-        self.config = self.db_configdefn.get_config()
+        # refresh the config data in case it changed in the web_admin process.
+        # The cached config and stations are shared, so the plugins and the
+        # stream proxies are given their own copies
+        self.config = copy.deepcopy(TunerHttpHandler.lineup_cache.get_config())
         self.plugins.config_obj.data = self.config
         # try:
-        station_list = TunerHttpHandler.channels_db.get_channels(_namespace, _instance)
+        station_list = TunerHttpHandler.lineup_cache.get_stations(_namespace, _instance)
         try:
             self.real_namespace, self.real_instance, station_data = self.get_ns_inst_station(station_list[sid])
+            station_data = copy.deepcopy(station_data)
             if not self.config[self.real_namespace.lower()]['enabled']:
                 self.logger.warning(
                     'Plugin is not enabled, ignoring request: {} sid:{}'
@@ -317,6 +324,9 @@ class TunerHttpHandler(WebHTTPHandler):
                         tuner_count += _plugins.config_obj.data[plugin_name.lower()]['player-tuner_count']
         WebHTTPHandler.total_instances = tuner_count
         super(TunerHttpHandler, cls).init_class_var(_plugins, _hdhr_queue, _terminate_queue)
+        TunerHttpHandler.lineup_cache = LineupCache(_plugins.config_obj.data)
+        if _plugins.config_obj.data['stream'].get('m3u8_pool_size'):
+            M3U8Pool(_plugins).start()
 
 
 class TunerHttpServer(Thread):
@@ -355,7 +365,21 @@ def child_exited(sig, frame):
 def start(_plugins, _hdhr_queue, _terminate_queue):
     # uncomment this to find out about m3u8 subprocess exits
     #signal.signal(signal.SIGCHLD, child_exited)
-    TunerHttpHandler.start_httpserver(
-        _plugins, _hdhr_queue, _terminate_queue,
-        _plugins.config_obj.data['web']['plex_accessible_port'],
-        TunerHttpServer)
+    if not _plugins.config_obj.data['web'].get('tuner_event_loop', True):
+        TunerHttpHandler.start_httpserver(
+            _plugins, _hdhr_queue, _terminate_queue,
+            _plugins.config_obj.data['web']['plex_accessible_port'],
+            TunerHttpServer)
+        return
+    server_socket = TunerHttpHandler.bind_server_socket(
+        _plugins, _plugins.config_obj.data['web']['plex_accessible_port'],
+        socket.SOMAXCONN)
+    utils.logging_setup(_plugins.config_obj.data)
+    logger = logging.getLogger(__name__)
+    TunerHttpHandler.init_class_var_sub(_plugins, _hdhr_queue, _terminate_queue, None)
+    logger.info('TunerServer Now listening for requests. Tuners={}'
+                .format(TunerHttpHandler.total_instances))
+    try:
+        TunerServer(server_socket, FactoryTunerHttpHandler()).serve_forever()
+    except KeyboardInterrupt:
+        pass
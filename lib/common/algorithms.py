@@ -73,6 +73,7 @@ class Crc(object):
         self.xor_out = xor_out
         self.tbl_idx_width = table_idx_width
         self.slice_by = slice_by
+        self.tbl = None
 
         self.msb_mask = 0x1 << (self.width - 1)
         self.mask = ((self.msb_mask - 1) << 1) | 1
@@ -209,7 +210,9 @@ class Crc(object):
         if isinstance(in_data, str):
             in_data = bytearray(in_data, 'utf-8')
 
-        tbl = self.gen_table()
+        if self.tbl is None:
+            self.tbl = self.gen_table()
+        tbl = self.tbl
 
         if not self.reflect_in:
             reg = self.direct_init << self.crc_shift
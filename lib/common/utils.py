@@ -142,6 +142,21 @@ def convert_to_utc(tm):
     tm_blank = tm.replace(tzinfo=datetime.timezone.utc)
     tm_utc = tm + (tm_blank - tm)
     return tm_utc.replace(tzinfo=datetime.timezone.utc)
+
+
+def xmltv_to_utc_str(tm):
+    """
+    Given a XMLTV time string, like 20230101120000 +0000, returns the
+    UTC time as a 'YYYY-MM-DD HH:MM:SS' string used in SQLite
+    """
+    if len(tm) == 20 and tm.endswith(' +0000'):
+        return '{}-{}-{} {}:{}:{}'.format(tm[0:4], tm[4:6], tm[6:8], tm[8:10], tm[10:12], tm[12:14])
+    if len(tm) == 14:
+        tm_date = datetime.datetime.strptime(tm, '%Y%m%d%H%M%S')
+    else:
+        tm_date = datetime.datetime.strptime(tm, '%Y%m%d%H%M%S %z') \
+            .astimezone(datetime.timezone.utc)
+    return tm_date.strftime('%Y-%m-%d %H:%M:%S')
     
     
 
@@ -26,8 +26,11 @@ import threading
 import time
 
 LOCK = threading.Lock()
+VERSION_LOCK = threading.Lock()
+BUSY_TIMEOUT = 30.0
 DB_EXT = '.db'
 BACKUP_EXT = '.sql'
+DEFAULT_BATCH_SIZE = 50
 
 # trailers used in sqlcmds.py
 SQL_CREATE_TABLES = 'ct'
@@ -40,16 +43,15 @@ FILE_LINK_ZIP = '_filelinks'
 
 class DB:
     conn = {}
+    read_conn = {}
+    version_conn = {}
 
     def __init__(self, _config, _db_name, _sqlcmds):
         self.logger = logging.getLogger(__name__ + str(threading.get_ident()))
         self.config = _config
         self.db_name = _db_name
         self.sqlcmds = _sqlcmds
-        self.cur = None
-        self.offset = -1
-        self.where = None
-        self.sqlcmd = None
+        self.rows = None
         self.db_fullpath = pathlib.Path(self.config['paths']['db_dir']) \
             .joinpath(_db_name + DB_EXT)
         if not os.path.exists(self.db_fullpath):
@@ -72,6 +74,9 @@ class DB:
                 else:
                     return DB.conn[self.db_name][threading.get_ident()].execute(_sqlcmd)
         except sqlite3.IntegrityError as e:
+            # the close is deferred while the cursor is alive, so release
+            # the write lock held by the failed statement first
+            DB.conn[self.db_name][threading.get_ident()].rollback()
             DB.conn[self.db_name][threading.get_ident()].close()
             del DB.conn[self.db_name][threading.get_ident()]
             raise e
@@ -162,6 +167,43 @@ class DB:
         #self.logger.trace('DB update() exit {}'.format(threading.get_ident()))
         return None
 
+    def update_many(self, _sqlcmds):
+        """
+        Runs a list of (sqlcmd key, list of bindings) with executemany
+        inside a single transaction, so the whole list is one commit.
+        Keys are the full names in sqlcmds, including the trailer.
+        Returns True when the transaction was committed.
+        """
+        cur = None
+        i = 10
+        while i > 0:
+            i -= 1
+            try:
+                LOCK.acquire(True)
+                conn = self.check_connection()
+                cur = conn.cursor()
+                for sqlcmd_key, bindings_list in _sqlcmds:
+                    cur.executemany(self.sqlcmds[sqlcmd_key], bindings_list)
+                conn.commit()
+                cur.close()
+                LOCK.release()
+                return True
+            except sqlite3.OperationalError as e:
+                self.logger.warning('{} Bulk update request ignored, retrying {}, {}'
+                                    .format(self.db_name, i, e))
+                DB.conn[self.db_name][threading.get_ident()].rollback()
+                if cur is not None:
+                    cur.close()
+                LOCK.release()
+                self.rnd_sleep(0.3)
+            except (sqlite3.IntegrityError, sqlite3.InterfaceError) as e:
+                DB.conn[self.db_name][threading.get_ident()].rollback()
+                if cur is not None:
+                    cur.close()
+                LOCK.release()
+                raise e
+        return False
+
     def commit(self):
         DB.conn[self.db_name][threading.get_ident()].commit()
 
@@ -172,8 +214,7 @@ class DB:
         while i > 0:
             i -= 1
             try:
-                self.check_connection()
-                cur = DB.conn[self.db_name][threading.get_ident()].cursor()
+                cur = self.check_read_connection().cursor()
                 self.sql_exec(sqlcmd, _where, cur)
                 result = cur.fetchall()
                 cur.close()
@@ -181,7 +222,7 @@ class DB:
             except sqlite3.OperationalError as e:
                 self.logger.warning('{} GET request ignored retrying {}, {}'
                                     .format(self.db_name, i, e))
-                DB.conn[self.db_name][threading.get_ident()].rollback()
+                DB.read_conn[self.db_name][threading.get_ident()].rollback()
                 if cur is not None:
                     cur.close()
                 self.rnd_sleep(0.3)
@@ -197,47 +238,63 @@ class DB:
         while i > 0:
             i -= 1
             try:
-                LOCK.acquire(True)
-                self.check_connection()
-                cur = DB.conn[self.db_name][threading.get_ident()].cursor()
+                cur = self.check_read_connection().cursor()
                 self.sql_exec(sqlcmd, _where, cur)
                 records = cur.fetchall()
                 rows = []
                 for row in records:
                     rows.append(dict(zip([c[0] for c in cur.description], row)))
                 cur.close()
-                LOCK.release()
                 return rows
             except sqlite3.OperationalError as e:
                 self.logger.warning('{} GET request ignored retrying {}, {}'
                                     .format(self.db_name, i, e))
-                DB.conn[self.db_name][threading.get_ident()].rollback()
+                DB.read_conn[self.db_name][threading.get_ident()].rollback()
                 if cur is not None:
                     cur.close()
-                LOCK.release()
                 self.rnd_sleep(0.3)
         return None
 
+    def get_dict_iter(self, _table, _where=None, sql=None, _batch_size=DEFAULT_BATCH_SIZE):
+        """
+        Generator that executes the query once and yields each row as a dict,
+        fetching _batch_size rows at a time from the cursor.
+        The cursor is closed when the rows run out or the generator is closed.
+        """
+        if sql is None:
+            sqlcmd = self.sqlcmds[''.join([_table, SQL_GET])]
+        else:
+            sqlcmd = sql
+        cur = self.check_read_connection().cursor()
+        try:
+            self.sql_exec(sqlcmd, _where, cur)
+            col_names = [c[0] for c in cur.description]
+            records = cur.fetchmany(_batch_size)
+            while records:
+                for row in records:
+                    yield dict(zip(col_names, row))
+                records = cur.fetchmany(_batch_size)
+        finally:
+            cur.close()
+
     def get_init(self, _table, _where=None):
         """
-            Requires "LIMIT ? OFFSET ?" at the end of the sql statement
+        Starts a query whose rows are returned one at a time by get_dict_next()
         """
-        self.sqlcmd = self.sqlcmds[''.join([_table, SQL_GET])]
-        self.where = list(_where)
-        self.offset = 0
+        self.close_query()
+        self.rows = self.get_dict_iter(_table, _where)
 
     def get_dict_next(self):
-        w_list = self.where.copy()
-        w_list.extend((1, self.offset))
-        self.cur = self.sql_exec(self.sqlcmd, tuple(w_list))
-        records = self.cur.fetchall()
-        self.offset += 1
-        if len(records) == 0:
+        if self.rows is None:
             return None
-        row = records[0]
-        return dict(zip([c[0] for c in self.cur.description], row))
+        return next(self.rows, None)
 
-    def save_file(self, _keys, _blob):
+    def close_query(self):
+        if self.rows is not None:
+            self.rows.close()
+            self.rows = None
+
+    def save_file(self, _keys, _blob, _ext='.txt'):
         """
         Stores the blob in the folder with the db name with
         the filename of concatenated _keys
@@ -247,7 +304,7 @@ class DB:
         folder_path = pathlib.Path(self.config['paths']['db_dir']) \
             .joinpath(self.db_name)
         os.makedirs(folder_path, exist_ok=True)
-        filename = '_'.join(str(x) for x in _keys) + '.txt'
+        filename = '_'.join(str(x) for x in _keys) + _ext
         file_rel_path = pathlib.Path(self.db_name).joinpath(filename)
         filepath = folder_path.joinpath(filename)
         try:
@@ -374,26 +431,84 @@ class DB:
                 if ';' in line[-3:]:
                     DB.conn[self.db_name][threading.get_ident()].execute(cmd)
                     cmd = ''
+        DB.conn[self.db_name][threading.get_ident()].commit()
         return None
 
     def close(self):
         thread_id = threading.get_ident()
-        DB.conn[self.db_name][thread_id].close()
-        del DB.conn[self.db_name][thread_id]
+        conn = DB.conn.get(self.db_name, {}).pop(thread_id, None)
+        if conn is not None:
+            conn.close()
+        read_conn = DB.read_conn.get(self.db_name, {}).pop(thread_id, None)
+        if read_conn is not None:
+            read_conn.close()
         self.logger.debug('{} database closed for thread:{}'.format(self.db_name, thread_id))
 
+    def get_data_version(self):
+        """
+        Returns a number that changes whenever any connection, in this or
+        another process, commits to the database.  Used to tell when cached
+        query results are stale.
+        """
+        with VERSION_LOCK:
+            pid_conn = DB.version_conn.get(self.db_name)
+            if pid_conn is None or pid_conn[0] != os.getpid():
+                # connections are not shared with forked processes
+                pid_conn = (os.getpid(), sqlite3.connect(
+                    self.db_fullpath, timeout=BUSY_TIMEOUT, check_same_thread=False))
+                DB.version_conn[self.db_name] = pid_conn
+            return pid_conn[1].execute('PRAGMA data_version').fetchone()[0]
+
     def check_connection(self):
-        if self.db_name not in DB.conn:
-            DB.conn[self.db_name] = {}
-        db_conn_dbname = DB.conn[self.db_name]
+        """
+        Returns the read/write connection for this thread, opening it when needed
+        """
+        return self.check_pool_connection(DB.conn, False)
+
+    def check_read_connection(self):
+        """
+        Returns the read-only connection for this thread.  In WAL mode readers
+        see the last commit and do not wait on writers, so gets do not
+        share the write connection or take the global LOCK.
+        """
+        return self.check_pool_connection(DB.read_conn, True)
+
+    def check_pool_connection(self, _pool, _read_only):
+        if self.db_name not in _pool:
+            _pool[self.db_name] = {}
+        db_conn_dbname = _pool[self.db_name]
 
-        if threading.get_ident() not in db_conn_dbname:
-            db_conn_dbname[threading.get_ident()] = sqlite3.connect(
-                self.db_fullpath, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+        conn = db_conn_dbname.get(threading.get_ident())
+        if conn is None:
+            conn = self.connect(_read_only)
+            db_conn_dbname[threading.get_ident()] = conn
         else:
             try:
-                db_conn_dbname[threading.get_ident()].total_changes
+                conn.total_changes
             except sqlite3.ProgrammingError:
                 self.logger.debug('Reopening {} database for thread:{}'.format(self.db_name, threading.get_ident()))
-                db_conn_dbname[threading.get_ident()] = sqlite3.connect(
-                    self.db_fullpath, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+                conn = self.connect(_read_only)
+                db_conn_dbname[threading.get_ident()] = conn
+        return conn
+
+    def connect(self, _read_only):
+        """
+        Opens a connection that waits up to BUSY_TIMEOUT seconds on a locked
+        database.  The read/write connection switches the database to WAL mode.
+        """
+        if _read_only:
+            # make sure the write connection has created the file and set WAL mode
+            self.check_connection()
+            return sqlite3.connect(
+                self.db_fullpath.resolve().as_uri() + '?mode=ro', uri=True,
+                timeout=BUSY_TIMEOUT,
+                detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+        conn = sqlite3.connect(
+            self.db_fullpath, timeout=BUSY_TIMEOUT,
+            detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+        except sqlite3.OperationalError as e:
+            self.logger.warning('{} unable to enable WAL mode, {}'.format(self.db_name, e))
+        return conn
@@ -23,6 +23,9 @@ import sqlite3
 import threading
 
 from lib.db.db import DB
+from lib.db.db import SQL_ADD_ROW
+from lib.db.db import SQL_DELETE
+from lib.db.db import SQL_UPDATE
 from lib.common.decorators import Backup
 from lib.common.decorators import Restore
 
@@ -102,6 +105,19 @@ sqlcmds = {
             group_tag, thumbnail, thumbnail_size, updated, json
             ) VALUES ( ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ? )
         """,
+    'channels_upsert':
+        """
+        INSERT INTO channels (
+            namespace, instance, enabled, uid, number, display_number, display_name,
+            group_tag, thumbnail, thumbnail_size, updated, json
+            ) VALUES ( ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ? )
+            ON CONFLICT(namespace, instance, uid) DO UPDATE SET
+            enabled=excluded.enabled, number=excluded.number,
+            thumbnail=COALESCE(channels.thumbnail, excluded.thumbnail),
+            thumbnail_size=CASE WHEN channels.thumbnail IS NULL
+                THEN excluded.thumbnail_size ELSE channels.thumbnail_size END,
+            updated=excluded.updated, json=excluded.json
+        """,
     'channels_update':
         """
         UPDATE channels SET 
@@ -205,60 +221,49 @@ class DBChannels(DB):
 
     def save_channel_list(self, _namespace, _instance, _ch_dict, save_edit_groups=True):
         """
-        Assume the list is complete and will remove any old channels not updated
+        Assume the list is complete and will remove any old channels not updated.
+        The whole list is saved in one transaction.  Existing channels keep their
+        editable fields, except enabled and a missing thumbnail.
         """
         if _instance is None or _namespace is None:
             self.logger.warning(
                 'Saving Channel List: Namespace or Instance is None {}:{}'
                 .format(_namespace, _instance))
-        self.update(DB_CHANNELS_TABLE + '_updated', (_namespace, _instance,))
+        ch_rows = []
         for ch in _ch_dict:
             if save_edit_groups:
                 edit_groups = ch['groups_other']
             else:
                 edit_groups = None
-            try:
-                self.add(DB_CHANNELS_TABLE, (
-                    _namespace,
-                    _instance,
-                    ch['enabled'],
-                    ch['id'],
-                    ch['number'],
-                    ch['number'],
-                    ch['name'],
-                    edit_groups,
-                    ch['thumbnail'],
-                    str(ch['thumbnail_size']),
-                    True,
-                    json.dumps(ch)))
-            except sqlite3.IntegrityError as ex:
-                # record already present.  Check the editable fields and update as needed
-                ch_stored = self.get_channel(ch['id'], _namespace, _instance)
-
-                # manipulation of editable fields.  Need to be careful here.
-                ch_stored['enabled'] = ch['enabled']
-                if ch_stored['thumbnail'] is None:
-                    ch_stored['thumbnail'] = ch['thumbnail']
-                    ch_stored['thumbnail_size'] = ch['thumbnail_size']
-                self.update_channel(ch_stored)
-                self.update(DB_CHANNELS_TABLE, (
-                    ch['number'],
-                    True,
-                    json.dumps(ch),
-                    _namespace,
-                    _instance,
-                    ch['id']
-                ))
-            except sqlite3.InterfaceError as ex:
-                self.logger.warning('InterfaceError: Bind data: {} : {} : ({}){} : {} : {} : {}'.format( \
-                    ch['id'], ch['number'], type(ch['name']), ch['name'], edit_groups, \
-                    ch['thumbnail'], str(ch['thumbnail_size']) ))
-                raise ex
-
-            self.add(DB_STATUS_TABLE, (
-                _namespace, _instance, datetime.datetime.now()))
-
-        self.delete(DB_CHANNELS_TABLE, (False, _namespace, _instance,))
+            ch_rows.append((
+                _namespace,
+                _instance,
+                ch['enabled'],
+                ch['id'],
+                ch['number'],
+                ch['number'],
+                ch['name'],
+                edit_groups,
+                ch['thumbnail'],
+                str(ch['thumbnail_size']),
+                True,
+                json.dumps(ch)))
+        sqlcmds = [
+            (DB_CHANNELS_TABLE + '_updated' + SQL_UPDATE, [(_namespace, _instance,)]),
+            (DB_CHANNELS_TABLE + '_upsert', ch_rows)]
+        if ch_rows:
+            sqlcmds.append((DB_STATUS_TABLE + SQL_ADD_ROW, [
+                (_namespace, _instance, datetime.datetime.now())]))
+        sqlcmds.append((DB_CHANNELS_TABLE + SQL_DELETE, [(False, _namespace, _instance,)]))
+        try:
+            if not self.update_many(sqlcmds):
+                self.logger.warning(
+                    'Saving Channel List: Database busy, channels not updated {}:{}'
+                    .format(_namespace, _instance))
+        except sqlite3.InterfaceError as ex:
+            self.logger.warning('InterfaceError: Bind data: {}:{} {}'.format(
+                _namespace, _instance, ex))
+            raise ex
 
     def update_channel(self, _ch):
         """
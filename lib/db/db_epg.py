@@ -18,13 +18,26 @@ substantial portions of the Software.
 
 import json
 import datetime
+import marshal
+import zlib
 
+import lib.common.utils as utils
 from lib.db.db import DB
+from lib.db.db import SQL_ADD_ROW
+from lib.db.db import SQL_DELETE
 from lib.common.decorators import Backup
 from lib.common.decorators import Restore
 
 DB_EPG_TABLE = 'epg'
+DB_EPG_INDEX_TABLE = 'epg_index'
 DB_CONFIG_NAME = 'db_files-epg_db'
+# file extension of the program files for each [datamgmt][epg_file_format]
+EPG_FILE_EXT = {'json': '.txt', 'compact': '.epg'}
+EPG_BLOB_MAGIC = b'CBEPG1'
+# errors from a truncated or corrupt program file, or a compact file
+# written by a python version with a different marshal format
+EPG_DECODE_ERRORS = (zlib.error, ValueError, EOFError, TypeError, AttributeError, IndexError)
+NOW_NEXT_HORIZON = datetime.timedelta(days=1)
 
 sqlcmds = {
     'ct': [
@@ -37,11 +50,36 @@ sqlcmds = {
             file      VARCHAR(255) NOT NULL,
             UNIQUE(namespace, instance, day)
             )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS epg_index (
+            namespace VARCHAR(255) NOT NULL,
+            instance  VARCHAR(255) NOT NULL,
+            day       DATE NOT NULL,
+            channel   VARCHAR(255) NOT NULL,
+            start     TIMESTAMP NOT NULL,
+            stop      TIMESTAMP NOT NULL,
+            title     VARCHAR(255),
+            subtitle  VARCHAR(255),
+            progid    VARCHAR(255)
+            )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS epg_index_channel ON epg_index (channel, stop)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS epg_index_day ON epg_index (namespace, instance, day)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS epg_index_stop ON epg_index (stop)
         """
     ],
     'dt': [
         """
         DROP TABLE IF EXISTS epg
+        """,
+        """
+        DROP TABLE IF EXISTS epg_index
         """
     ],
 
@@ -76,12 +114,27 @@ sqlcmds = {
         SELECT file FROM epg WHERE namespace=? AND instance LIKE ?
         """,
 
+    'epg_file_get':
+        """
+        SELECT namespace, instance, day FROM epg WHERE file=?
+        """,
+
+    'epg_file_del':
+        """
+        DELETE FROM epg WHERE file=?
+        """,
+
     'epg_last_update_get':
         """
         SELECT datetime(last_update, 'localtime') FROM epg WHERE
             namespace=? AND instance LIKE ? and day=?
         """,
 
+    'epg_file_update':
+        """
+        UPDATE epg SET file=? WHERE namespace=? AND instance=? AND day=?
+        """,
+
     'epg_last_update_update':
         """
         UPDATE epg SET 
@@ -91,13 +144,19 @@ sqlcmds = {
     'epg_get':
         """
         SELECT * FROM epg WHERE
-            namespace LIKE ? AND instance LIKE ? ORDER BY day LIMIT ? OFFSET ?
+            namespace LIKE ? AND instance LIKE ? ORDER BY day
         """,
     'epg_one_get':
         """
         SELECT * FROM epg WHERE
             namespace=? AND instance=? AND day=?
         """,
+    'epg_unindexed_get':
+        """
+        SELECT * FROM epg WHERE NOT EXISTS (
+            SELECT 1 FROM epg_index WHERE epg_index.namespace=epg.namespace
+                AND epg_index.instance=epg.instance AND epg_index.day=epg.day)
+        """,
     'epg_name_get':
         """
         SELECT DISTINCT namespace FROM epg
@@ -105,6 +164,43 @@ sqlcmds = {
     'epg_instances_get':
         """
         SELECT DISTINCT namespace, instance FROM epg
+        """,
+
+    'epg_index_add':
+        """
+        INSERT INTO epg_index (
+            namespace, instance, day, channel, start, stop, title, subtitle, progid
+            ) VALUES ( ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+    'epg_index_day_del':
+        """
+        DELETE FROM epg_index WHERE namespace=? AND instance=? AND day=?
+        """,
+    'epg_index_by_day_del':
+        """
+        DELETE FROM epg_index WHERE namespace LIKE ? AND instance LIKE ? AND day < DATE('now',?)
+        """,
+    'epg_index_instance_del':
+        """
+        DELETE FROM epg_index WHERE namespace=? AND instance LIKE ?
+        """,
+    'epg_index_now_next_get':
+        """
+        SELECT namespace, instance, channel, start, stop, title, subtitle, progid FROM (
+            SELECT *, ROW_NUMBER() OVER (
+                PARTITION BY namespace, instance, channel ORDER BY stop) AS row_num
+            FROM epg_index WHERE channel=? AND stop > ?
+                AND namespace LIKE ? AND instance LIKE ?)
+        WHERE row_num <= 2 ORDER BY namespace, instance, stop
+        """,
+    'epg_index_all_now_next_get':
+        """
+        SELECT namespace, instance, channel, start, stop, title, subtitle, progid FROM (
+            SELECT *, ROW_NUMBER() OVER (
+                PARTITION BY namespace, instance, channel ORDER BY stop) AS row_num
+            FROM epg_index WHERE stop > ? AND stop <= ?
+                AND namespace LIKE ? AND instance LIKE ?)
+        WHERE row_num <= 2 ORDER BY namespace, instance, channel, stop
         """
 }
 
@@ -118,14 +214,167 @@ class DBepg(DB):
         return self.get(DB_EPG_TABLE + '_column_names')
     
     def save_program_list(self, _namespace, _instance, _day, _prog_list):
-        filepath = self.save_file((DB_EPG_TABLE, _namespace, _instance, _day), json.dumps(_prog_list))
+        file_format = self.get_file_format()
+        old_row = self.get_dict(DB_EPG_TABLE + '_one', (_namespace, _instance, _day))
+        filepath = self.save_file((DB_EPG_TABLE, _namespace, _instance, _day),
+                                  self.encode_programs(_prog_list, file_format),
+                                  EPG_FILE_EXT[file_format])
         if filepath:
-            self.add(DB_EPG_TABLE, (
-                _namespace,
-                _instance,
-                _day,
-                datetime.datetime.utcnow(),
-                str(filepath),))
+            self.update_many([
+                (DB_EPG_TABLE + SQL_ADD_ROW, [(
+                    _namespace,
+                    _instance,
+                    _day,
+                    datetime.datetime.utcnow(),
+                    str(filepath),)]),
+                (DB_EPG_INDEX_TABLE + '_day' + SQL_DELETE, [(_namespace, _instance, _day,)]),
+                (DB_EPG_INDEX_TABLE + SQL_ADD_ROW,
+                    self.get_index_rows(_namespace, _instance, _day, _prog_list))])
+            if old_row and old_row[0]['file'] != str(filepath):
+                self.delete_file(old_row[0]['file'])
+
+    def get_index_rows(self, _namespace, _instance, _day, _prog_list):
+        """
+        Returns the epg_index rows for the programs.  Times are stored in UTC
+        """
+        rows = []
+        for prog in _prog_list:
+            try:
+                rows.append((
+                    _namespace,
+                    _instance,
+                    _day,
+                    prog['channel'],
+                    utils.xmltv_to_utc_str(prog['start']),
+                    utils.xmltv_to_utc_str(prog['stop']),
+                    prog.get('title'),
+                    prog.get('subtitle'),
+                    prog.get('progid'),))
+            except (KeyError, TypeError, ValueError):
+                self.logger.debug('Program not indexed, invalid times {}'.format(prog))
+        return rows
+
+    def index_days(self):
+        """
+        Adds the epg_index rows for the days saved before the index existed
+        """
+        count = 0
+        for row in self.get_dict(DB_EPG_TABLE + '_unindexed'):
+            prog_list = self.get_programs(row['file'])
+            self.update_many([
+                (DB_EPG_INDEX_TABLE + SQL_ADD_ROW,
+                    self.get_index_rows(row['namespace'], row['instance'], row['day'], prog_list))])
+            count += 1
+        if count:
+            self.logger.info('Indexed programs for {} EPG days'.format(count))
+
+    def get_now_next(self, _namespace=None, _instance=None, _channel=None, _now=None):
+        """
+        Returns the current and next program for the channel, or for all
+        channels when _channel is None, from a single query on epg_index.
+        For all channels, only programs ending within NOW_NEXT_HORIZON are found.
+        Returns a list of dicts with namespace, instance, channel, now and next
+        """
+        if not _namespace:
+            _namespace = '%'
+        if not _instance:
+            _instance = '%'
+        if _now is None:
+            _now = datetime.datetime.utcnow()
+        now = _now.strftime('%Y-%m-%d %H:%M:%S')
+        if _channel is None:
+            # limit the range of the stop index scanned
+            horizon = (_now + NOW_NEXT_HORIZON).strftime('%Y-%m-%d %H:%M:%S')
+            rows = self.get_dict(DB_EPG_INDEX_TABLE + '_all_now_next', (now, horizon, _namespace, _instance,))
+        else:
+            rows = self.get_dict(DB_EPG_INDEX_TABLE + '_now_next', (_channel, now, _namespace, _instance,))
+        results = []
+        current = None
+        for row in rows:
+            key = (row.pop('namespace'), row.pop('instance'), row.pop('channel'))
+            if current is None or current['key'] != key:
+                current = {'key': key, 'namespace': key[0], 'instance': key[1],
+                           'channel': key[2], 'now': None, 'next': None}
+                results.append(current)
+                if row['start'] <= _now:
+                    current['now'] = row
+                    continue
+            if current['next'] is None:
+                current['next'] = row
+        for result in results:
+            del result['key']
+        return results
+
+    def get_file_format(self):
+        file_format = self.config['datamgmt'].get('epg_file_format')
+        if file_format not in EPG_FILE_EXT:
+            file_format = 'json'
+        return file_format
+
+    def encode_programs(self, _prog_list, _file_format):
+        if _file_format == 'compact':
+            return EPGDayBlob.from_programs(_prog_list).dumps()
+        return json.dumps(_prog_list)
+
+    def get_programs(self, _filepath, _channels=None):
+        """
+        Returns the list of programs in the program file, either format.
+        When _channels is set, only the programs for those channels are
+        returned and the other channels in a compact file are not decoded
+        """
+        blob = self.get_file(_filepath)
+        if not blob:
+            return []
+        try:
+            if blob.startswith(EPG_BLOB_MAGIC):
+                return EPGDayBlob.loads(blob).to_list(_channels)
+            prog_list = json.loads(blob)
+        except EPG_DECODE_ERRORS as ex:
+            self.remove_bad_file(_filepath, ex)
+            return []
+        if _channels is None:
+            return prog_list
+        return [prog for prog in prog_list if prog.get('channel') in _channels]
+
+    def remove_bad_file(self, _filepath, _ex):
+        """
+        Removes the day of a program file that cannot be read, so the
+        next EPG refresh downloads it again
+        """
+        self.logger.warning('Unable to read EPG program file, day will be refreshed {} {}'
+                            .format(_filepath, _ex))
+        for row in self.get_dict(DB_EPG_TABLE + '_file', (_filepath,)):
+            self.delete(DB_EPG_INDEX_TABLE + '_day', (row['namespace'], row['instance'], row['day'],))
+        self.delete(DB_EPG_TABLE + '_file', (_filepath,))
+        self.delete_file(_filepath)
+
+    def migrate_files(self):
+        """
+        Converts the program files that are not in the configured format
+        and indexes the days missing from epg_index.  Called at startup
+        """
+        # creates the tables and indexes added since the database was created
+        self.create_tables()
+        file_format = self.get_file_format()
+        ext = EPG_FILE_EXT[file_format]
+        count = 0
+        for row in self.get_epg_rows(None, None):
+            if row['file'].endswith(ext):
+                continue
+            prog_list = self.get_programs(row['file'])
+            if not prog_list:
+                continue
+            filepath = self.save_file(
+                (DB_EPG_TABLE, row['namespace'], row['instance'], row['day']),
+                self.encode_programs(prog_list, file_format), ext)
+            if filepath:
+                self.update(DB_EPG_TABLE + '_file', (
+                    str(filepath), row['namespace'], row['instance'], row['day'],))
+                self.delete_file(row['file'])
+                count += 1
+        if count:
+            self.logger.info('Converted {} EPG program files to {} format'.format(count, file_format))
+        self.index_days()
 
     def del_old_programs(self, _namespace, _instance, _days='-2 day'):
         """
@@ -140,6 +389,7 @@ class DBepg(DB):
         for f in files:
             self.delete_file(f)
         self.delete(DB_EPG_TABLE + '_by_day', (_namespace, _instance, _days,))
+        self.delete(DB_EPG_INDEX_TABLE + '_by_day', (_namespace, _instance, _days,))
 
     def del_instance(self, _namespace, _instance):
         """
@@ -151,6 +401,7 @@ class DBepg(DB):
         files = [x[0] for x in files]
         for f in files:
             self.delete_file(f)
+        self.delete(DB_EPG_INDEX_TABLE + '_instance', (_namespace, _instance,))
         return self.delete(DB_EPG_TABLE + '_instance', (_namespace, _instance,))
 
     def set_last_update(self, _namespace=None, _instance=None, _day=None):
@@ -186,12 +437,22 @@ class DBepg(DB):
     def get_epg_one(self, _namespace, _instance, _day):
         row = self.get_dict(DB_EPG_TABLE + '_one', (_namespace, _instance, _day))
         if len(row):
-            blob = self.get_file_by_key((_namespace, _instance, _day,))
-            if blob:
-                row[0]['json'] = json.loads(blob)
+            prog_list = self.get_programs(row[0]['file'])
+            if prog_list:
+                row[0]['json'] = prog_list
                 return row
         return []
 
+    def get_epg_rows(self, _namespace, _instance):
+        """
+        Returns the epg rows ordered by day without loading the program files
+        """
+        if not _namespace:
+            _namespace = '%'
+        if not _instance:
+            _instance = '%'
+        return self.get_dict(DB_EPG_TABLE, (_namespace, _instance,))
+
     def init_get_query(self, _namespace, _instance):
         if not _namespace:
             _namespace = '%'
@@ -199,7 +460,11 @@ class DBepg(DB):
             _instance = '%'
         self.get_init(DB_EPG_TABLE, (_namespace, _instance,))
 
-    def get_next_row(self):
+    def get_next_row(self, _channels=None):
+        """
+        Returns the programs for the next day of the query.  When _channels
+        is set, only the programs for those channels are decoded
+        """
         row = self.get_dict_next()
         namespace = None
         instance = None
@@ -208,18 +473,9 @@ class DBepg(DB):
             namespace = row['namespace']
             instance = row['instance']
             day = row['day']
-            file = row['file']
-            blob = self.get_file(file)
-            if blob:
-                json_data = json.loads(blob)
-            else:
-                json_data = []
-            row = json_data
+            row = self.get_programs(row['file'], _channels)
         return row, namespace, instance, day
 
-    def close_query(self):
-        self.cur.close()
-
     @Backup(DB_CONFIG_NAME)
     def backup(self, backup_folder):
         self.export_sql(backup_folder)
@@ -227,3 +483,76 @@ class DBepg(DB):
     @Restore(DB_CONFIG_NAME)
     def restore(self, backup_folder):
         return self.import_sql(backup_folder)
+
+
+class EPGDayBlob:
+    """
+    Compact encoding of the programs for one EPG day.  Each program is
+    a tuple of values stored by channel, with the key names stored once for
+    each distinct set of keys and repeated strings stored once.  The result
+    is marshalled and compressed with zlib.  Program dicts are only created
+    for the channels requested.
+    """
+
+    def __init__(self, _shapes, _channels, _runs):
+        # list of key tuples
+        self.shapes = _shapes
+        # channel -> list of (shape index, values...)
+        self.channels = _channels
+        # [channel, number of programs] in the original program order
+        self.runs = _runs
+
+    @classmethod
+    def from_programs(cls, _prog_list):
+        shapes = {}
+        strings = {}
+        channels = {}
+        runs = []
+        for prog in _prog_list:
+            shape = shapes.setdefault(tuple(prog.keys()), len(shapes))
+            channel = prog.get('channel')
+            row = [shape]
+            row.extend(cls.intern_value(value, strings) for value in prog.values())
+            channels.setdefault(channel, []).append(tuple(row))
+            if runs and runs[-1][0] == channel:
+                runs[-1][1] += 1
+            else:
+                runs.append([channel, 1])
+        return cls(list(shapes.keys()), channels, runs)
+
+    @classmethod
+    def intern_value(cls, _value, _strings):
+        if isinstance(_value, str):
+            return _strings.setdefault(_value, _value)
+        elif isinstance(_value, list):
+            return [cls.intern_value(x, _strings) for x in _value]
+        elif isinstance(_value, dict):
+            return {key: cls.intern_value(x, _strings) for key, x in _value.items()}
+        return _value
+
+    @classmethod
+    def loads(cls, _blob):
+        if not _blob.startswith(EPG_BLOB_MAGIC):
+            raise ValueError('Not a compact EPG program file')
+        shapes, channels, runs = marshal.loads(zlib.decompress(_blob[len(EPG_BLOB_MAGIC):]))
+        return cls(shapes, channels, runs)
+
+    def dumps(self):
+        return EPG_BLOB_MAGIC + zlib.compress(
+            marshal.dumps((self.shapes, self.channels, self.runs)))
+
+    def to_list(self, _channels=None):
+        """
+        Returns the programs in the order they were saved.  When _channels
+        is set, the programs for the other channels are not decoded
+        """
+        prog_list = []
+        position = {}
+        for channel, count in self.runs:
+            start = position.get(channel, 0)
+            position[channel] = start + count
+            if _channels is not None and channel not in _channels:
+                continue
+            prog_list.extend(dict(zip(self.shapes[row[0]], row[1:]))
+                             for row in self.channels[channel][start:start + count])
+        return prog_list
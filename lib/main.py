@@ -56,6 +56,7 @@ import lib.updater.updater as updater
 import lib.config.user_config as user_config
 from lib.db.db_scheduler import DBScheduler
 from lib.db.db_temp import DBTemp
+from lib.db.db_epg import DBepg
 from lib.common.utils import clean_exit
 from lib.common.pickling import Pickling
 from lib.schedule.scheduler import Scheduler
@@ -146,6 +147,10 @@ def main(script_dir):
         utils.cleanup_web_temp(config)
         dbtemp = DBTemp(config)
         dbtemp.cleanup_temp(None, None)
+        try:
+            DBepg(config).migrate_files()
+        except Exception as ex:
+            LOGGER.warning('Unable to convert EPG program files, continuing {}'.format(ex))
         plugins = init_plugins(config_obj)
         config_obj.defn_json = None
         init_versions(plugins)
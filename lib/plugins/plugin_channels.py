@@ -29,6 +29,7 @@ import lib.m3u8 as m3u8
 import lib.config.config_callbacks as config_callbacks
 import lib.common.utils as utils
 import lib.image_size.get_image_size as get_image_size
+from lib.clients.logo_cache import LogoCache
 from lib.db.db_channels import DBChannels
 from lib.common.decorators import handle_url_except
 from lib.common.decorators import handle_json_except
@@ -214,6 +215,10 @@ class PluginChannels:
                 if ch_row['json']['thumbnail'] == _thumbnail:
                     return ch_row['json']['thumbnail_size']
 
+        logo_cache = LogoCache(self.config_obj.data)
+        if logo_cache.is_cacheable(_thumbnail):
+            return logo_cache.get_size(_thumbnail, self.plugin_obj.http_session)
+
         h = {'User-Agent': utils.DEFAULT_USER_AGENT,
              'Accept': '*/*',
              'Accept-Encoding': 'identity',
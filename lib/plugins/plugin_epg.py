@@ -16,18 +16,68 @@ The above copyright notice and this permission notice shall be included in all c
 substantial portions of the Software.
 """
 
+import concurrent.futures
 import datetime
 import json
 import logging
 import threading
+import time
 
+import lib.common.exceptions as exceptions
 import lib.common.utils as utils
+from lib.clients.epg2xml import XMLTVFiles
 from lib.db.db_epg import DBepg
 from lib.common.decorators import handle_url_except
 from lib.common.decorators import handle_json_except
 
 
+class RateLimiter:
+    """
+    Spaces out the requests to a provider so no more than _rate requests
+    per second are sent from all threads in the process.  One limiter
+    is shared by all instances of a plugin.
+    """
+    limiters = {}
+    limiters_lock = threading.Lock()
+
+    def __init__(self, _rate):
+        self.lock = threading.Lock()
+        self.interval = 0.0
+        self.next_time = 0.0
+        self.set_rate(_rate)
+
+    @classmethod
+    def get_limiter(cls, _name, _rate):
+        with cls.limiters_lock:
+            limiter = cls.limiters.get(_name)
+            if limiter is None:
+                limiter = cls(_rate)
+                cls.limiters[_name] = limiter
+            else:
+                limiter.set_rate(_rate)
+            return limiter
+
+    def set_rate(self, _rate):
+        if _rate:
+            self.interval = 1.0 / _rate
+        else:
+            self.interval = 0.0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
 class PluginEPG:
+    # plugins whose refresh_programs() can run for several days at the
+    # same time set this to True.  Otherwise days are refreshed one at a time
+    is_refresh_thread_safe = False
 
     def __init__(self, _instance_obj):
         self.logger = logging.getLogger(__name__)
@@ -43,6 +93,8 @@ class PluginEPG:
             self.episode_adj = 0
         else:
             self.episode_adj = int(self.episode_adj)
+        self.rate_limiter = RateLimiter.get_limiter(
+            self.plugin_obj.name, self.config_obj.data['epg'].get('epg_refresh_rate_limit'))
 
     def terminate(self):
         """
@@ -57,6 +109,7 @@ class PluginEPG:
         self.db = None
         self.config_section = None
         self.episode_adj = None
+        self.rate_limiter = None
 
     @handle_url_except(timeout=10.0)
     @handle_json_except
@@ -69,6 +122,7 @@ class PluginEPG:
         else:
             header = _header
         self.logger.trace('HEADER: {}'.format(header))
+        self.rate_limiter.wait()
         resp = self.plugin_obj.http_session.get(_uri, headers=header, timeout=8)
         x = resp.json()
         resp.raise_for_status()
@@ -85,13 +139,73 @@ class PluginEPG:
         forced_dates, aging_dates = self.dates_to_pull()
         self.db.del_old_programs(self.plugin_obj.name, self.instance_key)
 
-        for epg_day in forced_dates:
-            self.refresh_programs(epg_day, False)
-        for epg_day in aging_dates:
-            self.refresh_programs(epg_day, True)
-        self.logger.info('{}:{} EPG update completed'.format(self.plugin_obj.name, self.instance_key))
+        start = time.monotonic()
+        day_times = self.refresh_days(
+            [(epg_day, False) for epg_day in forced_dates]
+            + [(epg_day, True) for epg_day in aging_dates])
+        self.logger.info('{}:{} EPG update completed in {:.1f} seconds. Days: {}'.format(
+            self.plugin_obj.name, self.instance_key, time.monotonic() - start,
+            ', '.join(['{} {:.1f}s'.format(epg_day, secs) for epg_day, secs in sorted(day_times.items())])))
+        if self.config_obj.data['epg'].get('epg_xmltv_cache'):
+            XMLTVFiles(self.config_obj.data).update_files(self.plugin_obj.name, self.instance_key)
         return True
 
+    def refresh_days(self, _days):
+        """
+        Calls refresh_programs() for each (day, use_cache) in _days using
+        [epg][epg_refresh_workers] threads when the plugin sets
+        is_refresh_thread_safe, otherwise one thread.  Days that fail are retried until
+        [epg][epg_refresh_retries] retries have been used for this refresh.
+        Returns a dict of day: seconds to refresh
+        """
+        workers = 1
+        if self.is_refresh_thread_safe:
+            workers = max(1, int(self.config_obj.data['epg'].get('epg_refresh_workers') or 1))
+        retries = int(self.config_obj.data['epg'].get('epg_refresh_retries') or 0)
+        day_times = {}
+        last_ex = None
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers,
+                thread_name_prefix='{}_{}_epg'.format(self.plugin_obj.name, self.instance_key)) as pool:
+            futures = {pool.submit(self.refresh_day, epg_day, use_cache): (epg_day, use_cache)
+                       for epg_day, use_cache in _days}
+            while futures:
+                done, not_done = concurrent.futures.wait(
+                    futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    epg_day, use_cache = futures.pop(future)
+                    try:
+                        day_times[epg_day] = future.result()
+                    except exceptions.CabernetException:
+                        for pending in futures:
+                            pending.cancel()
+                        raise
+                    except Exception as ex:
+                        if retries > 0:
+                            retries -= 1
+                            self.logger.warning('{}:{} EPG refresh failed for {}, retrying: {}'.format(
+                                self.plugin_obj.name, self.instance_key, epg_day, ex))
+                            futures[pool.submit(self.refresh_day, epg_day, use_cache)] = (epg_day, use_cache)
+                        else:
+                            self.logger.warning('{}:{} EPG refresh failed for {}, no retries left: {}'.format(
+                                self.plugin_obj.name, self.instance_key, epg_day, ex))
+                            last_ex = ex
+        if last_ex is not None:
+            raise last_ex
+        return day_times
+
+    def refresh_day(self, _epg_day, _use_cache):
+        """
+        Runs in the refresh thread pool.  Returns the seconds taken
+        """
+        start = time.monotonic()
+        try:
+            self.refresh_programs(_epg_day, _use_cache)
+        finally:
+            # the pool threads are temporary, so release their db connections
+            self.db.close()
+        return time.monotonic() - start
+
     def refresh_programs(self, _epg_day, use_cache=True):
         """
         dummy method to be overridden
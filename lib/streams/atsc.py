@@ -21,6 +21,7 @@ import datetime
 import logging
 import struct
 import lib.common.utils as utils
+import lib.streams.ts_scanner as ts_scanner
 from lib.common.algorithms import Crc
 from lib.common.models import CrcModels
 
@@ -35,6 +36,9 @@ MPEG2_CONDITIONAL_ACCESS_TABLE_TAG = b'\x01'
 MPEG2_PROGRAM_MAP_TABLE_TAG = b'\x02'
 
 ATSC_MSG_LEN = 188
+SDT_PID = 0x0011
+# PAT and the private data PID carrying the audio/video meta
+PSIP_PIDS = (0x0000, 0x1000)
 LEAP_SECONDS_1980 = 19
 LEAP_SECONDS_2021 = 37  # this has not changed since 2017
 
@@ -57,21 +61,27 @@ class ATSCMsg:
         self.crc_reflect_out = crc32_mpeg_model['reflect_out']
         self.crc_xor_out = crc32_mpeg_model['xor_out']
         self.crc_table_idx_width = 8
-        self.atsc_blank_section = b'\x47\x1f\xff\x10\x00'.ljust(ATSC_MSG_LEN, b'\xff')
-        self.type_strings = []
-        self.msg_counter = {}
-
-    def gen_crc_mpeg(self, _msg):
-        alg = Crc(
+        self.crc_alg = Crc(
             width=self.crc_width,
             poly=self.crc_poly,
             reflect_in=self.crc_reflect_in,
             xor_in=self.crc_xor_in,
             reflect_out=self.crc_reflect_out,
             xor_out=self.crc_xor_out,
-            table_idx_width=8,
+            table_idx_width=self.crc_table_idx_width,
         )
-        crc_int = alg.bit_by_bit(_msg)
+        self.atsc_blank_section = b'\x47\x1f\xff\x10\x00'.ljust(ATSC_MSG_LEN, b'\xff')
+        self.type_strings = []
+        self.msg_counter = {}
+        # (packet, provider, name) the cached sdt_packet_out was made from
+        self.sdt_key = None
+        self.sdt_packet_out = None
+        self.video_packets_msgs = None
+        self.video_packets_template = None
+        self.video_packets_pids = None
+
+    def gen_crc_mpeg(self, _msg):
+        crc_int = self.crc_alg.table_driven(_msg)
         crc = struct.pack('>I', crc_int)
         return crc
 
@@ -153,42 +163,34 @@ class ATSCMsg:
     def update_sdt_names(self, _video, _service_provider, _service_name):
         if _video.data is None:
             return
-        i = 0
-        video_len = len(_video.data)
-        msg = None
-        while True:
-            if i + ATSC_MSG_LEN > video_len:
-                break
-            packet = _video.data[i:i + ATSC_MSG_LEN]
-            program_fields = self.decode_ts_packet(packet)
-            if program_fields is None:
-                i += ATSC_MSG_LEN
-                continue
-            if program_fields['transport_error_indicator']:
-                i += ATSC_MSG_LEN
-                continue
-            if program_fields['pid'] == 0x0011:
-                descr = b'\x01' \
-                        + utils.set_str(_service_provider, False) \
-                        + utils.set_str(_service_name, False)
-                descr = b'\x48' + utils.set_u8(len(descr)) + descr
-                msg = packet[8:20] + utils.set_u8(len(descr)) + descr
-                length = utils.set_u16(len(msg) + 4 + 0xF000)
-                msg = ATSC_SERVICE_DESCR_TABLE_TAG + length + msg
-                crc = self.gen_crc_mpeg(msg)
-                msg = packet[:5] + msg + crc
-                msg = msg.ljust(len(packet), b'\xFF')
-                _video.data = b''.join([
-                    _video.data[:i],
-                    msg,
-                    _video.data[i + ATSC_MSG_LEN:]
-                ])
-            i += ATSC_MSG_LEN
-        if msg is None:
+        offsets = ts_scanner.find_pid_packets(_video.data, (SDT_PID,))
+        if not offsets:
             self.logger.debug('Missing ATSC SDT Msg in stream, unable to update provider and service name')
-        else:
-            self.logger.debug('Updating ATSC SDT with service info {} {}' \
-                              .format(_service_provider, _service_name))
+            return
+        if not isinstance(_video.data, bytearray):
+            _video.data = bytearray(_video.data)
+        for i in offsets:
+            packet = bytes(_video.data[i:i + ATSC_MSG_LEN])
+            sdt_key = (packet, _service_provider, _service_name)
+            if sdt_key != self.sdt_key:
+                self.sdt_key = sdt_key
+                self.sdt_packet_out = self.gen_sdt(packet, _service_provider, _service_name)
+            _video.data[i:i + ATSC_MSG_LEN] = self.sdt_packet_out
+        self.logger.debug('Updating ATSC SDT with service info {} {}' \
+                          .format(_service_provider, _service_name))
+
+    def gen_sdt(self, _packet, _service_provider, _service_name):
+        # rebuilds the SDT packet with a single service descriptor
+        descr = b'\x01' \
+                + utils.set_str(_service_provider, False) \
+                + utils.set_str(_service_name, False)
+        descr = b'\x48' + utils.set_u8(len(descr)) + descr
+        msg = _packet[8:20] + utils.set_u8(len(descr)) + descr
+        length = utils.set_u16(len(msg) + 4 + 0xF000)
+        msg = ATSC_SERVICE_DESCR_TABLE_TAG + length + msg
+        crc = self.gen_crc_mpeg(msg)
+        msg = _packet[:5] + msg + crc
+        return msg.ljust(len(_packet), b'\xFF')
 
     def gen_sld(self, _base_pid, _elements):
         # Table 6.29 Service Location Descriptor
@@ -519,102 +521,51 @@ class ATSCMsg:
         #       PAT 0
         #       CAT 1
         # 7 sections per packet
-        sections = [
-            self.update_continuity_counter(self.atsc_blank_section),
-            self.update_continuity_counter(self.atsc_blank_section),
-            self.update_continuity_counter(self.atsc_blank_section),
-            self.update_continuity_counter(self.atsc_blank_section),
-            self.update_continuity_counter(self.atsc_blank_section),
-            self.update_continuity_counter(self.atsc_blank_section),
-            self.update_continuity_counter(self.atsc_blank_section),
-        ]
-
-        if _msgs is None:
-            return b''.join(sections)
-
-        # for now assume the msgs are less than 1316
-        if len(_msgs) > 7:
-            self.logger.error('ATSC: TOO MANY MESSAGES={}'.format(len(_msgs)))
-            return None
-        for i in range(len(_msgs)):
-            if len(_msgs[i]) > ATSC_MSG_LEN:
-                self.logger.error('ATSC: MESSAGE LENGTH TOO LONG={}'.format(len(_msgs[i])))
-                return None
-            else:
-                sections[i] = self.update_continuity_counter(_msgs[i].ljust(ATSC_MSG_LEN, b'\xff'))
-
-        return b''.join(sections)
+        # The padded sections are kept until a different list of msgs is
+        # passed in, so only the continuity counters change on each call
+        if self.video_packets_template is None or _msgs != self.video_packets_msgs:
+            sections = []
+            if _msgs is not None:
+                # for now assume the msgs are less than 1316
+                if len(_msgs) > 7:
+                    self.logger.error('ATSC: TOO MANY MESSAGES={}'.format(len(_msgs)))
+                    return None
+                for msg in _msgs:
+                    if len(msg) > ATSC_MSG_LEN:
+                        self.logger.error('ATSC: MESSAGE LENGTH TOO LONG={}'.format(len(msg)))
+                        return None
+                    sections.append(bytes(msg).ljust(ATSC_MSG_LEN, b'\xff'))
+            while len(sections) < 7:
+                sections.append(self.atsc_blank_section)
+            self.video_packets_template = b''.join(sections)
+            self.video_packets_pids = [self.get_pid(section) for section in sections]
+            # a copy, so a list changed in place is seen as different
+            self.video_packets_msgs = None if _msgs is None else [bytes(msg) for msg in _msgs]
+
+        packets = bytearray(self.video_packets_template)
+        for i, pid in enumerate(self.video_packets_pids):
+            if pid is None:
+                continue
+            counter = self.msg_counter.get(pid, 0)
+            j = i * ATSC_MSG_LEN + 3
+            packets[j] = (packets[j] & 0xf0) + counter
+            self.msg_counter[pid] = (counter + 1) & 0x0f
+        return bytes(packets)
         # TBD need to handle large msg and more than 7 msgs
 
     def extract_psip(self, _video_data):
-        packet_list = []
+        """
+        Returns the PAT and private data packets found at the start of the
+        segment.  Only the first 7 packets are looked at and each match
+        counts twice against that limit.
+        """
         if _video_data is None:
             return
-        i = 0
-        video_len = len(_video_data)
-        prev_pid = -1
-        pmt_pids = None
-        pat_found = False
-        pmt_found = False
-        seg_counter = 0
-
-        while True:
-            if i + ATSC_MSG_LEN > video_len:
-                break
-            packet = _video_data[i:i + ATSC_MSG_LEN]
-            i += ATSC_MSG_LEN
-            program_fields = self.decode_ts_packet(packet)
-
-            seg_counter += 1
-            if seg_counter > 7:
-                # self.logger.debug('###### SENDING BACK {} PACKETS'.format(len(packet_list)))
+        packet_list = []
+        for i in ts_scanner.find_pid_packets(_video_data, PSIP_PIDS, 7):
+            if i // ATSC_MSG_LEN + 1 + len(packet_list) > 7:
                 break
-
-            if program_fields is None:
-                continue
-            if program_fields['transport_error_indicator']:
-                continue
-
-            # SDT: 17, PAT: 0, Private data: 4096 (audio/video meta)
-            if program_fields['pid'] == 0 \
-                    or program_fields['pid'] == 4096:
-                packet_list.append(packet)
-
-                seg_counter += 1
-                if seg_counter > 7:
-                    # self.logger.debug('###### SENDING BACK {} PACKETS'.format(len(packet_list)))
-                    break
-
-                continue
-
-
-            if program_fields['pid'] == 0x0000:
-                pmt_pids = self.decode_pat(program_fields['payload'])
-                # self.logger.debug('###### EXPECTED PMT PIDS: {}'.format(pmt_pids))
-                if not pat_found:
-                    packet_list.append(packet)
-                    pat_found = True
-            #if pmt_pids and program_fields['pid'] in pmt_pids.keys():
-            #    program = pmt_pids[program_fields['pid']]
-            #    self.decode_pmt(program_fields['pid'], program, program_fields['payload'])
-            #    if not pmt_found:
-            #        # self.logger.debug('###### FOUND PMT PID: {}'.format(program_fields['pid']))
-            #        packet_list.append(packet)
-            #        pmt_found = True
-            #    continue
-            #elif program_fields['pid'] == 0x1ffb:
-            #    self.logger.info('Packet Table indicator 0x1ffb, not implemented {}'.format(i))
-            #    continue
-            # elif program_fields['pid'] == 0x0011:
-            #    self.logger.info('Service Description Table (SDT) 0x0011, not implemented {}'.format(i))
-            #    continue
-            # elif program_fields['pid'] == 0x0000 or \
-            #        program_fields['pid'] == 0x0100 or \
-            #        program_fields['pid'] == 0x0101:
-            #    continue
-            # else:
-            #    self.logger.info('Unknown PID {}'.format(program_fields['pid']))                
-            prev_pid = program_fields['pid']
+            packet_list.append(bytes(_video_data[i:i + ATSC_MSG_LEN]))
         return packet_list
 
     def sync_audio_video(self, _video_data):
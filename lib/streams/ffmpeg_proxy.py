@@ -91,6 +91,7 @@ class FFMpegProxy(Stream):
                     self.validate_stream()
                     self.update_tuner_status('Streaming')
                     start_ttw = time.time()
+                    self.record_tunein(_channel_dict, self.tuner_no)
                     self.write_buffer.write(self.video.data)
                     delta_ttw = time.time() - start_ttw
                     self.logger.info(
@@ -145,7 +146,7 @@ class FFMpegProxy(Stream):
         self.video.data = None
         idle_timer = MAX_IDLE_TIMER  # time slice segments are less than 10 seconds
         while not data_found:
-            self.video.data = self.stream_queue.read()
+            self.video.data = self.stream_queue.read_view()
             if self.video.data:
                 data_found = True
             else:
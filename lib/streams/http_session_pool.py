@@ -0,0 +1,128 @@
+"""
+MIT License
+
+Copyright (C) 2023 ROCKY4546
+https://github.com/rocky4546
+
+This file is part of Cabernet
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+and associated documentation files (the "Software"), to deal in the Software without restriction,
+including without limitation the rights to use, copy, modify, merge, publish, distribute,
+sublicense, and/or sell copies of the Software, and to permit persons to whom the Software
+is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or
+substantial portions of the Software.
+"""
+
+import logging
+import threading
+import urllib.parse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class HTTPSessionPool:
+    """
+    Keeps one keep-alive requests session per host, so the playlist, key and
+    segment downloads reuse their TCP/TLS connections.  A host's session is
+    only replaced after repeated failures instead of on every error.
+    Connection counters come from the urllib3 pools, num_connections
+    being the number of handshakes done.
+    """
+
+    def __init__(self, _pool_size=4, _max_failures=2):
+        self.logger = logging.getLogger(__name__)
+        self.pool_size = _pool_size
+        self.max_failures = _max_failures
+        self.sessions = {}
+        self.failures = {}
+        self.lock = threading.Lock()
+        self.closed_connections = 0
+        self.closed_requests = 0
+
+    def get_session(self, _uri):
+        host = self.get_host(_uri)
+        with self.lock:
+            session = self.sessions.get(host)
+            if session is None:
+                session = requests.session()
+                # one pool each for http and https on this host
+                adapter = HTTPAdapter(pool_connections=2, pool_maxsize=self.pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self.sessions[host] = session
+                self.failures[host] = 0
+        return session
+
+    def report_success(self, _uri):
+        self.failures[self.get_host(_uri)] = 0
+
+    def report_failure(self, _uri):
+        """
+        Evicts the session for the host once max_failures errors in a row occur
+        """
+        host = self.get_host(_uri)
+        failures = self.failures.get(host, 0) + 1
+        self.failures[host] = failures
+        if failures >= self.max_failures:
+            self.logger.debug('Evicting HTTP session for {} after {} failures'.format(host, failures))
+            self.evict(_uri)
+
+    def evict(self, _uri):
+        host = self.get_host(_uri)
+        with self.lock:
+            session = self.sessions.pop(host, None)
+            self.failures.pop(host, None)
+        if session is not None:
+            self.close_session(session)
+
+    def reset(self):
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions.clear()
+            self.failures.clear()
+        for session in sessions:
+            self.close_session(session)
+
+    def close_session(self, _session):
+        connections, num_requests = self.count_connections(_session)
+        self.closed_connections += connections
+        self.closed_requests += num_requests
+        _session.close()
+
+    def get_stats(self):
+        """
+        Returns the handshakes and reused connection counts for all hosts,
+        including the sessions already evicted
+        """
+        connections = self.closed_connections
+        num_requests = self.closed_requests
+        with self.lock:
+            sessions = list(self.sessions.values())
+        for session in sessions:
+            s_connections, s_requests = self.count_connections(session)
+            connections += s_connections
+            num_requests += s_requests
+        return {
+            'hosts': len(sessions),
+            'handshakes': connections,
+            'reused': max(num_requests - connections, 0)}
+
+    def count_connections(self, _session):
+        connections = 0
+        num_requests = 0
+        adapters = {id(adapter): adapter for adapter in _session.adapters.values()}
+        for adapter in adapters.values():
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is not None:
+                    connections += pool.num_connections
+                    num_requests += pool.num_requests
+        return connections, num_requests
+
+    def get_host(self, _uri):
+        return urllib.parse.urlsplit(_uri).netloc
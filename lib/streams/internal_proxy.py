@@ -25,15 +25,18 @@ import socket
 import threading
 import time
 import urllib.parse
-from multiprocessing import Queue, Process
+from multiprocessing import Queue
 
 import lib.common.exceptions as exceptions
 import lib.common.utils as utils
 import lib.m3u8 as m3u8
-import lib.streams.m3u8_queue as m3u8_queue
+import lib.streams.ts_scanner as ts_scanner
 from lib.streams.video import Video
 from lib.streams.atsc import ATSCMsg
+from lib.streams.m3u8_pool import M3U8Pool
+from lib.streams.segment_ring import SegmentRing
 from lib.streams.thread_queue import ThreadQueue
+from lib.streams.timeshift_buffer import TimeShiftBuffer
 from lib.db.db_config_defn import DBConfigDefn
 from lib.db.db_channels import DBChannels
 from lib.clients.web_handler import WebHTTPHandler
@@ -42,11 +45,16 @@ from .stream import Stream
 MAX_OUT_QUEUE_SIZE = 30
 IDLE_COUNTER_MAX = 110    # four times the timeout * retries to terminate the stream in seconds set in config!
 STARTUP_IDLE_COUNTER = 40 # time to wait for an initial stream
+WRITE_INTERVAL = 0.5      # seconds between paced writes while waiting for the next segment
+WRITE_STRETCH = 4         # a segment is spread over this many times its duration, about 25s for 6s segments
+M3U8_START_TIMEOUT = 8    # seconds to wait for the m3u8_queue process to report running
 # code assumes a timeout response in TVH of 15 or higher.
 
 class InternalProxy(Stream):
 
-    is_m3u8_starting = 0
+    # (namespace, tuner index) -> lock held while the tuner starts
+    tuner_locks = {}
+    tuner_locks_lock = threading.Lock()
 
     def __init__(self, _plugins, _hdhr_queue):
         global MAX_OUT_QUEUE_SIZE
@@ -77,6 +85,8 @@ class InternalProxy(Stream):
         self.filter_counter = 0
         self.is_starting = True
         self.cue = False
+        self.timeshift = None
+        self.buffered_segments = []
 
     def terminate(self, *args):
         if self.t_queue:
@@ -116,6 +126,8 @@ class InternalProxy(Stream):
         IDLE_COUNTER_MAX = self.config[self.namespace.lower()]['stream-g_stream_timeout']
         
         self.channel_dict = _channel_dict
+        self.timeshift = TimeShiftBuffer(self.config, _channel_dict)
+        self.buffered_segments = self.get_buffered_segments()
         if not self.start_m3u8_queue_process():
             self.terminate()
             return
@@ -124,6 +136,8 @@ class InternalProxy(Stream):
         while True:
             try:
                 self.check_termination()
+                if self.buffered_segments:
+                    self.write_buffered_segments()
                 self.play_queue()
                 if self.t_m3u8 and not self.t_m3u8.is_alive():
                     break
@@ -206,6 +220,8 @@ class InternalProxy(Stream):
                 self.channel_dict['atsc'] = out_queue_item['atsc']
                 self.db_channels.update_channel_atsc(
                     self.channel_dict)
+            if out_queue_item.get('http_stats') is not None:
+                self.update_tuner_http_stats(out_queue_item['http_stats'])
             uri = out_queue_item['uri']
             if uri == 'terminate':
                 raise exceptions.CabernetException(
@@ -249,8 +265,10 @@ class InternalProxy(Stream):
                             self.in_queue.put({'thread_id': threading.get_ident(), 'uri': 'restart_http'})
                         else:
                             start_ttw = time.time()
+                            self.record_tunein(self.channel_dict, self.tuner_no)
                             self.write_buffer(self.video.data)
                             delta_ttw = time.time() - start_ttw
+                            self.timeshift.add(uri, self.duration, self.video.data)
                             self.update_tuner_status('Streaming')
                             self.logger.info(
                                 'Serving {} {} ({})s ({}B) ttw:{:.2f}s {}'
@@ -269,6 +287,36 @@ class InternalProxy(Stream):
             time.sleep(0.01)
         self.video.terminate()
 
+    def get_buffered_segments(self):
+        """
+        Returns the time-shift segments to start the stream with.  Uses the
+        same number of segments as a normal start and only when the buffer
+        is recent enough to continue into the live playlist.
+        """
+        section = utils.instance_config_section(
+            self.channel_dict['namespace'], self.channel_dict['instance'])
+        seg_to_play = self.config[section]['player-segments_to_play']
+        return self.timeshift.get_recent(seg_to_play, seg_to_play * self.duration)
+
+    def write_buffered_segments(self):
+        """
+        Sends the time-shift segments to the client ahead of the live
+        segments coming from the m3u8_queue process
+        """
+        self.tunein_source = 'timeshift'
+        self.record_tunein(self.channel_dict, self.tuner_no)
+        for segment in self.buffered_segments:
+            self.wfile.write(segment['data'])
+            self.wfile.flush()
+            self.last_ts_filename = segment['path']
+            self.logger.info(
+                'Serving buffered {} {} ({})s ({}B) {}'
+                .format(self.t_m3u8_pid, segment['path'], segment['duration'],
+                        len(segment['data']), threading.get_ident()))
+        self.buffered_segments = []
+        self.update_tuner_status('Streaming')
+        self.is_starting = False
+
     def process_filtered_packet(self, _uri):
         """
         Assumes the queued item has been pulled and is a filtered item.
@@ -290,40 +338,30 @@ class InternalProxy(Stream):
         Plan is to slowly push out bytes until something is
         added to the queue to process.  This should stop the
         clients from terminating the data stream due to lack of data for 
-        a short.  It is currently set to at least 20 seconds of data 
-        before it stops transmitting
+        a short.  The segment is paced based on its duration so it lasts
+        about 25 seconds for 6 second segments before it stops transmitting.
+        As soon as the next segment arrives, the rest is sent.
         """
         try:
-            bytes_written = 0
-            count = 0
             x = 0
-            bytes_per_write = int(len(_data)/25)  # number of seconds to keep transmitting
-            while self.out_queue.qsize() < 1 or \
-                    (self.out_queue.qsize() > 0 and \
-                    self.out_queue.queue[0]['data'] is not None and \
-                    self.out_queue.queue[0]['data']['filtered']):
-                self.wfile.flush()
+            data = memoryview(_data)
+            data_len = len(data)
+            bytes_written = 0
+            bytes_per_write = self.get_bytes_per_write(data)
+            start_time = time.monotonic()
+            while self.is_out_queue_waiting():
                 # Do not use chunk writes! Just send data.
-                # x = self.wfile.write('{}\r\n'.format(len(_data)).encode())
                 next_buffer_write = bytes_written + bytes_per_write
-                if next_buffer_write >= len(_data):
-                    x = self.wfile.write(_data[bytes_written:])
-                    bytes_written = len(_data)
-                    self.wfile.flush()
+                if next_buffer_write >= data_len:
                     break
-                else:
-                    count += 1
-                    if count > 13:
-                        self.update_tuner_status('No Reply')
-                    x = self.wfile.write(_data[bytes_written:next_buffer_write])
-                    bytes_written = next_buffer_write
-                    # x = self.wfile.write('\r\n'.encode())
-                    self.wfile.flush()
-                time.sleep(1.0)
+                if time.monotonic() - start_time > 13:
+                    self.update_tuner_status('No Reply')
+                x = self.wfile.write(data[bytes_written:next_buffer_write])
+                bytes_written = next_buffer_write
+                self.wfile.flush()
+                self.wait_for_out_queue(WRITE_INTERVAL)
                 # special filtered packet processing
-                if self.out_queue.qsize() > 0 and \
-                        self.out_queue.queue[0]['data'] is not None and \
-                        self.out_queue.queue[0]['data']['filtered']:
+                if self.is_out_queue_filtered():
                     # pull queue item and check to confirm it is filtered
                     try:
                         out_queue_item = self.out_queue.get(timeout=1)
@@ -338,8 +376,8 @@ class InternalProxy(Stream):
                     else:
                         # somehow NOT filtered, log this issue
                         self.logger.warning('Unexpected Error: Found unfiltered packet when a filtered packet was expected')
-            if bytes_written != len(_data):
-                x = self.wfile.write(_data[bytes_written:])
+            if bytes_written != data_len:
+                x = self.wfile.write(data[bytes_written:])
                 self.wfile.flush()
         except socket.timeout:
             raise
@@ -347,6 +385,41 @@ class InternalProxy(Stream):
             raise
         return x
 
+    def get_bytes_per_write(self, _data):
+        """
+        Returns the number of bytes to send every WRITE_INTERVAL, rounded to
+        whole TS packets.  The segment duration comes from the m3u8 and the
+        PCR is used when the m3u8 did not provide one.
+        """
+        duration = self.duration
+        if not duration:
+            duration = ts_scanner.get_pcr_duration(_data)
+        if not duration:
+            duration = 6
+        bytes_per_write = int(len(_data) * WRITE_INTERVAL / (duration * WRITE_STRETCH))
+        bytes_per_write -= bytes_per_write % ts_scanner.TS_PACKET_SIZE
+        return max(bytes_per_write, ts_scanner.TS_PACKET_SIZE)
+
+    def is_out_queue_filtered(self):
+        with self.out_queue.mutex:
+            return len(self.out_queue.queue) > 0 \
+                and self.out_queue.queue[0]['data'] is not None \
+                and self.out_queue.queue[0]['data']['filtered']
+
+    def is_out_queue_waiting(self):
+        """
+        True while there is no segment to play next in the out_queue
+        """
+        return self.out_queue.empty() or self.is_out_queue_filtered()
+
+    def wait_for_out_queue(self, _timeout):
+        """
+        Waits until an item is added to the out_queue or the timeout passes
+        """
+        with self.out_queue.not_empty:
+            if not self.out_queue.queue:
+                self.out_queue.not_empty.wait(_timeout)
+
     def write_atsc_msg(self):
         if not self.channel_dict['atsc']:
             self.logger.debug(
@@ -383,6 +456,14 @@ class InternalProxy(Stream):
         if type(tuner) == dict and tuner['ch'] == ch_num:
             WebHTTPHandler.rmg_station_scans[namespace][self.tuner_no]['status'] = _status
 
+    def update_tuner_http_stats(self, _stats):
+        ch_num = self.channel_dict['display_number']
+        namespace = self.channel_dict['namespace']
+        scan_list = WebHTTPHandler.rmg_station_scans[namespace]
+        tuner = scan_list[self.tuner_no]
+        if type(tuner) == dict and tuner['ch'] == ch_num:
+            WebHTTPHandler.rmg_station_scans[namespace][self.tuner_no]['http'] = _stats
+
     def update_idle_counter(self):
         """
         Updates the idle_counter to the nearest int in seconds
@@ -413,115 +494,128 @@ class InternalProxy(Stream):
 
     def start_m3u8_queue_process(self):
         """
-        Python sometimes starts a process where it is not connected to the parent,
-        so the queues do not interact.  The process is killed and restarted
-        until python can do this correctly.
+        Tune-ins for the same tuner are done one at a time, so the second
+        client reuses the ThreadQueue of the first.  Different tuners start
+        in parallel.  The m3u8_queue process comes from the M3U8Pool and is
+        sent the channel over its control pipe.
         """
-        is_running = False
-        max_tries = 40
-        restarts = 5
-        while True:
-            while InternalProxy.is_m3u8_starting != 0:
-                time.sleep(0.1)
-            InternalProxy.is_m3u8_starting = threading.get_ident()
-            time.sleep(0.01)
-            if InternalProxy.is_m3u8_starting == threading.get_ident():
-                break
+        with self.get_tuner_lock():
+            return self.start_m3u8_queue_locked()
+
+    def get_tuner_lock(self):
+        key = (self.channel_dict['namespace'], self.tuner_no)
+        with InternalProxy.tuner_locks_lock:
+            lock = InternalProxy.tuner_locks.get(key)
+            if lock is None:
+                lock = InternalProxy.tuner_locks[key] = threading.Lock()
+            return lock
+
+    def start_m3u8_queue_locked(self):
         ch_num = self.channel_dict['display_number']
         namespace = self.channel_dict['namespace']
         scan_list = WebHTTPHandler.rmg_station_scans[namespace]
         tuner = scan_list[self.tuner_no]
-        m3u8_out_queue = None
-
-        if isinstance(tuner, dict) \
-                and tuner['ch'] == ch_num \
-                and tuner['instance'] == self.instance:
-
-            if not tuner['mux']:
-                # new tuner case
-                m3u8_out_queue = Queue(maxsize=MAX_OUT_QUEUE_SIZE)
-                self.t_queue = ThreadQueue(m3u8_out_queue, self.config)
-                self.t_queue.add_thread(threading.get_ident(), self.out_queue)
-                self.t_queue.status_queue = self.in_queue
-                WebHTTPHandler.rmg_station_scans[namespace][self.tuner_no]['mux'] = self.t_queue
-            else:
-                # reuse tuner case
-                self.t_queue = tuner['mux']
-                self.t_queue.add_thread(threading.get_ident(), self.out_queue)
-                self.t_m3u8 = self.t_queue.remote_proc
-                self.t_m3u8_pid = self.t_queue.remote_proc.pid
-                self.in_queue = self.t_queue.status_queue
-
-        while not is_running and restarts > 0:
-            restarts -= 1
-            # Process is not thread safe.  Must do the same target, one at a time.
+
+        if not isinstance(tuner, dict) \
+                or tuner['ch'] != ch_num \
+                or tuner['instance'] != self.instance:
+            return True
+
+        if tuner['mux']:
+            # reuse tuner case, the live segments are already flowing
+            self.buffered_segments = []
+            self.t_queue = tuner['mux']
+            self.t_queue.add_thread(threading.get_ident(), self.out_queue)
+            self.t_m3u8 = self.t_queue.remote_proc
+            self.t_m3u8_pid = self.t_queue.remote_proc.pid
+            self.in_queue = self.t_queue.status_queue
+            self.tunein_source = 'shared'
             self.in_queue.put({'thread_id': threading.get_ident(), 'uri': 'status'})
-            self.logger.debug('3 Requesting status from m3u8_queue {}'.format(self.t_m3u8_pid))
-
-            if m3u8_out_queue:
-                self.logger.debug('Starting m3u8 queue process')
-                self.t_m3u8 = Process(target=m3u8_queue.start, args=(
-                    self.config, self.plugins, self.in_queue, m3u8_out_queue, self.channel_dict,))
-                self.t_m3u8.start()
-                self.t_queue.remote_proc = self.t_m3u8
-                self.t_m3u8_pid = self.t_m3u8.pid
-
-                time.sleep(0.1)
-                tries = 0
-                # Some providers needs more than 8 seconds to start up. Change max_tries to 8 seconds
-                while self.out_queue.empty() and tries < max_tries:
-                    tries += 1
-                    time.sleep(0.2)
-                if tries >= max_tries:
-                    self.logger.notice('################# Forked process not responding, restarting')
-                    self.m3u8_terminate()
-                else:
-                    try:
-                        # queue is not empty, but it sticks here anyway...
-                        status = self.out_queue.get(False, 3)
-                    except queue.Empty as ex:
-                        self.logger.notice('Queue is empty, terminating  {}'.format(ex))
-                        self.m3u8_terminate()
-                        continue
+            return True
 
-                    if status['uri'] == 'terminate':
-                        self.logger.debug('Receive request to terminate from m3u8_queue {}'.format(self.t_m3u8_pid))
-                        InternalProxy.is_m3u8_starting = False
-                        return False
-                    elif status['uri'] == 'running':
-                        self.logger.debug('2 Status of Running returned from m3u8_queue {}'.format(self.t_m3u8_pid))
-                        is_running = True
-                    else:
-                        self.logger.warning(
-                            'Unknown response from m3u8queue: {}'
-                            .format(status['uri']))
+        # new tuner case
+        segment_ring = self.open_segment_ring()
+        if segment_ring is not None:
+            segment_ring_name = segment_ring.name
+        else:
+            segment_ring_name = None
+        buffered_paths = [segment['path'] for segment in self.buffered_segments]
+        m3u8_pool = M3U8Pool(self.plugins)
+        restarts = 5
+        while restarts > 0:
+            restarts -= 1
+            worker, is_warm = m3u8_pool.get_worker()
+            if worker is None:
+                break
+            self.t_m3u8 = worker.process
+            self.t_m3u8_pid = worker.pid
+            self.in_queue = worker.in_queue
+            self.out_queue = queue.Queue(maxsize=MAX_OUT_QUEUE_SIZE)
+            self.t_queue = ThreadQueue(worker.out_queue, self.config)
+            self.t_queue.add_thread(threading.get_ident(), self.out_queue)
+            self.t_queue.status_queue = self.in_queue
+            self.t_queue.segment_ring = segment_ring
+            self.t_queue.remote_proc = self.t_m3u8
+            self.tunein_source = 'pool' if is_warm else 'fork'
+            self.logger.debug('Starting m3u8 queue process {} warm={}'.format(self.t_m3u8_pid, is_warm))
+            status = None
+            if worker.assign(self.config, self.channel_dict, segment_ring_name, buffered_paths):
+                self.in_queue.put({'thread_id': threading.get_ident(), 'uri': 'status'})
+                self.logger.debug('3 Requesting status from m3u8_queue {}'.format(self.t_m3u8_pid))
+                try:
+                    # Some providers needs more than 8 seconds to start up
+                    status = self.out_queue.get(timeout=M3U8_START_TIMEOUT)
+                except queue.Empty:
+                    pass
+
+            if status is None:
+                self.logger.notice('################# m3u8 queue process not responding, restarting')
+                self.m3u8_terminate(worker)
+                continue
+            elif status['uri'] == 'terminate':
+                self.logger.debug('Receive request to terminate from m3u8_queue {}'.format(self.t_m3u8_pid))
+                return False
+            elif status['uri'] == 'running':
+                self.logger.debug('2 Status of Running returned from m3u8_queue {}'.format(self.t_m3u8_pid))
             else:
-                is_running = True
-
-        InternalProxy.is_m3u8_starting = False
-        return restarts > 0
+                self.logger.warning(
+                    'Unknown response from m3u8queue: {}'
+                    .format(status['uri']))
+            WebHTTPHandler.rmg_station_scans[namespace][self.tuner_no]['mux'] = self.t_queue
+            return True
+        if segment_ring is not None:
+            segment_ring.terminate()
+        return False
+
+    def open_segment_ring(self):
+        """
+        Creates the shared memory ring used by the m3u8_queue process
+        to pass the video segments to this process.  Returns None when
+        disabled or when the shared memory is not available, in which case
+        the segments are sent through the queue.
+        """
+        ring_size = self.config['stream'].get('segment_ring_size')
+        if not ring_size:
+            return None
+        try:
+            return SegmentRing(_size=ring_size * 1024 * 1024)
+        except (OSError, ValueError) as ex:
+            self.logger.warning('Unable to create segment ring, using queue instead {}'.format(ex))
+            return None
 
-    def m3u8_terminate(self):
-        while not self.in_queue.empty():
-            try:
-                self.in_queue.get()
-                time.sleep(0.1)
-            except (queue.Empty, EOFError):
-                pass
-        if self.t_m3u8:
-            self.t_m3u8.terminate()
-            self.t_m3u8.join()
+    def m3u8_terminate(self, _worker):
+        """
+        Stops an m3u8_queue process that did not start correctly.
+        The segment ring is kept for the next try
+        """
         self.logger.debug(
             'm3u8_queue did not start correctly, restarting {}'
             .format(self.channel_dict['uid']))
-        try:
-            while not self.out_queue.empty():
-                self.out_queue.get()
-        except (queue.Empty, EOFError):
-            pass
-        self.clear_queues()
+        self.t_queue.segment_ring = None
+        self.t_queue.terminate_requested = True
+        # wake the ThreadQueue so it sees the terminate request
+        _worker.out_queue.put({'thread_id': threading.get_ident(), 'uri': 'terminate'})
+        _worker.terminate()
+        self.t_m3u8 = None
+        self.t_queue = None
         time.sleep(0.1)
-        self.in_queue = Queue()
-        self.out_queue = queue.Queue(maxsize=MAX_OUT_QUEUE_SIZE)
-        self.t_queue.add_thread(threading.get_ident(), self.out_queue)
-        self.t_queue.status_queue = self.in_queue
@@ -0,0 +1,193 @@
+"""
+MIT License
+
+Copyright (C) 2023 ROCKY4546
+https://github.com/rocky4546
+
+This file is part of Cabernet
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+and associated documentation files (the "Software"), to deal in the Software without restriction,
+including without limitation the rights to use, copy, modify, merge, publish, distribute,
+sublicense, and/or sell copies of the Software, and to permit persons to whom the Software
+is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or
+substantial portions of the Software.
+"""
+
+import collections
+import logging
+import os
+import threading
+import time
+from multiprocessing import Pipe, Process, Queue
+
+import lib.streams.m3u8_queue as m3u8_queue
+
+# maximum number of items in the queue from the m3u8_queue process
+MAX_OUT_QUEUE_SIZE = 30
+# seconds to wait for a new worker to report it is ready
+WORKER_READY_TIMEOUT = 8
+# idle workers are replaced after this many seconds so they do not
+# hold a copy of the plugin state from long ago
+WORKER_MAX_IDLE = 900
+# seconds between checks of the idle workers
+MAINTENANCE_INTERVAL = 60
+
+
+class M3U8Worker:
+    """
+    A started m3u8_queue process waiting on its control pipe for a
+    channel.  The queues are created before the process is started,
+    since multiprocessing queues can only be passed to a new process.
+    """
+
+    def __init__(self, _plugins):
+        self.in_queue = Queue()
+        self.out_queue = Queue(maxsize=MAX_OUT_QUEUE_SIZE)
+        self.control_conn, child_conn = Pipe()
+        self.process = Process(target=m3u8_queue.start_worker, args=(
+            _plugins, child_conn, self.in_queue, self.out_queue, os.getpid()))
+        self.process.start()
+        child_conn.close()
+        self.start_time = time.monotonic()
+        self.is_ready = False
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def wait_ready(self, _timeout):
+        """
+        Returns True once the process has sent its ready message
+        """
+        if not self.is_ready:
+            try:
+                if self.control_conn.poll(_timeout):
+                    self.is_ready = self.control_conn.recv() == 'ready'
+            except (EOFError, OSError):
+                self.is_ready = False
+        return self.is_ready and self.process.is_alive()
+
+    def assign(self, _config, _channel_dict, _segment_ring_name, _buffered_paths):
+        """
+        Sends the channel to the worker, which then runs m3u8_queue.start().
+        Returns False when the worker is no longer listening
+        """
+        try:
+            self.control_conn.send({
+                'config': _config,
+                'channel_dict': _channel_dict,
+                'segment_ring_name': _segment_ring_name,
+                'buffered_paths': _buffered_paths})
+            return True
+        except (BrokenPipeError, EOFError, OSError):
+            return False
+        finally:
+            self.control_conn.close()
+
+    def terminate(self):
+        try:
+            self.control_conn.close()
+        except OSError:
+            pass
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join(timeout=5)
+
+
+class M3U8Pool:
+    """
+    Keeps stream-m3u8_pool_size m3u8_queue processes started and waiting
+    for a tune request, so a new tuner does not wait on a process start.
+    Workers are used once.  The pool is refilled in the background.
+    """
+    lock = threading.Lock()
+    idle = collections.deque()
+    plugins = None
+    maintenance = None
+    wakeup = threading.Event()
+
+    def __init__(self, _plugins):
+        self.logger = logging.getLogger(__name__)
+        M3U8Pool.plugins = _plugins
+
+    def start(self):
+        """
+        Starts the thread that fills the pool and replaces old workers
+        """
+        with M3U8Pool.lock:
+            if M3U8Pool.maintenance is not None:
+                return
+            M3U8Pool.maintenance = threading.Thread(
+                target=self.run_maintenance, name='M3U8Pool', daemon=True)
+            M3U8Pool.maintenance.start()
+
+    def run_maintenance(self):
+        while True:
+            M3U8Pool.wakeup.clear()
+            try:
+                self.retire_workers()
+                self.fill()
+            except Exception as ex:
+                self.logger.exception('{}{}'.format(
+                    'UNEXPECTED EXCEPTION in m3u8 pool=', ex))
+            M3U8Pool.wakeup.wait(MAINTENANCE_INTERVAL)
+
+    def get_pool_size(self):
+        return M3U8Pool.plugins.config_obj.data['stream'].get('m3u8_pool_size', 0)
+
+    def fill(self):
+        while True:
+            with M3U8Pool.lock:
+                if len(M3U8Pool.idle) >= self.get_pool_size():
+                    return
+            worker = M3U8Worker(M3U8Pool.plugins)
+            if not worker.wait_ready(WORKER_READY_TIMEOUT):
+                self.logger.notice('m3u8 pool worker not responding, trying again later {}'.format(worker.pid))
+                worker.terminate()
+                return
+            with M3U8Pool.lock:
+                M3U8Pool.idle.append(worker)
+            self.logger.debug('m3u8 pool worker ready {}'.format(worker.pid))
+
+    def retire_workers(self):
+        now = time.monotonic()
+        retired = []
+        with M3U8Pool.lock:
+            for worker in list(M3U8Pool.idle):
+                if now - worker.start_time > WORKER_MAX_IDLE \
+                        or not worker.process.is_alive() \
+                        or len(M3U8Pool.idle) > self.get_pool_size():
+                    M3U8Pool.idle.remove(worker)
+                    retired.append(worker)
+        for worker in retired:
+            self.logger.debug('Retiring idle m3u8 pool worker {}'.format(worker.pid))
+            worker.terminate()
+
+    def get_worker(self):
+        """
+        Returns a ready worker and whether it came from the pool.  Starts a
+        new worker when the pool is empty.  Returns (None, False) when no
+        worker could be started
+        """
+        worker = None
+        with M3U8Pool.lock:
+            while M3U8Pool.idle:
+                worker = M3U8Pool.idle.popleft()
+                if worker.process.is_alive():
+                    break
+                worker = None
+        if self.get_pool_size():
+            self.start()
+            M3U8Pool.wakeup.set()
+        if worker is not None:
+            return worker, True
+        for i in range(5):
+            worker = M3U8Worker(M3U8Pool.plugins)
+            if worker.wait_ready(WORKER_READY_TIMEOUT):
+                return worker, False
+            self.logger.notice('################# Forked process not responding, restarting')
+            worker.terminate()
+        return None, False
@@ -18,6 +18,7 @@ substantial portions of the Software.
 
 import logging
 import os
+import queue
 import re
 import requests
 import requests.exceptions
@@ -41,12 +42,16 @@ from lib.db.db_channels import DBChannels
 from lib.common.decorators import handle_url_except
 from lib.common.decorators import handle_json_except
 from lib.streams.atsc import ATSCMsg
+from lib.streams.http_session_pool import HTTPSessionPool
+from lib.streams.segment_ring import SegmentRing
 from lib.streams.video import Video
 from .pts_validation import PTSValidation
 from .pts_resync import PTSResync
 
 
 PLAY_LIST = OrderedDict()
+# uri -> PLAY_LIST key, used to rename the keys after a discontinuity
+PLAY_LIST_URIS = {}
 PROCESSED_URLS = {}
 IN_QUEUE = Queue()
 OUT_QUEUE = Queue()
@@ -61,40 +66,66 @@ PARALLEL_DOWNLOADS=3
 IS_VOD = False
 UID_COUNTER = 1
 UID_PROCESSED = 1
+SEGMENT_RING = None
+HTTP_SESSION_POOL = HTTPSessionPool()
+# uri paths already sent to the client from the time-shift buffer
+BUFFERED_PATHS = set()
+# guards PROCESSED_URLS, UID_PROCESSED and IS_SENDING and is notified
+# each time a worker finishes a segment
+PROCESSED_CONDITION = threading.Condition()
+# set while a worker is sending the segments that are next in line
+IS_SENDING = False
+WORK_QUEUE = queue.Queue()
 
 class M3U8GetUriData(Thread):
-    def __init__(self, _queue_item, _uid_counter, _config):
-        global TERMINATE_REQUESTED
+    """
+    Worker thread that downloads and processes the segments placed
+    in WORK_QUEUE.  A fixed pool of workers is started by M3U8Queue,
+    so the Video and PTSValidation objects are reused for each segment.
+    """
+
+    def __init__(self, _m3u8_queue, _config):
         Thread.__init__(self)
-        self.queue_item = _queue_item
-        self.uid_counter = _uid_counter
+        self.daemon = True
+        self.m3u8_queue = _m3u8_queue
+        self.queue_item = None
+        self.uid_counter = None
         self.video = Video(_config)
         self.config = _config
         self.logger = logging.getLogger(__name__ + str(threading.get_ident()))
         self.pts_validation = None
         if _config[M3U8Queue.config_section]['player-enable_pts_filter']:
             self.pts_validation = PTSValidation(_config, M3U8Queue.channel_dict)
-        if not TERMINATE_REQUESTED:
-            self.start()
+        self.start()
 
     def run(self):
-        global UID_COUNTER
-        global UID_PROCESSED
-        global STREAM_QUEUE
         global TERMINATE_REQUESTED
-        self.logger.trace('M3U8GetUriData started {} {} {}'.format(self.queue_item['data']['uri'], os.getpid(), threading.get_ident()))
-        m3u8_data = self.process_m3u8_item(self.queue_item)
-        if not TERMINATE_REQUESTED:
-            PROCESSED_URLS[self.uid_counter] = m3u8_data
-            STREAM_QUEUE.put({'uri_dt': 'check_processed_list'})
-        self.logger.trace('M3U8GetUriData terminated COUNTER {} {} {}'.format(self.uid_counter, os.getpid(), threading.get_ident()))
-        m3u8_data = None
-        self.queue_item = None
-        self.uid_counter = None
-        self.video = None
-        self.pts_validation = None
-        self.logger = None
-
+        while not TERMINATE_REQUESTED:
+            work_item = WORK_QUEUE.get()
+            if work_item is None:
+                break
+            self.queue_item, self.uid_counter = work_item
+            self.logger.trace('M3U8GetUriData started {} {} {}'.format(self.queue_item['data']['uri'], os.getpid(), threading.get_ident()))
+            try:
+                m3u8_data = self.process_m3u8_item(self.queue_item)
+            except Exception as ex:
+                # keep the worker running and skip the segment so the
+                # segments after it are not held in the reorder buffer
+                self.logger.exception('{}'.format(
+                    'UNEXPECTED EXCEPTION M3U8GetUriData='))
+                m3u8_data = None
+            try:
+                if not TERMINATE_REQUESTED:
+                    self.m3u8_queue.add_processed(self.uid_counter, m3u8_data)
+            except Exception as ex:
+                self.logger.exception('{}'.format(
+                    'UNEXPECTED EXCEPTION M3U8GetUriData add_processed='))
+            self.logger.trace('M3U8GetUriData finished COUNTER {} {} {}'.format(self.uid_counter, os.getpid(), threading.get_ident()))
+            m3u8_data = None
+            self.queue_item = None
+            self.uid_counter = None
+            self.video.data = None
+        self.logger.trace('M3U8GetUriData terminated {} {}'.format(os.getpid(), threading.get_ident()))
 
     @handle_url_except()
     def get_uri_data(self, _uri, _retries, _header=None):
@@ -104,25 +135,26 @@ class M3U8GetUriData(Thread):
         global HTTP_TIMEOUT
         global MAINTAIN_HTTP_SESSION
         if not MAINTAIN_HTTP_SESSION:
-            M3U8Queue.http_session.close()
-            time.sleep(0.01)
-            M3U8Queue.http_session = requests.session()
+            HTTP_SESSION_POOL.evict(_uri)
         if _header:
             header = _header.copy()
         else:
             header = M3U8Queue.http_header.copy()
         self.logger.trace('HTTP HEADER: {}  URI: {}'.format(header, _uri))
-        resp = M3U8Queue.http_session.get(_uri, headers=header, timeout=HTTP_TIMEOUT, verify=False)
+        try:
+            resp = HTTP_SESSION_POOL.get_session(_uri).get(_uri, headers=header, timeout=HTTP_TIMEOUT, verify=False)
+        except requests.exceptions.RequestException:
+            HTTP_SESSION_POOL.report_failure(_uri)
+            raise
         x = resp.content
         try:
             resp.raise_for_status()
         except (requests.exceptions.HTTPError, urllib.error.HTTPError) as ex:
             self.logger.warning('Error: Will refreshing session   {}'.format(ex))
-            M3U8Queue.http_session.close()
-            time.sleep(0.01)
-            M3U8Queue.http_session = requests.session()
+            HTTP_SESSION_POOL.report_failure(_uri)
             time.sleep(2.0)
             raise ex
+        HTTP_SESSION_POOL.report_success(_uri)
         return x
 
     def decrypt_stream(self, _data):
@@ -206,6 +238,9 @@ class M3U8GetUriData(Thread):
     def is_pts_valid(self):
         if self.pts_validation is None:
             return True
+        # the worker handles segments out of playback order, so the pts
+        # from its previous segment is not the one just before this one
+        self.pts_validation.reset()
         results = self.pts_validation.check_pts(self.video)
         if results['byteoffset'] != 0:
             return False
@@ -310,7 +345,6 @@ class M3U8Queue(Thread):
     output to the client.
     """
     is_stuck = None
-    http_session = requests.session()
     http_header = None
     key_list = {}
     config_section = None
@@ -327,7 +361,7 @@ class M3U8Queue(Thread):
         # Disable the CERT unverified warnings
         requests.packages.urllib3.disable_warnings()
         self.video = Video(_config)
-        self.q_action = None
+        self.workers = []
         self.logger = logging.getLogger(__name__ + str(threading.get_ident()))
         self.config = _config
         self.namespace = _channel_dict['namespace'].lower()
@@ -347,6 +381,8 @@ class M3U8Queue(Thread):
             self.use_date_on_key = _channel_dict['json']['use_date_on_m3u8_key']
 
         M3U8Queue.pts_resync = PTSResync(_config, self.config_section, _channel_dict['uid'])
+        for i in range(max(PARALLEL_DOWNLOADS, 1)):
+            self.workers.append(M3U8GetUriData(self, _config))
         self.start()
 
 
@@ -362,7 +398,6 @@ class M3U8Queue(Thread):
         try:
             while not TERMINATE_REQUESTED:
                 queue_item = STREAM_QUEUE.get()
-                self.q_action = queue_item['uri_dt']
                 if queue_item['uri_dt'] == 'terminate':
                     self.logger.debug('Received terminate from internalproxy {}'.format(os.getpid()))
                     TERMINATE_REQUESTED = True
@@ -374,33 +409,20 @@ class M3U8Queue(Thread):
                                    'stream': None,
                                    'atsc': None})
                     continue
-                elif queue_item['uri_dt'] == 'check_processed_list':
-                    self.logger.trace('#### Received check_processed_list request {}  Received: {}  Processed: {}  Processed_Queue: {}  Incoming_Queue: {}'
-                        .format(os.getpid(), UID_COUNTER, UID_PROCESSED, len(PROCESSED_URLS), STREAM_QUEUE.qsize()))
-                    self.check_processed_list()
-                    continue
 
-                self.logger.trace('**** Running check_processed_list {}  Received: {}  Processed: {}  Processed_Queue: {}  Incoming_Queue: {}'
-                    .format(os.getpid(), UID_COUNTER, UID_PROCESSED, len(PROCESSED_URLS), STREAM_QUEUE.qsize()))
-                self.check_processed_list()
-                while UID_COUNTER - UID_PROCESSED - len(PROCESSED_URLS) > PARALLEL_DOWNLOADS:
-                    self.logger.trace('Slowed Processing: {}  Received: {}  Processed: {}  Processed_Queue: {}  Incoming_Queue: {}'
-                        .format(os.getpid(), UID_COUNTER, UID_PROCESSED, len(PROCESSED_URLS), STREAM_QUEUE.qsize()))
-                    time.sleep(0.4)
-                    self.check_processed_list()
-                    if TERMINATE_REQUESTED:
-                        break
-
-                self.process_queue = M3U8GetUriData(queue_item, UID_COUNTER, self.config)
-                if IS_VOD:
-                    time.sleep(0.1)
-                elif queue_item['data']['duration']:
-                    time.sleep(queue_item['data']['duration']/4)
-                else:
-                    time.sleep(0.1)
+                with PROCESSED_CONDITION:
+                    while UID_COUNTER - UID_PROCESSED - len(PROCESSED_URLS) > PARALLEL_DOWNLOADS \
+                            and not TERMINATE_REQUESTED:
+                        self.logger.trace('Slowed Processing: {}  Received: {}  Processed: {}  Processed_Queue: {}  Incoming_Queue: {}'
+                            .format(os.getpid(), UID_COUNTER, UID_PROCESSED, len(PROCESSED_URLS), STREAM_QUEUE.qsize()))
+                        PROCESSED_CONDITION.wait(1.0)
+                if TERMINATE_REQUESTED:
+                    break
+                WORK_QUEUE.put((queue_item, UID_COUNTER))
                 UID_COUNTER += 1
         except (KeyboardInterrupt, EOFError) as ex:
             TERMINATE_REQUESTED = True
+            self.stop_workers()
             clear_queues()
             if self.pts_resync is not None:
                 self.pts_resync.terminate()
@@ -409,6 +431,7 @@ class M3U8Queue(Thread):
             sys.exit()
         except Exception as ex:
             TERMINATE_REQUESTED = True
+            self.stop_workers()
             STREAM_QUEUE.put({'uri_dt': 'terminate'})
             IN_QUEUE.put({'uri': 'terminate'})
             if self.pts_resync is not None:
@@ -419,6 +442,7 @@ class M3U8Queue(Thread):
             self.logger.exception('{}'.format(
                 'UNEXPECTED EXCEPTION M3U8Queue='))
             sys.exit()
+        self.stop_workers()
         # we are terminating so cleanup ffmpeg
         if self.pts_resync is not None:
             self.pts_resync.terminate()
@@ -434,24 +458,73 @@ class M3U8Queue(Thread):
         self.logger.debug('M3U8Queue terminated {}'.format(os.getpid()))
 
 
+    def stop_workers(self):
+        clear_q(WORK_QUEUE)
+        for worker in self.workers:
+            WORK_QUEUE.put(None)
+        with PROCESSED_CONDITION:
+            PROCESSED_CONDITION.notify_all()
+
+    def add_processed(self, _uid, _m3u8_data):
+        """
+        Called by the workers.  Stores the segment in the reorder buffer
+        and sends every segment that is now next in line.
+        """
+        with PROCESSED_CONDITION:
+            PROCESSED_URLS[_uid] = _m3u8_data
+            PROCESSED_CONDITION.notify_all()
+        self.check_processed_list()
+
     def check_processed_list(self):
+        """
+        Sends the segments that are next in line.  Only one worker sends
+        at a time so the order is kept.  The pts resync and the queue put
+        run without holding PROCESSED_CONDITION, so the other workers and
+        the dispatcher are not blocked by a slow resync or a full OUT_QUEUE.
+        A segment counts as in progress until it has been sent.
+        """
         global UID_PROCESSED
         global PROCESSED_URLS
-        if len(PROCESSED_URLS) > 0:
-            first_key = sorted(PROCESSED_URLS.keys())[0]
-            if first_key == UID_PROCESSED:
-                try:
-                    self.video.data = PROCESSED_URLS[first_key]['stream']
-                    M3U8Queue.pts_resync.resequence_pts(self.video)
-                    if self.video.data is None and self.q_action != 'check_processed_list':
-                        PLAY_LIST[self.q_action]['played'] = True
-                    PROCESSED_URLS[first_key]['stream'] = self.video.data
-                    out_queue_put(PROCESSED_URLS[first_key])
-                    del PROCESSED_URLS[first_key]
-                    UID_PROCESSED += 1
-                except TypeError as ex:
-                    # If the first_key is null, then skip it and move on.
-                    UID_PROCESSED += 1
+        global IS_SENDING
+        with PROCESSED_CONDITION:
+            if IS_SENDING:
+                # the sending worker checks for more segments before it stops
+                return
+            IS_SENDING = True
+        while True:
+            with PROCESSED_CONDITION:
+                if UID_PROCESSED not in PROCESSED_URLS:
+                    IS_SENDING = False
+                    return
+                m3u8_data = PROCESSED_URLS.pop(UID_PROCESSED)
+            self.send_processed(m3u8_data)
+            with PROCESSED_CONDITION:
+                UID_PROCESSED += 1
+                PROCESSED_CONDITION.notify_all()
+
+    def send_processed(self, _m3u8_data):
+        """
+        Resyncs the pts and sends the segment.  Errors are logged so
+        the sending worker keeps running
+        """
+        if _m3u8_data is None:
+            # segment was removed from the PLAY_LIST or failed to process
+            return
+        try:
+            if M3U8Queue.pts_resync is not None:
+                self.video.data = _m3u8_data['stream']
+                M3U8Queue.pts_resync.resequence_pts(self.video)
+                _m3u8_data['stream'] = self.video.data
+        except Exception as ex:
+            self.logger.exception('{}'.format(
+                'UNEXPECTED EXCEPTION pts resync, sending segment as is='))
+        finally:
+            self.video.data = None
+        try:
+            out_queue_put(_m3u8_data)
+        except Exception as ex:
+            self.logger.exception('{}'.format(
+                'UNEXPECTED EXCEPTION M3U8Queue out_queue_put='))
 
 class M3U8Process(Thread):
     """
@@ -473,6 +546,8 @@ class M3U8Process(Thread):
 
         self.ch_uid = _channel_dict['uid']
         self.is_starting = True
+        # media sequence number of the last segment in the PLAY_LIST
+        self.last_sequence = None
         self.last_refresh = time.time()
         HTTP_TIMEOUT = self.config[_channel_dict['namespace'].lower()]['stream-g_http_timeout']
         HTTP_RETRIES = self.config[_channel_dict['namespace'].lower()]['stream-g_http_retries']
@@ -554,9 +629,7 @@ class M3U8Process(Thread):
                 if playlist is None:
                     self.logger.debug('M3U Playlist is None, retrying')
                     count = count - 1
-                    M3U8Queue.http_session.close()
-                    time.sleep(0.01)
-                    M3U8Queue.http_session = requests.session()
+                    HTTP_SESSION_POOL.report_failure(self.stream_uri)
                     continue
                 self.logger.trace('2 M3U8: {}'.format(playlist.segments))
                 count = 4
@@ -567,17 +640,16 @@ class M3U8Process(Thread):
                 elif IS_VOD:
                     self.logger.debug('Setting stream type to non-VOD {}'.format(os.getpid()))
                     IS_VOD = False
-                removed += self.remove_from_stream_queue(playlist)
-                num_added = self.add_to_stream_queue(playlist)
+                segment_keys = [self.get_uri_dt(segment) for segment in playlist.segments]
+                removed += self.remove_from_stream_queue(playlist, segment_keys)
+                num_added = self.add_to_stream_queue(playlist, segment_keys)
                 # Reset HTTP session if m3u8 is not changing
                 if num_added == 0:
                     zero_added += 1
                     if zero_added == 2:
                         zero_added = 0
                         self.logger.warning('No change in m3u8 load, resetting session')
-                        M3U8Queue.http_session.close()
-                        time.sleep(0.01)
-                        M3U8Queue.http_session = requests.session()
+                        HTTP_SESSION_POOL.evict(self.stream_uri)
                 added += num_added
 
                 if self.plugins.plugins[self.channel_dict['namespace']].plugin_obj \
@@ -630,11 +702,10 @@ class M3U8Process(Thread):
         # it sticks here.  Need to find a work around for the socket.timeout per process
         global MAINTAIN_HTTP_SESSION
         if not MAINTAIN_HTTP_SESSION:
-            M3U8Queue.http_session.close()
-            time.sleep(0.01)
-            M3U8Queue.http_session = requests.session()
+            HTTP_SESSION_POOL.evict(_uri)
         self.logger.trace('M3U8 HEADER: {} {}'.format(M3U8Queue.http_header, _uri))
-        return m3u8.load(_uri, timeout=3, headers=M3U8Queue.http_header, http_session=M3U8Queue.http_session)
+        return m3u8.load(_uri, timeout=3, headers=M3U8Queue.http_header,
+                         http_session=HTTP_SESSION_POOL.get_session(_uri))
 
     def segment_date_time(self, _segment):
         if _segment:
@@ -643,19 +714,35 @@ class M3U8Process(Thread):
             return None
         return _segment.current_program_date_time.replace(microsecond=0)
 
-    def add_to_stream_queue(self, _playlist):
+    def get_uri_dt(self, _segment):
+        """
+        Returns the PLAY_LIST key for the segment
+        """
+        if self.use_full_duplicate_checking:
+            uri = _segment.absolute_uri
+        elif self.use_pathonly_checking:
+            uri = urllib.parse.urlparse(_segment.absolute_uri).path
+        else:
+            uri = _segment.get_path_from_uri()
+        if self.use_date_on_key:
+            return uri, self.segment_date_time(_segment)
+        else:
+            return uri, 0
+
+    def get_segment_key(self, _segment):
+        if _segment.key:
+            return {"uri": _segment.key.absolute_uri, "method": _segment.key.method, "iv": _segment.key.iv}
+        return None
+
+    def add_to_stream_queue(self, _playlist, _segment_keys):
+        """
+        _segment_keys are the PLAY_LIST keys for the playlist segments, so
+        each key is only computed once per reload
+        """
         global PLAY_LIST
         global STREAM_QUEUE
         global TERMINATE_REQUESTED
         total_added = 0
-        if _playlist.keys != [None]:
-            keys = [{"uri": key.absolute_uri, "method": key.method, "iv": key.iv}
-                    for key in _playlist.keys if key]
-            if len(keys) != len(_playlist.segments):
-                keys = [{"uri": keys[0]['uri'], "method": keys[0]['method'], "iv": keys[0]['iv']}
-                        for i in range(0, len(_playlist.segments))]
-        else:
-            keys = [None for i in range(0, len(_playlist.segments))]
         num_segments = len(_playlist.segments)
         if self.is_starting and not self.config[self.config_section]['player-play_all_segments']:
             seg_to_play = self.config[self.config_section]['player-segments_to_play']
@@ -665,81 +752,78 @@ class M3U8Process(Thread):
                 seg_to_play = num_segments
 
             skipped_seg = num_segments - seg_to_play
-            # total_added += self.add_segment(_playlist.segments[0], keys[0])
-
-            for m3u8_segment, key in zip(_playlist.segments[0:skipped_seg], keys[0:skipped_seg]):
-                if m3u8_segment.key:
-                    key2 = {"uri": m3u8_segment.key.absolute_uri, "method": m3u8_segment.key.method, "iv": m3u8_segment.key.iv}
-                else:
-                    key2=None
-                total_added += self.add_segment(m3u8_segment, key2, _default_played=True)
-            for i in range(skipped_seg, num_segments):
-                if _playlist.segments[i].key:
-                    key = {"uri": _playlist.segments[i].key.absolute_uri, "method": _playlist.segments[i].key.method, "iv": _playlist.segments[i].key.iv}
-                else:
-                    key=None
-                total_added += self.add_segment(_playlist.segments[i], key)
+            for i in range(num_segments):
+                total_added += self.add_segment(
+                    _playlist.segments[i], self.get_segment_key(_playlist.segments[i]),
+                    _default_played=i < skipped_seg, _uri_dt=_segment_keys[i])
+            self.set_last_sequence(_playlist, _segment_keys, num_segments - 1)
             self.is_starting = False
         else:
-            key_list = list(PLAY_LIST.keys())
-            if len(key_list) == 0:
-                i = 0
-            else:
-                last_key = list(PLAY_LIST.keys())[-1]
-                i = 0
-                for index, segment in enumerate(reversed(_playlist.segments)):
-                    if self.use_full_duplicate_checking:
-                        uri = segment.absolute_uri
-                    elif self.use_pathonly_checking:
-                        uri = urllib.parse.urlparse(segment.absolute_uri).path
-                    else:
-                        uri = segment.get_path_from_uri()
-                    dt = self.segment_date_time(segment)
-                    if self.use_date_on_key:
-                        uri_dt = (uri, dt)
-                    else:
-                        uri_dt = (uri, 0)
-                    if last_key == uri_dt:
-                        i = num_segments - index
-            for m3u8_segment, key in zip(
-                    _playlist.segments[i:num_segments], keys[i:num_segments]):
-                if m3u8_segment.key:
-                    key2 = {"uri": m3u8_segment.key.absolute_uri, "method": m3u8_segment.key.method, "iv": m3u8_segment.key.iv}
-                else:
-                    key2 = None
-                added = self.add_segment(m3u8_segment, key2)
+            i = self.get_next_index(_playlist, _segment_keys)
+            last_index = i - 1
+            for index in range(i, num_segments):
+                added = self.add_segment(
+                    _playlist.segments[index], self.get_segment_key(_playlist.segments[index]),
+                    _uri_dt=_segment_keys[index])
+                last_index = index
                 total_added += added
                 if added == 0 or TERMINATE_REQUESTED:
                     break
+            self.set_last_sequence(_playlist, _segment_keys, last_index)
             time.sleep(0.1)
         return total_added
 
-    def add_segment(self, _segment, _key, _default_played=False):
-        global TERMINATE_REQUESTED
-        self.set_cue_status(_segment)
-        if self.use_full_duplicate_checking:
-            uri = _segment.absolute_uri
-        elif self.use_pathonly_checking:
-            uri = urllib.parse.urlparse(_segment.absolute_uri).path
-        else:
-            uri = _segment.get_path_from_uri()
-
+    def get_next_index(self, _playlist, _segment_keys):
+        """
+        Returns the index of the first playlist segment after the last one
+        in the PLAY_LIST.  Uses the media sequence when it still matches the
+        PLAY_LIST, otherwise searches the playlist from the end
+        """
+        if not PLAY_LIST:
+            return 0
+        last_key = next(reversed(PLAY_LIST))
+        num_segments = len(_segment_keys)
+        if self.last_sequence is not None and _playlist.media_sequence is not None:
+            index = self.last_sequence - _playlist.media_sequence
+            if 0 <= index < num_segments and _segment_keys[index] == last_key:
+                return index + 1
+        for index in range(num_segments - 1, -1, -1):
+            if _segment_keys[index] == last_key:
+                return index + 1
+        return 0
 
+    def set_last_sequence(self, _playlist, _segment_keys, _index):
+        """
+        Keeps the media sequence of the segment at _index when it is the
+        last one in the PLAY_LIST
+        """
+        self.last_sequence = None
+        if _index < 0 or _playlist.media_sequence is None or not PLAY_LIST:
+            return
+        if _segment_keys[_index] == next(reversed(PLAY_LIST)):
+            self.last_sequence = _playlist.media_sequence + _index
 
+    def add_segment(self, _segment, _key, _default_played=False, _uri_dt=None):
+        global TERMINATE_REQUESTED
         uri_full = _segment.absolute_uri
-        dt = self.segment_date_time(_segment)
-        if self.use_date_on_key:
-            uri_dt = (uri, dt)
+        if _uri_dt is None:
+            uri_dt = self.get_uri_dt(_segment)
         else:
-            uri_dt = (uri, 0)
-        if uri_dt not in PLAY_LIST.keys():
+            uri_dt = _uri_dt
+        if uri_dt not in PLAY_LIST:
             played = _default_played
+            if not played and urllib.parse.urlparse(uri_full).path in BUFFERED_PATHS:
+                self.logger.debug('Skipping {}, already sent from time-shift buffer {}'
+                                  .format(uri_full, os.getpid()))
+                played = True
             filtered = False
             cue_status = self.set_cue_status(_segment)
             if self.file_filter is not None:
                 m = self.file_filter.match(urllib.parse.unquote(uri_full))
                 if m:
                     filtered = True
+            if PLAY_LIST_URIS.get(uri_dt[0]) not in PLAY_LIST:
+                PLAY_LIST_URIS[uri_dt[0]] = uri_dt
             PLAY_LIST[uri_dt] = {
                 'uid': self.channel_dict['uid'],
                 'uri': uri_full,
@@ -770,68 +854,66 @@ class M3U8Process(Thread):
 
         return 0
 
-    def remove_from_stream_queue(self, _playlist):
+    def remove_from_stream_queue(self, _playlist, _segment_keys):
+        """
+        Removes the played segments at the front of the PLAY_LIST that are
+        no longer in the playlist.  Stops at the first one still listed.
+        """
         global PLAY_LIST
         total_removed = 0
         if _playlist.discontinuity_sequence is not None:
             disc_index = 0
             total_index = len(_playlist.segments)
-            url_list = [key[0] for key in PLAY_LIST]
             for i, segment in enumerate(reversed(_playlist.segments)):
                 if segment.discontinuity:
                     disc_index = total_index - i
                     break
-            for segment in _playlist.segments[disc_index:total_index]:
-                if self.use_full_duplicate_checking:
-                    s_uri = segment.absolute_uri
-                elif self.use_pathonly_checking:
-                    s_uri = urllib.parse.urlparse(segment.absolute_uri).path
-                else:
-                    s_uri = segment.get_path_from_uri()
-                s_dt = self.segment_date_time(segment)
-                if self.use_date_on_key:
-                    s_key = (s_uri, s_dt)
-                else:
-                    s_key = (s_uri, 0)
-
-                if s_key in PLAY_LIST.keys():
+            renames = {}
+            for s_key in _segment_keys[disc_index:total_index]:
+                if s_key in PLAY_LIST:
                     continue
-                else:
-                    try:
-                        i = url_list.index(s_uri)
-                        PLAY_LIST = utils.rename_dict_key(list(PLAY_LIST.keys())[i], s_key, PLAY_LIST)
-                    except ValueError as ex:
-                        # not in list
-                        pass
-
-        for segment_key in list(PLAY_LIST.keys()):
-            is_found = False
-            for segment_m3u8 in _playlist.segments:
-                if self.use_full_duplicate_checking:
-                    s_uri = segment_m3u8.absolute_uri
-                elif self.use_pathonly_checking:
-                    s_uri = urllib.parse.urlparse(segment_m3u8.absolute_uri).path
-                else:
-                    s_uri = segment_m3u8.get_path_from_uri()
-                s_dt = self.segment_date_time(segment_m3u8)
-                if self.use_date_on_key:
-                    s_key = (s_uri, s_dt)
-                else:
-                    s_key = (s_uri, 0)
-                if segment_key == s_key:
-                    is_found = True
-                    break
-            if not is_found:
-                if PLAY_LIST[segment_key]['played']:
-                    del PLAY_LIST[segment_key]
-                    total_removed += 1
-                    self.logger.debug('Removed {} from play queue {}'
-                                      .format(segment_key[0], os.getpid()))
-                continue
-            else:
+                old_key = PLAY_LIST_URIS.get(s_key[0])
+                if old_key is not None and old_key in PLAY_LIST and old_key not in renames:
+                    renames[old_key] = s_key
+                    PLAY_LIST_URIS[s_key[0]] = s_key
+            if renames:
+                self.rename_play_list_keys(renames)
+
+        playlist_keys = set(_segment_keys)
+        removed_keys = []
+        for segment_key, segment in PLAY_LIST.items():
+            if segment_key in playlist_keys:
                 break
+            if segment['played']:
+                removed_keys.append(segment_key)
+        for segment_key in removed_keys:
+            del PLAY_LIST[segment_key]
+            if PLAY_LIST_URIS.get(segment_key[0]) == segment_key:
+                del PLAY_LIST_URIS[segment_key[0]]
+            total_removed += 1
+            self.logger.debug('Removed {} from play queue {}'
+                              .format(segment_key[0], os.getpid()))
         return total_removed
 
+    def rename_play_list_keys(self, _renames):
+        """
+        Renames the PLAY_LIST keys in _renames (old key -> new key) in one
+        pass.  The entries from the first renamed key on are moved to the
+        end in order, so the PLAY_LIST keeps its order and is not rebuilt
+        for each key.  Entries that are not renamed stay in the PLAY_LIST
+        while they are moved.
+        """
+        is_moving = False
+        for key in list(PLAY_LIST):
+            if not is_moving:
+                if key not in _renames:
+                    continue
+                is_moving = True
+            if key in _renames:
+                PLAY_LIST[_renames[key]] = PLAY_LIST.pop(key)
+            else:
+                PLAY_LIST.move_to_end(key)
+
     def set_cue_status(self, _segment):
         if _segment.cue_out_start:
             return 'out'
@@ -862,30 +944,91 @@ def clear_queues():
     clear_q(IN_QUEUE)
 
 def out_queue_put(data_dict):
+    """
+    When the segment ring is available, the video stream is written once
+    into shared memory and only the descriptor is queued for each client thread.
+    Each client gets its own copy of the dict since the queue pickles
+    the item in a background thread.  Segment items also carry the
+    HTTP session counters shown on /tunerstatus.
+    """
     global OUT_QUEUE
-    logger = logging.getLogger(__name__)
+    segment_ring = SEGMENT_RING
+    if segment_ring is not None and data_dict.get('stream'):
+        descr = segment_ring.put(data_dict['stream'])
+        if descr is not None:
+            data_dict['stream'] = None
+            data_dict['ring'] = descr
+    if data_dict.get('data') is not None:
+        data_dict['http_stats'] = HTTP_SESSION_POOL.get_stats()
     for t in OUT_QUEUE_LIST:
-        data_dict['thread_id'] = t
-        OUT_QUEUE.put(data_dict)
-        time.sleep(0.01)
+        OUT_QUEUE.put(dict(data_dict, thread_id=t))
 
 
-def start(_config, _plugins, _m3u8_queue, _data_queue, _channel_dict, extra=None):
+def close_segment_ring():
+    """
+    Closes this process's attach to the segment ring.  The tuner process
+    owns the ring and unlinks it
+    """
+    global SEGMENT_RING
+    segment_ring = SEGMENT_RING
+    SEGMENT_RING = None
+    if segment_ring is not None:
+        segment_ring.terminate()
+
+
+def start_worker(_plugins, _control_conn, _m3u8_queue, _data_queue, _parent_pid):
+    """
+    Entry point for the processes in the M3U8Pool.  Sets up logging, reports
+    ready on the control pipe and waits for a channel.  Exits when the
+    tuner process goes away or the pipe is closed before a channel is sent.
+    """
+    try:
+        utils.logging_setup(_plugins.config_obj.data)
+        _control_conn.send('ready')
+        while not _control_conn.poll(5):
+            if os.getppid() != _parent_pid:
+                sys.exit()
+        assignment = _control_conn.recv()
+        _control_conn.close()
+    except (EOFError, OSError, KeyboardInterrupt):
+        sys.exit()
+    start(assignment['config'], _plugins, _m3u8_queue, _data_queue,
+          assignment['channel_dict'], assignment['segment_ring_name'],
+          assignment['buffered_paths'], _is_logging_setup=True)
+
+
+def start(_config, _plugins, _m3u8_queue, _data_queue, _channel_dict, _segment_ring_name=None,
+          _buffered_paths=None, extra=None, _is_logging_setup=False):
     """
     All items in this process must handle a socket timeout of 5.0
+    _segment_ring_name is the shared memory name used to pass the video
+    segments back to the tuner process.  If None, segments are sent through the queue.
+    _buffered_paths are the uri paths the tuner already sent from its
+    time-shift buffer, so they are not downloaded again.
     """
     global IN_QUEUE
     global STREAM_QUEUE
     global OUT_QUEUE
     global TERMINATE_REQUESTED
+    global SEGMENT_RING
     logger = None
     try:
-        utils.logging_setup(_plugins.config_obj.data)
+        if not _is_logging_setup:
+            utils.logging_setup(_plugins.config_obj.data)
         logger = logging.getLogger(__name__)
         socket.setdefaulttimeout(5.0)
         IN_QUEUE = _m3u8_queue
         STREAM_QUEUE = Queue(maxsize=MAX_STREAM_QUEUE_SIZE)
         OUT_QUEUE = _data_queue
+        if _buffered_paths:
+            BUFFERED_PATHS.update(_buffered_paths)
+        HTTP_SESSION_POOL.pool_size = _config['stream']['http_pool_size']
+        if _segment_ring_name is not None:
+            try:
+                SEGMENT_RING = SegmentRing(_name=_segment_ring_name)
+            except FileNotFoundError as ex:
+                logger.warning('Unable to attach to segment ring, using queue instead {}'.format(ex))
+                SEGMENT_RING = None
         p_m3u8 = M3U8Process(_config, _plugins, _channel_dict)
         while not TERMINATE_REQUESTED:
             try:
@@ -919,11 +1062,7 @@ def start(_config, _plugins, _m3u8_queue, _data_queue, _channel_dict, extra=None
                     time.sleep(0.01)
                 elif q_item['uri'] == 'restart_http':
                     logger.debug('HTTP Session restarted {}'.format(os.getpid()))
-                    temp_session = M3U8Queue.http_session
-                    M3U8Queue.http_session = requests.session()
-                    temp_session.close()
-                    temp_session = None
-                    time.sleep(0.01)
+                    HTTP_SESSION_POOL.reset()
                 else:
                     logger.debug('UNKNOWN m3u8 queue request {}'.format(q_item['uri']))
             except (KeyboardInterrupt, EOFError, TypeError, ValueError) as ex:
@@ -955,3 +1094,5 @@ def start(_config, _plugins, _m3u8_queue, _data_queue, _channel_dict, extra=None
         TERMINATE_REQUESTED = True
         logger.debug('2 m3u8_queue process terminated {}'.format(os.getpid()))
         sys.exit()
+    finally:
+        close_segment_ring()
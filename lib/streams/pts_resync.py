@@ -23,8 +23,15 @@ import subprocess
 import time
 from threading import Thread
 
+import lib.streams.ts_scanner as ts_scanner
 from .stream_queue import StreamQueue
 
+# jumps in the video DTS larger than this (10 seconds in 90kHz ticks) or any
+# backwards jump is treated as a discontinuity, same threshold ffmpeg uses
+MAX_DTS_GAP = 900000
+# frame duration assumed until two video frames have been seen (29.97fps)
+DEFAULT_FRAME_DURATION = 3003
+
 
 class PTSResync:
 
@@ -37,12 +44,15 @@ class PTSResync:
         self.is_looping = False
         self.id = _id
         self.ffmpeg_proc = None
-        if self.config[self.config_section]['player-enable_pts_resync']:
-            if self.config[self.config_section]['player-pts_resync_type'] == 'ffmpeg':
-                self.ffmpeg_proc = self.open_ffmpeg_proc()
+        self.video_pid = None
+        self.last_dts = None
+        self.pts_offset = 0
+        self.frame_duration = DEFAULT_FRAME_DURATION
+        if self.config[self.config_section]['player-enable_pts_resync'] \
+                and self.config[self.config_section]['player-pts_resync_type'] == 'ffmpeg':
+            self.ffmpeg_proc = self.open_ffmpeg_proc()
             self.stream_queue = StreamQueue(188, self.ffmpeg_proc, _id)
-            if self.config[self.config_section]['player-pts_resync_type'] == 'ffmpeg':
-                self.logger.debug('PTS Resync running ffmpeg')
+            self.logger.debug('PTS Resync running ffmpeg')
 
     def video_to_stdin(self, _video):
         video_copy = copy.copy(_video.data)
@@ -123,11 +133,113 @@ class PTSResync:
 
             _video.data = new_video
         elif self.config[self.config_section]['player-pts_resync_type'] == 'internal':
-            self.logger.warning('player-pts_resync_type internal NOT IMPLEMENTED')
+            self.resequence_internal(_video)
         else:
             self.logger.error('player-pts_resync_type UNKNOWN TYPE {}'.format(
                 self.config[self.config_section]['player-pts_resync_type']))
 
+    def resequence_internal(self, _video):
+        """
+        Rewrites the PTS/DTS in the PES headers and the PCR of each packet
+        in place so the timestamps continue from the previous segment.
+        The offset applied only changes when the video DTS jumps, so a
+        continuous stream passes through with only the DTS being checked.
+        """
+        if isinstance(_video.data, bytearray):
+            data = _video.data
+        else:
+            data = bytearray(_video.data)
+            _video.data = data
+
+        first_dts = self.first_video_dts(data)
+        if first_dts is None:
+            self.video_pid = ts_scanner.find_video_pid(data)
+            first_dts = self.first_video_dts(data)
+            if first_dts is None:
+                self.logger.debug('PTS Resync unable to find video PES, passing segment through')
+                return
+        self.check_discontinuity(first_dts)
+
+        data_len = len(data) - ts_scanner.TS_PACKET_SIZE
+        i = 0
+        while i <= data_len:
+            pid = ts_scanner.packet_pid(data, i)
+            if pid is None or pid == ts_scanner.NULL_PID:
+                i += ts_scanner.TS_PACKET_SIZE
+                continue
+            if self.pts_offset:
+                pcr = ts_scanner.pcr_offset(data, i)
+                if pcr is not None:
+                    ts_scanner.encode_pcr_base(
+                        data, pcr, ts_scanner.decode_pcr_base(data, pcr) + self.pts_offset)
+            if data[i + 1] & 0x40:
+                start = ts_scanner.payload_offset(data, i)
+                end = i + ts_scanner.TS_PACKET_SIZE
+                if start is not None and start + 9 <= end \
+                        and data[start:start + 3] == b'\x00\x00\x01' \
+                        and data[start + 6] & 0xC0 == 0x80:
+                    self.update_pes_timestamps(data, start, end, pid)
+            i += ts_scanner.TS_PACKET_SIZE
+
+    def update_pes_timestamps(self, _data, _start, _end, _pid):
+        """
+        Rewrites the PTS/DTS of the PES header at _start.  _end is the end
+        of the TS packet, timestamps past it are left alone
+        """
+        pts_dts_flags = _data[_start + 7] >> 6
+        if not pts_dts_flags & 0x02 or _start + 14 > _end:
+            return
+        has_dts = pts_dts_flags == 3 and _start + 19 <= _end
+        if _pid == self.video_pid:
+            if has_dts:
+                self.check_discontinuity(ts_scanner.decode_timestamp(_data, _start + 14))
+            else:
+                self.check_discontinuity(ts_scanner.decode_timestamp(_data, _start + 9))
+        if not self.pts_offset:
+            return
+        ts_scanner.encode_timestamp(
+            _data, _start + 9, ts_scanner.decode_timestamp(_data, _start + 9) + self.pts_offset)
+        if has_dts:
+            ts_scanner.encode_timestamp(
+                _data, _start + 14, ts_scanner.decode_timestamp(_data, _start + 14) + self.pts_offset)
+
+    def first_video_dts(self, _data):
+        """
+        Returns the DTS (or PTS) of the first video PES in the buffer
+        """
+        if self.video_pid is None:
+            return None
+        data_len = len(_data) - ts_scanner.TS_PACKET_SIZE
+        i = 0
+        while i <= data_len:
+            if ts_scanner.packet_pid(_data, i) == self.video_pid and _data[i + 1] & 0x40:
+                start = ts_scanner.payload_offset(_data, i)
+                if start is not None and start + 19 <= i + ts_scanner.TS_PACKET_SIZE \
+                        and _data[start:start + 3] == b'\x00\x00\x01' \
+                        and _data[start + 7] & 0x80:
+                    if _data[start + 7] & 0x40:
+                        return ts_scanner.decode_timestamp(_data, start + 14)
+                    return ts_scanner.decode_timestamp(_data, start + 9)
+            i += ts_scanner.TS_PACKET_SIZE
+        return None
+
+    def check_discontinuity(self, _dts):
+        """
+        Updates the offset when the input DTS is not continuous with the
+        previous one so the output continues one frame after the last output DTS
+        """
+        if self.last_dts is not None and _dts != self.last_dts:
+            delta = (_dts - self.last_dts) % ts_scanner.PTS_ROLLOVER
+            if delta > MAX_DTS_GAP:
+                new_offset = (self.last_dts + self.pts_offset + self.frame_duration - _dts) \
+                    % ts_scanner.PTS_ROLLOVER
+                self.logger.debug('PTS Resync discontinuity found, offset changed from {} to {}'
+                                  .format(self.pts_offset, new_offset))
+                self.pts_offset = new_offset
+            else:
+                self.frame_duration = delta
+        self.last_dts = _dts
+
     def terminate(self):
         if self.ffmpeg_proc is not None:
             self.stream_queue.terminate()
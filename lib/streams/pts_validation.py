@@ -16,11 +16,10 @@ The above copyright notice and this permission notice shall be included in all c
 substantial portions of the Software.
 """
 
-import json
 import logging
-import subprocess
 
 import lib.common.utils as utils
+import lib.streams.ts_scanner as ts_scanner
 
 
 class PTSValidation:
@@ -46,6 +45,14 @@ class PTSValidation:
         self.config_section = utils.instance_config_section(
             self.channel_dict['namespace'], self.channel_dict['instance'])
 
+    def reset(self):
+        """
+        Clears the values kept from the previous check, so each segment
+        is checked on its own
+        """
+        self.prev_last_pts = 0
+        self.default_duration = 0
+
     def check_pts(self, _video):
         """
         Checks the PTS in the video stream.  If a bad PTS packet is found, 
@@ -216,18 +223,12 @@ class PTSValidation:
         return byte_offset
 
     def get_probe_results(self, _video):
-        ffprobe_command = [self.config['paths']['ffprobe_path'],
-                           '-print_format', 'json',
-                           '-v', 'quiet', '-show_packets',
-                           '-select_streams', 'v:0',
-                           '-show_entries', 'side_data=:packet=pts,pos,duration,size',
-                           '-']
-        cmdpts = subprocess.Popen(ffprobe_command,
-                                  stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-        ptsout = cmdpts.communicate(_video.data)[0]
-        exit_code = cmdpts.wait()
-        if exit_code != 0:
-            self.logger.warning('FFPROBE failed to execute with error code: {}'
-                                .format(exit_code))
+        """
+        Scans the segment in-process for the video PES packets and returns
+        the results in the same layout as "ffprobe -show_packets -print_format json"
+        """
+        packets = ts_scanner.get_pes_packets(_video.data)
+        if packets is None:
+            self.logger.debug('No video stream found in segment, unable to check PTS')
             return None
-        return json.loads(ptsout)
+        return {'packets': packets}
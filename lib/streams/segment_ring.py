@@ -0,0 +1,151 @@
+"""
+MIT License
+
+Copyright (C) 2023 ROCKY4546
+https://github.com/rocky4546
+
+This file is part of Cabernet
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+and associated documentation files (the "Software"), to deal in the Software without restriction,
+including without limitation the rights to use, copy, modify, merge, publish, distribute,
+sublicense, and/or sell copies of the Software, and to permit persons to whom the Software
+is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or
+substantial portions of the Software.
+"""
+
+import logging
+import os
+import shutil
+import struct
+from multiprocessing import resource_tracker
+from multiprocessing import shared_memory
+
+# write_pos, read_pos, capacity
+HEADER_FMT = '!QQQ'
+HEADER_SIZE = struct.calcsize(HEADER_FMT)
+SHM_FOLDER = '/dev/shm'
+
+
+class SegmentRing:
+    """
+    Shared memory ring buffer used to move video segments from the
+    m3u8_queue process to the tuner process without pickling them
+    through the multiprocessing queue.  The m3u8_queue process is the only
+    writer and the ThreadQueue in the tuner process is the only reader.
+    Only a small descriptor {'offset', 'length'} travels over the queue.
+    The header holds monotonic byte counters for the writer and reader, so
+    the free space is always capacity - (write_pos - read_pos).
+    """
+
+    def __init__(self, _size=0, _name=None):
+        self.logger = logging.getLogger(__name__)
+        self.last_offset = None
+        self.last_data = None
+        if _name is None:
+            if os.path.isdir(SHM_FOLDER) \
+                    and shutil.disk_usage(SHM_FOLDER).free < _size + HEADER_SIZE:
+                raise OSError('Not enough space in {} for a segment ring of {} bytes'
+                              .format(SHM_FOLDER, _size))
+            self.shm = shared_memory.SharedMemory(create=True, size=_size + HEADER_SIZE)
+            self.is_owner = True
+            struct.pack_into(HEADER_FMT, self.shm.buf, 0, 0, 0, _size)
+        else:
+            self.shm = self.attach(_name)
+            self.is_owner = False
+        self.capacity = struct.unpack_from(HEADER_FMT, self.shm.buf, 0)[2]
+
+    def attach(self, _name):
+        """
+        Attaches to the ring created by another process.  The attach is not
+        tracked, otherwise a resource tracker started by this process unlinks
+        the ring when this process exits while the owner is still using it
+        """
+        try:
+            return shared_memory.SharedMemory(name=_name, track=False)
+        except TypeError:
+            pass
+        # before python 3.13 the attach is always registered.  When the
+        # tracker is shared with the owner, the entry is the owner's and is kept
+        is_tracker_shared = getattr(resource_tracker._resource_tracker, '_fd', None) is not None
+        shm = shared_memory.SharedMemory(name=_name)
+        if not is_tracker_shared:
+            try:
+                resource_tracker.unregister(shm._name, 'shared_memory')
+            except (AttributeError, OSError) as ex:
+                self.logger.debug('Unable to unregister segment ring attach {}'.format(ex))
+        return shm
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def put(self, _data):
+        """
+        Writes the data into the ring and returns the descriptor.
+        Returns None when the ring does not have room for the data,
+        in which case the caller should send the data inline.
+        """
+        length = len(_data)
+        write_pos, read_pos, capacity = struct.unpack_from(HEADER_FMT, self.shm.buf, 0)
+        if length == 0 or length > capacity - (write_pos - read_pos):
+            return None
+        start = write_pos % capacity
+        first_part = min(length, capacity - start)
+        buf = self.shm.buf
+        data = memoryview(_data)
+        buf[HEADER_SIZE + start:HEADER_SIZE + start + first_part] = data[:first_part]
+        if first_part < length:
+            buf[HEADER_SIZE:HEADER_SIZE + length - first_part] = data[first_part:]
+        struct.pack_into('!Q', buf, 0, write_pos + length)
+        return {'offset': write_pos, 'length': length}
+
+    def get(self, _descr):
+        """
+        Returns the bytes referenced by the descriptor and releases the
+        space back to the writer.  The same segment is sent once per client
+        thread, so the last segment read is kept to avoid a second copy.
+        """
+        offset = _descr['offset']
+        length = _descr['length']
+        if offset == self.last_offset:
+            return self.last_data
+        buf = self.shm.buf
+        read_pos = struct.unpack_from('!Q', buf, 8)[0]
+        if offset + length <= read_pos:
+            self.logger.warning('Segment already released from the ring, dropping offset {}'
+                                .format(offset))
+            return None
+        start = offset % self.capacity
+        first_part = min(length, self.capacity - start)
+        if first_part < length:
+            data = b''.join([
+                buf[HEADER_SIZE + start:HEADER_SIZE + self.capacity],
+                buf[HEADER_SIZE:HEADER_SIZE + length - first_part]])
+        else:
+            data = bytes(buf[HEADER_SIZE + start:HEADER_SIZE + start + length])
+        struct.pack_into('!Q', buf, 8, offset + length)
+        self.last_offset = offset
+        self.last_data = data
+        return data
+
+    def terminate(self):
+        """
+        Closes the ring.  The owner always unlinks it, even when close()
+        fails because a view of the buffer is still in use, so the
+        segment is not left in /dev/shm
+        """
+        self.last_offset = None
+        self.last_data = None
+        try:
+            self.shm.close()
+        except BufferError as ex:
+            self.logger.debug('Segment ring still in use, unable to close {}'.format(ex))
+        finally:
+            if self.is_owner:
+                try:
+                    self.shm.unlink()
+                except FileNotFoundError as ex:
+                    self.logger.debug('Segment ring already released {}'.format(ex))
@@ -17,6 +17,8 @@ substantial portions of the Software.
 """
 
 import logging
+import threading
+import time
 
 from lib.web.pages.templates import web_templates
 from lib.clients.web_handler import WebHTTPHandler
@@ -25,6 +27,9 @@ import lib.common.utils as utils
 
 class Stream:
     logger = None
+    # 'namespace:instance:channel' -> tune-in latency stats in seconds
+    tunein_stats = {}
+    tunein_lock = threading.Lock()
 
     def __init__(self, _plugins, _hdhr_queue):
         self.plugins = _plugins
@@ -32,6 +37,10 @@ class Stream:
         self.instance = ''
         self.config = self.plugins.config_obj.data
         self.hdhr_queue = _hdhr_queue
+        # time the tune request was received, cleared once the first byte is sent
+        self.tunein_start = None
+        # how the stream was started, used in the tune-in stats
+        self.tunein_source = 'proxy'
         if Stream.logger is None:
             Stream.logger = logging.getLogger(__name__)
 
@@ -96,6 +105,7 @@ class Stream:
         """
         self.namespace = _namespace
         self.instance = _instance
+        self.tunein_start = time.monotonic()
         i = self.find_tuner(_namespace, _instance, _ch_num, _isvod)
         if i >= 0:
             return {
@@ -113,6 +123,47 @@ class Stream:
                 'headers': {'Content-type': 'text/html'},
                 'text': web_templates['htmlError'].format('400 - All tuners already in use.')}
 
+    def record_tunein(self, _channel_dict, _tuner_no):
+        """
+        Records the time from the tune request to the first video
+        data sent to the client.  Only the first call per request counts
+        """
+        if self.tunein_start is None:
+            return
+        latency = round(time.monotonic() - self.tunein_start, 3)
+        self.tunein_start = None
+        key = '{}:{}:{}'.format(_channel_dict['namespace'], _channel_dict['instance'],
+                                _channel_dict['display_number'])
+        with Stream.tunein_lock:
+            stats = Stream.tunein_stats.get(key)
+            if stats is None:
+                stats = Stream.tunein_stats[key] = {
+                    'count': 0, 'total': 0.0, 'min': latency, 'max': latency}
+            stats['count'] += 1
+            stats['total'] += latency
+            stats['min'] = min(stats['min'], latency)
+            stats['max'] = max(stats['max'], latency)
+            stats['last'] = latency
+            stats['source'] = self.tunein_source
+        tuner = WebHTTPHandler.rmg_station_scans[_channel_dict['namespace']][_tuner_no]
+        if isinstance(tuner, dict) and tuner['ch'] == _channel_dict['display_number']:
+            tuner['tunein'] = latency
+        self.logger.info('{}:{} ch:{} tune-in {:.2f}s ({})'
+                         .format(_channel_dict['namespace'], _channel_dict['instance'],
+                                 _channel_dict['display_number'], latency, self.tunein_source))
+
+    @classmethod
+    def get_tunein_stats(cls):
+        with cls.tunein_lock:
+            return {key: {
+                'count': stats['count'],
+                'last': stats['last'],
+                'avg': round(stats['total'] / stats['count'], 3),
+                'min': stats['min'],
+                'max': stats['max'],
+                'source': stats['source']}
+                for key, stats in cls.tunein_stats.items()}
+
     @property
     def config_section(self):
         return utils.instance_config_section(self.namespace, self.instance)
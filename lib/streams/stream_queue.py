@@ -17,63 +17,137 @@ substantial portions of the Software.
 """
 
 import logging
-import time
+import threading
 from threading import Thread
 
+# packets in each readinto() from the process
+PACKETS_PER_READ = 348
+# number of reads the ring buffer holds
+RING_READS = 128
+# seconds read_view() waits to collect a full read before returning what is available
+READ_WAIT = 0.1
+# seconds without new data before read() returns
+QUIET_TIME = 0.1
+
 
 class StreamQueue:
     """
     This works when we run a process that has an output of a continuous stream.
     Used with ffmpeg and streamlink
+    The stdout of the process is read in large blocks with readinto() into a
+    preallocated ring buffer.  Readers are signaled with a condition variable.
+    Data is returned in whole packets of _bytes_per_read bytes.
     """
 
     def __init__(self, _bytes_per_read, _proc, _stream_id):
         self.logger = logging.getLogger(__name__)
         self.bytes_per_read = _bytes_per_read
+        self.read_size = _bytes_per_read * PACKETS_PER_READ
+        self.ring = bytearray(self.read_size * RING_READS)
+        self.ring_view = memoryview(self.ring)
+        self.cond = threading.Condition()
+        # total bytes written to and released from the ring
+        self.write_pos = 0
+        self.read_pos = 0
+        # end of the region returned by read_view(), released on the next read
+        self.view_end = 0
         self.sout = _proc.stdout
         self.serr = _proc.stderr
-        self.queue = []
         self.proc = _proc
         self.stream_id = _stream_id
         self.is_terminated = False
 
         def _populate_queue():
             """
-            Collect lines from 'stream' and put them in 'queue'.
+            Collect blocks from 'stream' and put them in the ring buffer.
             """
+            readinto = getattr(self.sout, 'readinto1', None)
+            if readinto is None:
+                readinto = self.sout.readinto
             while not self.is_terminated:
+                with self.cond:
+                    while len(self.ring) - (self.write_pos - self.read_pos) == 0 \
+                            and not self.is_terminated:
+                        self.cond.wait()
+                    if self.is_terminated:
+                        break
+                    start = self.write_pos % len(self.ring)
+                    length = min(len(self.ring) - (self.write_pos - self.read_pos),
+                                 len(self.ring) - start, self.read_size)
                 try:
-                    self.sout.flush()
-                    video_data = self.sout.read(self.bytes_per_read)
-                    if video_data:
-                        self.queue.append(video_data)
+                    num_bytes = readinto(self.ring_view[start:start + length])
+                except ValueError:
+                    # occurs on termination with buffer must not be NULL
+                    num_bytes = 0
+                with self.cond:
+                    if num_bytes:
+                        self.write_pos += num_bytes
+                        # only wake read_view() once a full block is ready
+                        if self.write_pos - self.read_pos >= self.read_size:
+                            self.cond.notify_all()
                     else:
                         self.logger.debug('Stream ended for this process, exiting queue thread')
                         self.is_terminated = True
-                        break
-                except ValueError:
-                    # occurs on termination with buffer must not be NULL
-                    self.is_terminated = True
-                    break
+                        self.cond.notify_all()
         self._t = Thread(target=_populate_queue, args=())
         self._t.daemon = True
         self._t.start()  # start collecting blocks from the stream
 
     def read(self):
-        is_queue_changing = True
-        queue_size = len(self.queue)
-        while is_queue_changing:
-            time.sleep(0.1)
-            if len(self.queue) != queue_size:
-                queue_size = len(self.queue)
-            else:
-                is_queue_changing = False
-        
-        if len(self.queue) > 0:
-            clone_queue = self.queue.copy()
-            del self.queue[:len(clone_queue)]
-            return b''.join(clone_queue)
-        return None
-        
+        """
+        Waits until the process stops sending data and returns everything
+        received as bytes.  Returns None when there is no data
+        """
+        with self.cond:
+            self.read_pos = self.view_end
+            self.cond.notify_all()
+            write_pos = self.write_pos
+            while not self.is_terminated:
+                self.cond.wait(QUIET_TIME)
+                if self.write_pos == write_pos:
+                    break
+                write_pos = self.write_pos
+            size = self.get_available()
+            if not size:
+                return None
+            start = self.read_pos % len(self.ring)
+            first_part = min(size, len(self.ring) - start)
+            data = b''.join([self.ring_view[start:start + first_part],
+                             self.ring_view[0:size - first_part]])
+            self.read_pos += size
+            self.view_end = self.read_pos
+            self.cond.notify_all()
+        return data
+
+    def read_view(self):
+        """
+        Returns a memoryview of the packets received, waiting up to READ_WAIT
+        seconds for a full read_size block.  The view is only valid until the
+        next read, when its part of the ring buffer is reused.
+        Returns None when there is no data
+        """
+        with self.cond:
+            self.read_pos = self.view_end
+            self.cond.notify_all()
+            self.cond.wait_for(
+                lambda: self.get_available() >= self.read_size or self.is_terminated,
+                READ_WAIT)
+            size = self.get_available()
+            if not size:
+                return None
+            start = self.read_pos % len(self.ring)
+            size = min(size, len(self.ring) - start)
+            self.view_end = self.read_pos + size
+        return self.ring_view[start:start + size]
+
+    def get_available(self):
+        """
+        Returns the number of bytes in whole packets waiting to be read
+        """
+        size = self.write_pos - self.read_pos
+        return size - size % self.bytes_per_read
+
     def terminate(self):
-        self.is_terminated = True
+        with self.cond:
+            self.is_terminated = True
+            self.cond.notify_all()
@@ -47,6 +47,8 @@ class ThreadQueue(Thread):
         self._remote_proc = None
         # incoming queue to the process, stored locally
         self._status_queue = None
+        # shared memory ring the process writes the video segments into
+        self._segment_ring = None
         self.start()
 
     def __str__(self):
@@ -72,6 +74,8 @@ class ThreadQueue(Thread):
                 if queue_item.get('uri') == 'terminate':
                     time.sleep(self.config['stream']['switch_channel_timeout'])
                     self.del_thread(thread_id, True)
+                if queue_item.get('ring') is not None and self._segment_ring is not None:
+                    queue_item['stream'] = self._segment_ring.get(queue_item['ring'])
                 out_queue = self.queue_list.get(thread_id)
                 if out_queue:
                     # Define the length of sleep to keep the queues from becoming full
@@ -102,6 +106,9 @@ class ThreadQueue(Thread):
 
         self.clear_queues()
         self.terminate_requested = True
+        if self._segment_ring is not None:
+            self._segment_ring.terminate()
+            self._segment_ring = None
         self.logger.debug('ThreadQueue terminated')
 
     def clear_queues(self):
@@ -198,3 +205,14 @@ class ThreadQueue(Thread):
     @status_queue.setter
     def status_queue(self, _queue):
         self._status_queue = _queue
+
+    @property
+    def segment_ring(self):
+        """
+        shared memory ring used by the remote process to send the video segments
+        """
+        return self._segment_ring
+
+    @segment_ring.setter
+    def segment_ring(self, _ring):
+        self._segment_ring = _ring
@@ -0,0 +1,83 @@
+"""
+MIT License
+
+Copyright (C) 2023 ROCKY4546
+https://github.com/rocky4546
+
+This file is part of Cabernet
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+and associated documentation files (the "Software"), to deal in the Software without restriction,
+including without limitation the rights to use, copy, modify, merge, publish, distribute,
+sublicense, and/or sell copies of the Software, and to permit persons to whom the Software
+is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or
+substantial portions of the Software.
+"""
+
+import logging
+import threading
+import time
+import urllib.parse
+from collections import deque, OrderedDict
+
+
+class TimeShiftBuffer:
+    """
+    Keeps the last few minutes of segments served for the most recently
+    watched channels in memory.  The buffers are shared by all the tuners
+    in the process, so when a client re-tunes a channel within the window,
+    the stream starts from the buffered segments and those segments are
+    not downloaded again.
+    """
+    buffers = OrderedDict()
+    lock = threading.Lock()
+
+    def __init__(self, _config, _channel_dict):
+        self.logger = logging.getLogger(__name__)
+        self.max_seconds = _config['stream']['timeshift_minutes'] * 60
+        self.max_channels = _config['stream']['timeshift_channels']
+        self.key = (_channel_dict['namespace'], _channel_dict['instance'], _channel_dict['uid'])
+
+    def add(self, _uri, _duration, _data):
+        """
+        Adds the segment to the end of the channel buffer and drops the
+        oldest segments and channels that no longer fit
+        """
+        if not self.max_seconds or not self.max_channels or not _data:
+            return
+        path = urllib.parse.urlparse(_uri).path
+        with TimeShiftBuffer.lock:
+            segments = TimeShiftBuffer.buffers.get(self.key)
+            if segments is None:
+                segments = deque()
+                TimeShiftBuffer.buffers[self.key] = segments
+            TimeShiftBuffer.buffers.move_to_end(self.key)
+            if segments and segments[-1]['path'] == path:
+                # another client on the same tuner already added it
+                return
+            segments.append({
+                'path': path,
+                'duration': _duration or 0,
+                'data': _data,
+                'time': time.monotonic()})
+            total_seconds = sum(segment['duration'] for segment in segments)
+            while len(segments) > 1 and total_seconds > self.max_seconds:
+                total_seconds -= segments.popleft()['duration']
+            while len(TimeShiftBuffer.buffers) > self.max_channels:
+                TimeShiftBuffer.buffers.popitem(last=False)
+
+    def get_recent(self, _count, _max_age):
+        """
+        Returns up to the last _count segments for the channel, oldest first.
+        Returns an empty list when the newest segment is older than _max_age
+        seconds, since the live playlist has moved past the buffer.
+        """
+        with TimeShiftBuffer.lock:
+            segments = TimeShiftBuffer.buffers.get(self.key)
+            if not segments or _count < 1:
+                return []
+            if time.monotonic() - segments[-1]['time'] > _max_age:
+                return []
+            return list(segments)[-_count:]
@@ -0,0 +1,310 @@
+"""
+MIT License
+
+Copyright (C) 2023 ROCKY4546
+https://github.com/rocky4546
+
+This file is part of Cabernet
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+and associated documentation files (the "Software"), to deal in the Software without restriction,
+including without limitation the rights to use, copy, modify, merge, publish, distribute,
+sublicense, and/or sell copies of the Software, and to permit persons to whom the Software
+is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or
+substantial portions of the Software.
+"""
+
+# In-process MPEG-TS helpers used on the streaming path instead of
+# running ffprobe/ffmpeg for each segment.
+
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+PAT_PID = 0x0000
+NULL_PID = 0x1FFF
+PTS_ROLLOVER = 1 << 33
+
+# keeps the TEI bit and the PID bits of the second header byte so packets
+# flagged with a transport error never match a PID in find_pid_packets
+PID_HI_MASK = bytes(b & 0x9F for b in range(256))
+
+# stream types found in the PMT that ffprobe would report as video
+VIDEO_STREAM_TYPES = (0x01, 0x02, 0x10, 0x1B, 0x24, 0x42, 0xD1, 0xEA)
+
+
+def packet_pid(_data, _offset):
+    """
+    Returns the PID of the packet at _offset or None if the sync byte is missing
+    """
+    if _data[_offset] != TS_SYNC_BYTE:
+        return None
+    return ((_data[_offset + 1] & 0x1F) << 8) | _data[_offset + 2]
+
+
+def find_pid_packets(_data, _pids, _max_packets=None):
+    """
+    Returns the offsets of the packets whose PID is in _pids in stream order.
+    The PID bytes of every packet are gathered with strided slices, so the
+    search itself runs with bytes.find instead of a Python loop per packet.
+    Packets with the transport error indicator set are skipped.
+    """
+    num_packets = len(_data) // TS_PACKET_SIZE
+    if _max_packets is not None:
+        num_packets = min(num_packets, _max_packets)
+    if num_packets == 0:
+        return []
+    data = memoryview(_data)[:num_packets * TS_PACKET_SIZE]
+    pid_bytes = bytearray(num_packets * 2)
+    pid_bytes[0::2] = bytes(data[1::TS_PACKET_SIZE]).translate(PID_HI_MASK)
+    pid_bytes[1::2] = data[2::TS_PACKET_SIZE]
+    offsets = []
+    for pid in _pids:
+        target = bytes([pid >> 8, pid & 0xFF])
+        idx = pid_bytes.find(target)
+        while idx != -1:
+            if idx % 2 == 0 and _data[idx * (TS_PACKET_SIZE // 2)] == TS_SYNC_BYTE:
+                offsets.append(idx * (TS_PACKET_SIZE // 2))
+            idx = pid_bytes.find(target, idx + 1)
+    offsets.sort()
+    return offsets
+
+
+def payload_offset(_data, _offset):
+    """
+    Returns the offset of the payload within the buffer for the packet
+    at _offset or None if the packet has no payload
+    """
+    afc = (_data[_offset + 3] & 0x30) >> 4
+    if afc == 2:
+        return None
+    if afc == 3:
+        start = _offset + 5 + _data[_offset + 4]
+    else:
+        start = _offset + 4
+    if start >= _offset + TS_PACKET_SIZE:
+        return None
+    return start
+
+
+def decode_timestamp(_data, _offset):
+    """
+    Decodes the 33-bit PTS/DTS value stored in 5 bytes at _offset
+    """
+    return ((_data[_offset] & 0x0E) << 29) \
+        | (_data[_offset + 1] << 22) \
+        | ((_data[_offset + 2] & 0xFE) << 14) \
+        | (_data[_offset + 3] << 7) \
+        | (_data[_offset + 4] >> 1)
+
+
+def encode_timestamp(_data, _offset, _value):
+    """
+    Writes the 33-bit PTS/DTS value into the 5 bytes at _offset of a
+    bytearray, keeping the prefix nibble and marker bits already present
+    """
+    _value %= PTS_ROLLOVER
+    _data[_offset] = (_data[_offset] & 0xF1) | ((_value >> 29) & 0x0E)
+    _data[_offset + 1] = (_value >> 22) & 0xFF
+    _data[_offset + 2] = (_data[_offset + 2] & 0x01) | ((_value >> 14) & 0xFE)
+    _data[_offset + 3] = (_value >> 7) & 0xFF
+    _data[_offset + 4] = (_data[_offset + 4] & 0x01) | ((_value << 1) & 0xFE)
+
+
+def pcr_offset(_data, _offset):
+    """
+    Returns the offset of the PCR within the buffer for the packet
+    at _offset or None if the packet does not carry a PCR
+    """
+    if not _data[_offset + 3] & 0x20 \
+            or _data[_offset + 4] < 7 \
+            or not _data[_offset + 5] & 0x10:
+        return None
+    return _offset + 6
+
+
+def decode_pcr_base(_data, _offset):
+    """
+    Decodes the 33-bit 90kHz base of the PCR stored at _offset
+    """
+    return (_data[_offset] << 25) \
+        | (_data[_offset + 1] << 17) \
+        | (_data[_offset + 2] << 9) \
+        | (_data[_offset + 3] << 1) \
+        | (_data[_offset + 4] >> 7)
+
+
+def encode_pcr_base(_data, _offset, _value):
+    """
+    Writes the 33-bit 90kHz PCR base at _offset of a bytearray,
+    leaving the reserved bits and the 27MHz extension as is
+    """
+    _value %= PTS_ROLLOVER
+    _data[_offset] = (_value >> 25) & 0xFF
+    _data[_offset + 1] = (_value >> 17) & 0xFF
+    _data[_offset + 2] = (_value >> 9) & 0xFF
+    _data[_offset + 3] = (_value >> 1) & 0xFF
+    _data[_offset + 4] = (_data[_offset + 4] & 0x7F) | ((_value & 0x01) << 7)
+
+
+def get_pcr_duration(_data):
+    """
+    Returns the number of seconds between the first and last PCR in the
+    buffer or None when fewer than two PCRs are found
+    """
+    first_pcr = None
+    last_pcr = None
+    data_len = len(_data) - TS_PACKET_SIZE
+    i = 0
+    while i <= data_len:
+        if _data[i] == TS_SYNC_BYTE:
+            offset = pcr_offset(_data, i)
+            if offset is not None:
+                last_pcr = decode_pcr_base(_data, offset)
+                if first_pcr is None:
+                    first_pcr = last_pcr
+        i += TS_PACKET_SIZE
+    if first_pcr is None or last_pcr == first_pcr:
+        return None
+    return ((last_pcr - first_pcr) % PTS_ROLLOVER) / 90000
+
+
+def psi_section(_data, _offset):
+    """
+    Returns (start, end) of the PSI section carried in the packet at _offset,
+    end excludes the CRC.  Returns None when the packet does not start a section
+    or the section does not fit within the packet.
+    """
+    if not _data[_offset + 1] & 0x40:
+        return None
+    start = payload_offset(_data, _offset)
+    if start is None:
+        return None
+    start += 1 + _data[start]
+    if start + 3 > _offset + TS_PACKET_SIZE:
+        return None
+    section_length = ((_data[start + 1] & 0x0F) << 8) | _data[start + 2]
+    end = start + 3 + section_length - 4
+    if end > _offset + TS_PACKET_SIZE:
+        return None
+    return start, end
+
+
+def find_pmt_pids(_data):
+    """
+    Returns the list of PMT PIDs listed in the first PAT found in the buffer
+    """
+    data_len = len(_data) - TS_PACKET_SIZE
+    i = 0
+    while i <= data_len:
+        if packet_pid(_data, i) == PAT_PID:
+            section = psi_section(_data, i)
+            if section is not None:
+                start, end = section
+                pids = []
+                for j in range(start + 8, end - 3, 4):
+                    program_number = (_data[j] << 8) | _data[j + 1]
+                    if program_number != 0:
+                        pids.append(((_data[j + 2] & 0x1F) << 8) | _data[j + 3])
+                return pids
+        i += TS_PACKET_SIZE
+    return []
+
+
+def find_video_pid(_data):
+    """
+    Returns the PID of the first video elementary stream listed in the PMT.
+    When the segment does not contain a PAT/PMT, the first PES with a
+    video stream_id is used instead.
+    """
+    pmt_pids = find_pmt_pids(_data)
+    data_len = len(_data) - TS_PACKET_SIZE
+    i = 0
+    while i <= data_len and pmt_pids:
+        if packet_pid(_data, i) in pmt_pids:
+            section = psi_section(_data, i)
+            if section is not None and _data[section[0]] == 0x02:
+                start, end = section
+                j = start + 12 + (((_data[start + 10] & 0x0F) << 8) | _data[start + 11])
+                while j + 5 <= end:
+                    stream_type = _data[j]
+                    es_pid = ((_data[j + 1] & 0x1F) << 8) | _data[j + 2]
+                    if stream_type in VIDEO_STREAM_TYPES:
+                        return es_pid
+                    j += 5 + (((_data[j + 3] & 0x0F) << 8) | _data[j + 4])
+        i += TS_PACKET_SIZE
+
+    i = 0
+    while i <= data_len:
+        pid = packet_pid(_data, i)
+        if pid is not None and pid != NULL_PID and _data[i + 1] & 0x40:
+            start = payload_offset(_data, i)
+            if start is not None and start + 4 <= i + TS_PACKET_SIZE \
+                    and _data[start:start + 3] == b'\x00\x00\x01' \
+                    and 0xE0 <= _data[start + 3] <= 0xEF:
+                return pid
+        i += TS_PACKET_SIZE
+    return None
+
+
+def get_pes_packets(_data, _pid=None):
+    """
+    Walks the buffer and returns one dict per PES packet on the video PID
+    in stream (decode) order, similar to "ffprobe -show_packets -select_streams v:0"
+    Each dict contains pts, pos (byte offset of the first TS packet), size
+    (PES payload bytes) and duration (when it can be derived from the DTS/PTS).
+    PES packets without a PTS are not included.
+    """
+    if _data is None:
+        return None
+    if _pid is None:
+        _pid = find_video_pid(_data)
+        if _pid is None:
+            return None
+    pid_hi = _pid >> 8
+    pid_lo = _pid & 0xFF
+    packets = []
+    current = None
+    data_len = len(_data) - TS_PACKET_SIZE
+    i = 0
+    while i <= data_len:
+        if _data[i] != TS_SYNC_BYTE \
+                or _data[i + 2] != pid_lo \
+                or (_data[i + 1] & 0x1F) != pid_hi:
+            i += TS_PACKET_SIZE
+            continue
+        start = payload_offset(_data, i)
+        if start is None:
+            i += TS_PACKET_SIZE
+            continue
+        end = i + TS_PACKET_SIZE
+        if _data[i + 1] & 0x40:
+            current = None
+            if start + 14 <= end and _data[start:start + 3] == b'\x00\x00\x01':
+                pts_dts_flags = _data[start + 7] >> 6
+                header_end = start + 9 + _data[start + 8]
+                if pts_dts_flags & 0x02:
+                    current = {
+                        'pts': decode_timestamp(_data, start + 9),
+                        'pos': i,
+                        'size': max(end - header_end, 0)}
+                    if pts_dts_flags == 3 and start + 19 <= end:
+                        current['dts'] = decode_timestamp(_data, start + 14)
+                    else:
+                        current['dts'] = current['pts']
+                    packets.append(current)
+        elif current is not None:
+            current['size'] += end - start
+        i += TS_PACKET_SIZE
+
+    # duration is the distance to the next decode timestamp
+    duration = None
+    for j in range(len(packets)):
+        if j + 1 < len(packets):
+            delta = packets[j + 1]['dts'] - packets[j]['dts']
+            if delta > 0:
+                duration = delta
+        if duration is not None:
+            packets[j]['duration'] = duration
+        del packets[j]['dts']
+    return packets